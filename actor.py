@@ -0,0 +1,123 @@
+"""
+Groups as actors.
+
+In threaded mode every Group owns a mailbox. Threads reading from clients (and
+the scheduler) only post work to it; a small pool of WORKERS threads runs the
+mailboxes, each one on a single worker at a time and in the order things were
+posted. A group's state is therefore only ever touched by one thread and needs
+no lock, while separate groups run side by side. A busy group gives its worker
+back after THROUGHPUT messages so it can't starve the others.
+
+The asyncio and prefork servers already run every group on their event loop,
+there is no pool and posting simply runs the work right away.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import Future
+from queue import SimpleQueue
+from threading import Lock, Thread
+
+# overridden from the server command line
+WORKERS = os.cpu_count() or 1
+# messages an actor handles before letting another one have the worker
+THROUGHPUT = 64
+
+# actors with something in their mailbox, waiting for a worker
+_ready = SimpleQueue()
+_started = False
+
+
+class Actor:
+    """
+    A mailbox run by one worker at a time
+    """
+
+    __slots__ = ("mailbox", "scheduled", "lock")
+
+    def __init__(self) -> None:
+        self.mailbox = deque()
+        # in the ready queue or running, so no other worker picks it up
+        self.scheduled = False
+        # only guards the two above, never held while running
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.mailbox)
+
+    def post(self, fn, *args) -> None:
+        """
+        run a function on the actor, after everything posted before it
+        :param fn: the function
+        :param args: its arguments
+        :return: None
+        """
+        if not _started:
+            fn(*args)
+            return
+
+        with self.lock:
+            self.mailbox.append((fn, args))
+            if self.scheduled:
+                return
+            self.scheduled = True
+        _ready.put(self)
+
+    def call(self, fn, *args) -> Future:
+        """
+        post a function and get its result back
+        :param fn: the function
+        :param args: its arguments
+        :return: a Future of what it returns, never wait on it from the actor
+                 itself
+        """
+        future = Future()
+
+        def run() -> None:
+            try:
+                future.set_result(fn(*args))
+            except Exception as error:
+                future.set_exception(error)
+
+        self.post(run)
+        return future
+
+    def run(self) -> None:
+        """
+        handle what is in the mailbox, on a worker
+        :return: None
+        """
+        mailbox = self.mailbox
+        for _ in range(THROUGHPUT):
+            with self.lock:
+                if not mailbox:
+                    self.scheduled = False
+                    return
+                fn, args = mailbox.popleft()
+
+            try:
+                fn(*args)
+            except Exception:
+                # the poster gets no answer either way, the worker must live on
+                pass
+
+        # still busy, back in line behind the other actors
+        _ready.put(self)
+
+
+def _work() -> None:
+    while True:
+        _ready.get().run()
+
+
+def start() -> None:
+    """
+    start the workers, from then on posted work runs on them
+    :return: None
+    """
+    global _started
+    if _started:
+        return
+    _started = True
+    for _ in range(max(1, WORKERS)):
+        Thread(target=_work, daemon=True).start()
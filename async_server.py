@@ -0,0 +1,460 @@
+import asyncio
+from collections import deque
+from time import monotonic
+
+import auth
+import compression
+import connection
+import directory
+import events
+import heartbeat
+import metrics
+import protocol
+import ratelimit
+import scheduler
+import snapshot
+import transfer
+from colors import color
+from connection import BLOCK, OutboundQueue
+from group import ASK_PASSWORD, Group
+from protocol import READ_SIZE, FrameDecoder
+from server import (
+    ASK_GROUP,
+    ASK_SECRET,
+    ASK_TYPE,
+    BAD_TYPE,
+    CREATED,
+    CREATED_MEANWHILE,
+    HOST,
+    NEW_ADMIN,
+    NO_SUCH_GROUP,
+    PORT,
+    WELCOME,
+    admit,
+    drop,
+    groups,
+    handle_frame,
+    special_message,
+)
+
+fg = color.fg
+reset = color.style.reset
+
+# clients whose queue went over its limit under the block policy, senders wait
+# for them to catch up before reading their next frame
+CONGESTED = set()
+
+
+class StreamClient:
+    """
+    Wraps an asyncio stream pair so that it can be used by Group in place of a socket,
+    writes go through a bounded queue drained by a writer task
+    """
+
+    def __init__(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """
+
+        :param reader: stream reader of the connection
+        :param writer: stream writer of the connection
+        """
+        self.reader = reader
+        self.writer = writer
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            connection.set_nodelay(sock)
+        self.decoder = FrameDecoder(inflate=True)
+        self.frames = deque()
+        # extensions the client asked for, see connection.negotiate
+        self.events = False
+        self.compress = False
+        self.resume = False
+        self.files = False
+
+        self.queue = OutboundQueue(connection.QUEUE_SIZE, connection.OVERFLOW)
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.closing = False
+        self.closed = False
+        self.queued_at = 0.0
+        # wakes the writer once the coalescing delay is over, see connection
+        self.flush = None
+        # when the client was last heard from, see heartbeat
+        self.last_seen = monotonic()
+        self.heartbeat = None
+
+        self.write_task = asyncio.create_task(self._write_loop())
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.queue)
+
+    def send(self, data: bytes) -> None:
+        """
+        queue one or more encoded frames for the writer task, never blocks the loop
+        :param data: encoded frame(s)
+        :return: None
+        """
+        if self.closed or self.closing:
+            return
+
+        if not self.events:
+            data = events.to_text(data)
+        if self.compress:
+            data = compression.pack(data)
+
+        first = not self.queue
+        if first:
+            self.queued_at = monotonic()
+
+        if not self.queue.push(data):
+            self._abort()
+            return
+
+        if self.queue.policy == BLOCK and self.queue.full():
+            self.space.clear()
+            CONGESTED.add(self)
+
+        if self.queue.ready():
+            if self.flush is not None:
+                self.flush.cancel()
+                self.flush = None
+            self.ready.set()
+        elif first:
+            self.flush = asyncio.get_running_loop().call_later(
+                connection.COALESCE_DELAY, self._flush
+            )
+
+    sendall = send
+
+    def _flush(self) -> None:
+        self.flush = None
+        self.ready.set()
+
+    async def writable(self) -> None:
+        """
+        wait for the queue to get back under its limit, a client that stays
+        stalled for longer than BLOCK_TIMEOUT is disconnected
+        :return: None
+        """
+        try:
+            await asyncio.wait_for(self.space.wait(), connection.BLOCK_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._abort()
+
+    def _relieve(self) -> None:
+        self.space.set()
+        CONGESTED.discard(self)
+
+    def _abort(self) -> None:
+        """
+        drop a client that can't keep up, its listen coroutine sees the
+        connection end and cleans up like for any other disconnect
+        :return: None
+        """
+        self.closed = True
+        self.queue.drain()
+        self._relieve()
+        self.ready.set()
+        self.writer.transport.abort()
+
+    async def _write_loop(self) -> None:
+        """
+        writer task, sends whatever piled up in the queue in one go
+        :return: None
+        """
+        try:
+            while not self.closed:
+                # held back while more frames may join them, see connection
+                if not self.queue or (self.flush is not None and not self.closing):
+                    if self.closing:
+                        break
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+
+                batch = self.queue.drain()
+                self._relieve()
+                metrics.WRITE_DELAY_SECONDS.observe(monotonic() - self.queued_at)
+                metrics.BYTES_SENT.inc(sum(map(len, batch)))
+                metrics.WRITES.inc()
+                self.writer.writelines(batch)
+                await self.writer.drain()
+
+        except (ConnectionError, OSError):
+            self._abort()
+
+        finally:
+            if self.closing:
+                self.writer.close()
+
+    async def recv_frame(self):
+        """
+        wait until a whole frame is available
+        :return: the next Frame, or None once the peer has closed the connection
+        """
+        while True:
+            while not self.frames:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    return None
+                self.last_seen = monotonic()
+                self.frames.extend(self.decoder.feed(data))
+
+            frame = self.frames.popleft()
+            if frame.type == protocol.HELLO:
+                connection.negotiate(self, frame.payload)
+            elif frame.type != protocol.PONG:
+                return frame
+
+    async def recv_line(self) -> str:
+        """
+        read the next frame as the text the user typed, used during the handshake
+        :return: the text of the frame
+        """
+        frame = await self.recv_frame()
+        if frame is None:
+            raise ConnectionError("connection closed by peer")
+        return frame.line
+
+    def expire(self) -> None:
+        """
+        stop reading from a client that timed out, its listen coroutine sees
+        the connection end while what is queued still gets written
+        :return: None
+        """
+        self.reader.feed_eof()
+
+    def close(self) -> None:
+        """
+        stop accepting frames, the writer flushes what is queued and closes the stream
+        :return: None
+        """
+        self.closing = True
+        self.ready.set()
+        if self.closed:
+            self.writer.close()
+
+
+async def listen(client: StreamClient, username: str, group: Group) -> None:
+    """
+    listening coroutine for the server
+    :param client: stream client of the user
+    :param username: username of the user
+    :param group: group object of the user's group
+    :return: None
+    """
+    limiter = ratelimit.Limiter()
+    waiting = group.is_waiting(username)
+    heartbeat.enter(client, heartbeat.WAITING if waiting else heartbeat.CHATTING)
+    while group.is_alive:
+        try:
+            frame = await client.recv_frame()
+            member = group.sessions.get(username)
+            if frame is not None and member is not None and member.waiting:
+                continue
+            if member is None or member.waiting:
+                if member is not None and member.conn is client:
+                    # gave up, or timed out, before being answered
+                    group.withdraw(username)
+                break
+
+            if frame is None:
+                special_message(username, client, group, "quit")
+                return
+
+            if frame.type in transfer.FRAMES:
+                # paced by the recipients, see server.receive
+                transfer.handle(group, username, client, frame)
+            elif not admit(username, client, group, limiter, frame):
+                if not group.is_member(username):
+                    break
+            elif not member.muted:
+                handle_frame(username, client, group, frame)
+
+            while CONGESTED:
+                await next(iter(CONGESTED)).writable()
+
+        except Exception:
+            # reset or broken, the user is gone all the same
+            drop(username, client, group)
+            break
+
+
+async def create_new_group(conn: StreamClient, username: str, name: str) -> bool:
+    """
+    create a new group object
+    :param conn: stream client of the user
+    :param username: the username of the connected client
+    :param name: name of the group
+    :return: bool
+    """
+    secret = None
+
+    conn.send(ASK_TYPE)
+    gtype = await conn.recv_line()
+
+    if gtype not in ["open", "secret", "private"]:
+        # the caller sends the kill, frames arrive in order so the client
+        # shows this first
+        conn.send(BAD_TYPE)
+        return False
+
+    if gtype == "secret":
+        conn.send(ASK_SECRET)
+        secret = await auth.hash_secret_async(await conn.recv_line())
+
+    if name in groups:
+        # created by someone else while this user answered the questions
+        conn.send(CREATED_MEANWHILE(name))
+        return False
+    groups[name] = Group(name, username, conn, gtype, secret)
+    conn.send(CREATED)
+    conn.send(NEW_ADMIN(gtype))
+    # a group created again picks up its logged history
+    groups[name].catch_up(username)
+
+    return True
+
+
+async def service_user(conn: StreamClient, username: str, group_name: str) -> None:
+    """
+    Coroutine to allocate a new user to some group
+    :param conn: stream client of the user
+    :param username: username of the client
+    :param group_name: group name the user wants to join/create
+    :return: None
+    """
+    if group_name in groups.keys() and groups[group_name].is_alive:
+        group = groups[group_name]
+
+        if group.type == "open":
+            group.open_accept(conn, username)
+
+        elif group.type == "secret":
+            conn.send(ASK_PASSWORD)
+            passwd = await conn.recv_line()
+            valid = await auth.verify_async(group.secret_key, passwd)
+            if not group.secret_verify(conn, username, valid):
+                return
+
+        elif group.type == "private":
+            if not group.private_accept(conn, username):
+                conn.send(protocol.KILL_FRAME)
+                return
+
+    else:
+
+        conn.send(NO_SUCH_GROUP(group_name))
+        answer = await conn.recv_line()
+
+        if answer.lower() != "y":
+            conn.send(protocol.KILL_FRAME)
+            return
+
+        ok = await create_new_group(conn, username, group_name)
+
+        if not ok:
+            conn.send(protocol.KILL_FRAME)
+            return
+
+    await listen(conn, username, groups[group_name])
+
+
+async def welcome_user(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """
+    Start the chat process, one coroutine per connection on the shared event loop
+    :param reader: stream reader of the client
+    :param writer: stream writer of the client
+    :return: None
+    """
+    await session(StreamClient(reader, writer), writer.get_extra_info("peername"))
+
+
+async def session(conn, addr) -> None:
+    """
+    Run the handshake and the chat for one connection, conn is a StreamClient or
+    anything with the same interface (see prefork.RemoteConnection)
+    :param conn: connection of the client
+    :param addr: ip adrress and port of the client
+    :return: None
+    """
+    beat = heartbeat.watch(conn)
+    username = None
+    metrics.CONNECTIONS.inc()
+    metrics.SESSIONS.inc()
+    try:
+        conn.send(WELCOME)
+        frame = await conn.recv_frame()
+        if frame is not None and frame.type == protocol.SESSION:
+            # back after a restart, straight into the group
+            username, group = snapshot.resume(conn, frame.payload)
+            if group is not None:
+                await listen(conn, username, group)
+                return
+            frame = await conn.recv_frame()
+
+        if frame is None:
+            raise ConnectionError("connection closed by peer")
+        username = frame.line
+        while not directory.claim(username, conn):
+            conn.send(directory.NAME_TAKEN(username))
+            username = await conn.recv_line()
+
+        conn.send(ASK_GROUP)
+        group_name = await conn.recv_line()
+        await service_user(conn, username, group_name)
+
+    except Exception:
+        print(
+            f"{fg.red} connection {addr} disappeared in midst of joining group {reset}"
+        )
+
+    finally:
+        beat.stop()
+        if username is not None:
+            directory.release(username, conn)
+        metrics.SESSIONS.dec()
+        conn.close()
+
+
+async def serve() -> None:
+    """
+    accept connections forever on the running event loop
+    :return: None
+    """
+    server = await asyncio.start_server(welcome_user, HOST, PORT, reuse_address=True)
+    restored = snapshot.restore()
+    if restored:
+        print(f"[+] RESTORED {restored} GROUPS")
+    snapshot.start()
+    reaper = asyncio.create_task(scheduler.run_async())
+    print("[+] SERVER IS UP AND RUNNING (asyncio)...")
+    print("[+] WAITING FOR CONNECTIONS...")
+
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            reaper.cancel()
+
+
+def start_server() -> None:
+    """
+    start the asyncio server
+    :return: None
+    """
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        print("SERVER CRASHED")
+
+
+if __name__ == "__main__":
+    start_server()
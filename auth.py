@@ -0,0 +1,125 @@
+"""
+Secret keys of secret groups.
+
+Keys are never kept in clear: a group stores a salted scrypt hash. Deriving one
+is deliberately slow, so it runs on a small pool of worker processes. The
+thread or coroutine handling the join waits for its own answer without holding
+up anyone else, and a join storm can only ever take WORKERS cores. A correct
+key is remembered for CACHE_SECONDS, so clients reconnecting in bulk are let
+in without deriving it again.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from threading import Lock
+from time import monotonic
+
+# scrypt cost, about 50ms and 16MiB per derivation
+N = 1 << 14
+R = 8
+P = 1
+SALT_BYTES = 16
+
+# overridden from the server command line
+WORKERS = max(1, (os.cpu_count() or 2) // 2)
+CACHE_SECONDS = 60.0
+CACHE_SIZE = 1024
+
+_pool = None
+_pool_lock = Lock()
+# digest of (hash, key) -> when the success stops counting
+_cache = dict()
+_cache_lock = Lock()
+
+
+def _derive(secret: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(secret.encode(), salt=salt, n=n, r=r, p=p, dklen=32)
+
+
+def _hash(secret: str) -> str:
+    salt = os.urandom(SALT_BYTES)
+    digest = _derive(secret, salt, N, R, P)
+    return f"scrypt${N}${R}${P}${salt.hex()}${digest.hex()}"
+
+
+def _check(hashed: str, secret: str) -> bool:
+    _, n, r, p, salt, digest = hashed.split("$")
+    derived = _derive(secret, bytes.fromhex(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(derived, bytes.fromhex(digest))
+
+
+def pool() -> ProcessPoolExecutor:
+    """
+    :return: the worker processes, started on first use
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawned, forking a process full of threads and sockets is unsafe
+            _pool = ProcessPoolExecutor(WORKERS, mp_context=get_context("spawn"))
+    return _pool
+
+
+def _cache_key(hashed: str, secret: str) -> bytes:
+    return hashlib.sha256(f"{hashed}\0{secret}".encode()).digest()
+
+
+def _cached(hashed: str, secret: str) -> bool:
+    until = _cache.get(_cache_key(hashed, secret))
+    return until is not None and until > monotonic()
+
+
+def _remember(hashed: str, secret: str, valid: bool) -> bool:
+    if valid and CACHE_SECONDS:
+        with _cache_lock:
+            _cache[_cache_key(hashed, secret)] = monotonic() + CACHE_SECONDS
+            while len(_cache) > CACHE_SIZE:
+                del _cache[next(iter(_cache))]
+    return valid
+
+
+def hash_secret(secret: str) -> str:
+    """
+    hash a new group's key, waits for a worker
+    :param secret: the key in clear
+    :return: the salted hash to keep
+    """
+    return pool().submit(_hash, secret).result()
+
+
+async def hash_secret_async(secret: str) -> str:
+    """
+    hash_secret for the event loop
+    :param secret: the key in clear
+    :return: the salted hash to keep
+    """
+    return await asyncio.wrap_future(pool().submit(_hash, secret))
+
+
+def verify(hashed: str, secret: str) -> bool:
+    """
+    check a key, waits for a worker unless it was right a moment ago
+    :param hashed: the group's salted hash
+    :param secret: the key the user entered
+    :return: whether it is the right key
+    """
+    if _cached(hashed, secret):
+        return True
+    return _remember(hashed, secret, pool().submit(_check, hashed, secret).result())
+
+
+async def verify_async(hashed: str, secret: str) -> bool:
+    """
+    verify for the event loop
+    :param hashed: the group's salted hash
+    :param secret: the key the user entered
+    :return: whether it is the right key
+    """
+    if _cached(hashed, secret):
+        return True
+    valid = await asyncio.wrap_future(pool().submit(_check, hashed, secret))
+    return _remember(hashed, secret, valid)
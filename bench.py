@@ -0,0 +1,557 @@
+#!/usr/bin/env python3
+"""
+Load generator for chat_house.
+
+Spawns many simulated clients that speak the same protocol as client.py and
+runs one or more scenarios against a server, then prints the results as JSON
+so runs can be compared.
+
+    python bench.py --spawn async --clients 2000 broadcast
+    python bench.py --server-pid 1234 join-open join-secret join-private
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict, deque
+
+import protocol
+from protocol import READ_SIZE, FrameDecoder, from_line
+from server import HOST, PORT
+
+MARK = "bench"
+JOIN_ERRORS = (ConnectionError, OSError, asyncio.TimeoutError)
+SCENARIOS = [
+    "join-open",
+    "join-secret",
+    "join-private",
+    "broadcast",
+    "private",
+    "except",
+    "admin",
+]
+
+
+class SimClient:
+    """
+    One simulated user
+    """
+
+    def __init__(self, name: str) -> None:
+        """
+
+        :param name: username of the client
+        """
+        self.name = name
+        self.reader = None
+        self.writer = None
+        self.frames = asyncio.Queue()
+        self.on_frame = None
+        self.task = None
+
+    async def connect(self, host: str, port: int) -> None:
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self) -> None:
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    if frame.type == protocol.PING:
+                        self.writer.write(protocol.PONG_FRAME)
+                        continue
+                    if self.on_frame is not None:
+                        self.on_frame(frame)
+                    else:
+                        self.frames.put_nowait(frame)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.frames.put_nowait(None)
+
+    def send(self, line: str) -> None:
+        self.writer.write(from_line(line))
+
+    async def expect(self, *needles: str, timeout: float = 30) -> str:
+        """
+        wait for a message containing one of the needles
+        :param needles: substrings to look for
+        :param timeout: seconds before giving up
+        :return: the text of the matching message
+        """
+
+        async def wait() -> str:
+            while True:
+                frame = await self.frames.get()
+                if frame is None or frame.type == protocol.KILL:
+                    raise ConnectionError(f"{self.name} was disconnected")
+                message = frame.text
+                if any(needle in message for needle in needles):
+                    return message
+
+        return await asyncio.wait_for(wait(), timeout)
+
+    async def join(self, group: str, gtype: str = "", secret: str = "") -> None:
+        """
+        run the handshake, creating the group when gtype is given
+        :param group: name of the group
+        :param gtype: type of the group to create, empty to join an existing one
+        :param secret: key of a secret group
+        :return: None
+        """
+        await self.expect("username")
+        self.send(self.name)
+        await self.expect("name of the group")
+        self.send(group)
+
+        if gtype:
+            await self.expect("Would you like to create one")
+            self.send("y")
+            await self.expect("type of group")
+            self.send(gtype)
+            if gtype == "secret":
+                await self.expect("secret key")
+                self.send(secret)
+            await self.expect("admin of this new")
+        elif secret:
+            await self.expect("password")
+            self.send(secret)
+            await self.expect("Welcome to the secret chat")
+        else:
+            await self.expect("Welcome to the chatroom", "request has been sent")
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Recorder:
+    """
+    Collects delivery latencies of benchmark messages
+    """
+
+    def __init__(self) -> None:
+        self.latencies = []
+        self.delivered = 0
+        self.last = 0.0
+
+    def __call__(self, frame: protocol.Frame) -> None:
+        message = frame.text
+        at = message.find(MARK + " ")
+        if at < 0:
+            return
+
+        now = time.perf_counter()
+        self.latencies.append(now - float(message[at + len(MARK) + 1 :].split()[0]))
+        self.delivered += 1
+        self.last = now
+
+
+def stamp() -> str:
+    return f"{MARK} {time.perf_counter():.9f}"
+
+
+def percentiles(samples: list) -> dict:
+    """
+    :param samples: latencies in seconds
+    :return: p50/p99/p999/max in milliseconds
+    """
+    if not samples:
+        return {"p50": None, "p99": None, "p999": None, "max": None}
+
+    samples = sorted(samples)
+    last = len(samples) - 1
+
+    def pick(q: float) -> float:
+        return round(samples[min(last, int(q * len(samples)))] * 1000, 3)
+
+    return {
+        "p50": pick(0.50),
+        "p99": pick(0.99),
+        "p999": pick(0.999),
+        "max": round(samples[-1] * 1000, 3),
+    }
+
+
+def rss_kb(pid: int) -> int:
+    """
+    resident memory of a process and all its children (prefork workers)
+    :param pid: process id of the server
+    :return: RSS in KiB, 0 when unknown
+    """
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as children:
+                    pending.extend(int(i) for i in children.read().split())
+        except (OSError, ValueError):
+            continue
+
+    return total
+
+
+class Bench:
+    """
+    Runs scenarios against one server
+    """
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.run_id = f"{os.getpid()}x{int(time.time()) % 100000}"
+        self.join_failures = 0
+
+    def name(self, kind: str, i: int) -> str:
+        return f"{kind}{self.run_id}n{i}"
+
+    async def connect_many(self, names: list) -> list:
+        """
+        open connections with bounded concurrency so the accept queue is not
+        overrun by the benchmark itself
+        :param names: usernames
+        :return: list of connected SimClient
+        """
+        limit = asyncio.Semaphore(self.args.concurrency)
+
+        async def one(name: str) -> SimClient:
+            async with limit:
+                client = SimClient(name)
+                await client.connect(self.args.host, self.args.port)
+                return client
+
+        return await asyncio.gather(*[one(name) for name in names])
+
+    async def make_group(self, size: int, gtype: str = "open") -> list:
+        """
+        create a group and fill it with members
+        :param size: total number of members, admin included
+        :param gtype: type of the group
+        :return: list of SimClient, admin first
+        """
+        group = self.name("g", 0)
+        secret = "s3cret" if gtype == "secret" else ""
+        (admin,) = await self.connect_many([self.name("admin", 0)])
+        await admin.join(group, gtype, secret)
+
+        members = await self.connect_many(
+            [self.name("u", i) for i in range(1, size)]
+        )
+        limit = asyncio.Semaphore(self.args.concurrency)
+
+        async def join(member: SimClient) -> bool:
+            async with limit:
+                try:
+                    await member.join(group, secret=secret)
+                    return True
+                except JOIN_ERRORS:
+                    member.close()
+                    return False
+
+        joined = await asyncio.gather(*[join(member) for member in members])
+        self.join_failures = joined.count(False)
+        self.run_id += "r"
+        return [admin] + [member for member, ok in zip(members, joined) if ok]
+
+    async def join_storm(self, gtype: str) -> dict:
+        group = self.name("g", 0)
+        secret = "s3cret" if gtype == "secret" else ""
+        (admin,) = await self.connect_many([self.name("admin", 0)])
+        await admin.join(group, gtype, secret)
+
+        if gtype == "private":
+            # the admin approves every request as soon as it shows up
+            def approve(frame: protocol.Frame) -> None:
+                message = frame.text
+                if "has requested to join" in message:
+                    admin.send(f"!accept {message.split()[2]}")
+
+            admin.on_frame = approve
+
+        names = [self.name("u", i) for i in range(1, self.args.clients)]
+        limit = asyncio.Semaphore(self.args.concurrency)
+        latencies = []
+
+        async def join(name: str) -> SimClient:
+            async with limit:
+                started = time.perf_counter()
+                client = SimClient(name)
+                try:
+                    await client.connect(self.args.host, self.args.port)
+                    await client.join(group, secret=secret)
+                    if gtype == "private":
+                        await client.expect("has been accepted")
+                except JOIN_ERRORS:
+                    return client
+                latencies.append(time.perf_counter() - started)
+                return client
+
+        started = time.perf_counter()
+        clients = await asyncio.gather(*[join(name) for name in names])
+        elapsed = time.perf_counter() - started
+
+        self.run_id += "r"
+        for client in [admin] + list(clients):
+            client.close()
+
+        return {
+            "joins": len(latencies),
+            "join_failures": len(names) - len(latencies),
+            "duration_s": round(elapsed, 3),
+            "joins_per_sec": round(len(latencies) / elapsed, 1),
+            "latency_ms": percentiles(latencies),
+        }
+
+    async def fan_out(self, kind: str) -> dict:
+        """
+        senders each send --messages messages as broadcasts, @ or - messages,
+        every receiver records the delivery latency
+        """
+        clients = await self.make_group(self.args.clients)
+        size = len(clients)
+        recorder = Recorder()
+        for client in clients:
+            client.on_frame = recorder
+
+        senders = clients[: self.args.senders]
+        targets = self.args.targets
+
+        def line(sender: int) -> str:
+            if kind == "private":
+                to = [clients[(sender + k + 1) % size].name for k in range(targets)]
+                return f"@{','.join(to)} {stamp()}"
+            if kind == "except":
+                to = [clients[(sender + k + 1) % size].name for k in range(targets)]
+                return f"-{','.join(to)} {stamp()}"
+            return stamp()
+
+        if kind == "private":
+            per_message = targets
+        elif kind == "except":
+            # private_except_message also delivers back to the sender
+            per_message = size - targets
+        else:
+            per_message = size - 1
+
+        interval = 1 / self.args.rate if self.args.rate else 0
+
+        async def send(index: int, sender: SimClient) -> None:
+            for i in range(self.args.messages):
+                sender.send(line(index))
+                if interval:
+                    await asyncio.sleep(interval)
+                elif i % 64 == 63:
+                    await sender.writer.drain()
+
+        started = time.perf_counter()
+        await asyncio.gather(*[send(i, s) for i, s in enumerate(senders)])
+        sent_at = time.perf_counter()
+        expected = len(senders) * self.args.messages * per_message
+
+        deadline = sent_at + self.args.timeout
+        while recorder.delivered < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+
+        elapsed = (recorder.last or time.perf_counter()) - started
+        for client in clients:
+            client.close()
+
+        return {
+            "group_size": size,
+            "join_failures": self.join_failures,
+            "senders": len(senders),
+            "messages_sent": len(senders) * self.args.messages,
+            "deliveries_expected": expected,
+            "deliveries": recorder.delivered,
+            "duration_s": round(elapsed, 3),
+            "sent_per_sec": round(len(senders) * self.args.messages / elapsed, 1),
+            "msgs_per_sec": round(recorder.delivered / elapsed, 1),
+            "latency_ms": percentiles(recorder.latencies),
+        }
+
+    async def admin_storm(self) -> dict:
+        """
+        the admin fires query and moderation commands back to back and times
+        the reply to each one
+        """
+        clients = await self.make_group(self.args.clients)
+        admin, victim = clients[0], clients[1]
+        for client in clients[1:]:
+            client.on_frame = lambda frame: None
+
+        commands = [
+            ("!strength", "members are online"),
+            ("!whosonline", "Currently online are"),
+            ("!whosadmin", "is currently the admin"),
+            (f"!mute {victim.name}", "was muted by"),
+            (f"!unmute {victim.name}", "was umuted by"),
+        ]
+        sent = defaultdict(deque)
+        latencies = []
+
+        def reply(frame: protocol.Frame) -> None:
+            message = frame.text
+            for _, needle in commands:
+                if needle in message and sent[needle]:
+                    latencies.append(time.perf_counter() - sent[needle].popleft())
+                    return
+
+        admin.on_frame = reply
+        total = self.args.messages * len(commands)
+
+        started = time.perf_counter()
+        for i in range(self.args.messages):
+            for command, needle in commands:
+                sent[needle].append(time.perf_counter())
+                admin.send(command)
+            if i % 16 == 15:
+                await admin.writer.drain()
+
+        deadline = time.perf_counter() + self.args.timeout
+        while len(latencies) < total and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        for client in clients:
+            client.close()
+
+        return {
+            "group_size": len(clients),
+            "join_failures": self.join_failures,
+            "commands_sent": total,
+            "replies": len(latencies),
+            "duration_s": round(elapsed, 3),
+            "commands_per_sec": round(len(latencies) / elapsed, 1),
+            "latency_ms": percentiles(latencies),
+        }
+
+    async def run(self, scenario: str) -> dict:
+        if scenario.startswith("join-"):
+            return await self.join_storm(scenario[len("join-") :])
+        if scenario == "admin":
+            return await self.admin_storm()
+        return await self.fan_out(scenario)
+
+
+def wait_for_port(host: str, port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def raise_fd_limit() -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def run_all(args: argparse.Namespace, pid: int) -> list:
+    bench = Bench(args)
+    results = []
+
+    for scenario in args.scenarios:
+        before = rss_kb(pid) if pid else None
+        result = await bench.run(scenario)
+        result = {"scenario": scenario, **result}
+        if pid:
+            result["server_rss_kb"] = {"before": before, "after": rss_kb(pid)}
+
+        results.append(result)
+        print(
+            f"[bench] {scenario}: {json.dumps(result['latency_ms'])}", file=sys.stderr
+        )
+        # let the server notice the departures before the next scenario
+        await asyncio.sleep(0.5)
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="chat_house load generator")
+    parser.add_argument(
+        "scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)"
+    )
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "--spawn",
+        choices=["threaded", "async", "prefork"],
+        help="start a server in this mode for the run",
+    )
+    parser.add_argument("--server-pid", type=int, help="pid of a running server")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=100, help="per sender")
+    parser.add_argument("--targets", type=int, default=3, help="for @ and -")
+    parser.add_argument("--rate", type=float, default=0, help="per sender, 0 = max")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or SCENARIOS
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    raise_fd_limit()
+
+    server = None
+    pid = args.server_pid
+    if args.spawn:
+        here = os.path.dirname(os.path.abspath(__file__))
+        # the load generator is the flood the rate limits are there to stop
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(here, "server.py"), "--mode", args.spawn]
+            + ["--no-rate-limits"],
+            stdout=subprocess.DEVNULL,
+        )
+        pid = server.pid
+        wait_for_port(args.host, args.port)
+
+    try:
+        results = asyncio.run(run_all(args, pid))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "mode": args.spawn,
+        "started": int(time.time()),
+        "clients": args.clients,
+        "senders": args.senders,
+        "messages": args.messages,
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,502 @@
+"""
+Headless client library, for bots, tests and load generators.
+
+    with ChatClient() as client:
+        client.join("bot", "lobby")
+        client.send("hello")
+        for frame in client:
+            print(frame.text)
+
+    async with AsyncChatClient() as client:
+        await client.join("bot", "lobby", gtype="open")
+        client.send("hello")
+        async for frame in client:
+            print(frame.text)
+
+Both run the join handshake for you and never wait for the server between
+sends, so any number of messages can be in flight. Received frames come out of
+an iterator, or go to an on_message callback once the client has joined. Pings
+are answered automatically and compression is offered unless turned off. With
+events=True group happenings come as EVENT frames, see events.decode.
+
+Once joined, client.token holds the session token; after a server restart a new
+client gets back in the same group with join(..., token=old.token).
+"""
+
+import asyncio
+import queue
+import socket
+from threading import Lock, Thread
+
+import compression
+import protocol
+from protocol import READ_SIZE, FrameDecoder, from_line
+
+HOST = "localhost"
+PORT = 5500
+
+
+class JoinError(ConnectionError):
+    """
+    raised when the server turns the handshake down
+    """
+
+
+class Handshake:
+    """
+    Answers the server's questions while joining a group, shared by both clients
+    """
+
+    def __init__(
+        self,
+        username: str,
+        group: str,
+        gtype: str = "",
+        secret: str = "",
+        resuming: bool = False,
+    ):
+        """
+
+        :param username: name to join with
+        :param group: group to join
+        :param gtype: type of the group to create if it doesn't exist, empty to
+                      only join an existing group
+        :param secret: key of a secret group, to create or to join it
+        :param resuming: a session token answered the first prompt
+        """
+        self.username = username
+        self.group = group
+        self.gtype = gtype
+        self.secret = secret
+        self.resuming = resuming
+        self.done = False
+        # joined a private group, still to be accepted by its admin
+        self.waiting = False
+
+    def answer(self, frame: protocol.Frame):
+        """
+        :param frame: the next frame from the server
+        :return: the line to send back, or None
+        """
+        if frame.type == protocol.KILL:
+            raise JoinError("the server closed the connection")
+
+        if frame.type != protocol.MESSAGE:
+            return None
+
+        message = frame.text
+        if "already taken" in message:
+            raise JoinError(f"username {self.username} is taken")
+        if "username" in message:
+            if self.resuming:
+                self.resuming = False
+                return None
+            return self.username
+        if "name of the group" in message:
+            return self.group
+        if "Would you like to create one" in message:
+            if not self.gtype:
+                raise JoinError(f"there is no group named {self.group}")
+            return "y"
+        if "type of group" in message:
+            return self.gtype
+        if "secret key" in message or "prove you are worthy" in message:
+            return self.secret
+        if (
+            "Wrong password" in message
+            or "Not a valid type" in message
+            or "Too many requests" in message
+            or "created by someone else" in message
+        ):
+            raise JoinError(message)
+
+        if "request has been sent" in message or "still waiting" in message:
+            self.waiting = True
+            self.done = True
+        elif (
+            "admin of this new" in message
+            or "Welcome back" in message
+            or "Welcome to the chatroom" in message
+            or "Welcome to the secret chat" in message
+        ):
+            self.done = True
+        return None
+
+
+class ChatClient:
+    """
+    Blocking client, a thread reads from the server while the caller sends
+    """
+
+    def __init__(
+        self,
+        host: str = HOST,
+        port: int = PORT,
+        on_message=None,
+        compress=True,
+        events=False,
+        resume=True,
+    ):
+        """
+
+        :param host: server address
+        :param port: server port
+        :param on_message: called with every Frame received once joined,
+                           from the reader thread, instead of queueing them
+        :param compress: offer compression to the server
+        :param events: ask for typed events instead of rendered text
+        :param resume: ask for a session token, see join
+        """
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.offers = []
+        if compress:
+            self.offers.append(protocol.ZLIB_OFFER)
+        if events:
+            self.offers.append(protocol.EVENTS_OFFER)
+        if resume:
+            self.offers.append(protocol.RESUME_OFFER)
+        # what the server accepted
+        self.compress = False
+        self.events = False
+        # session token, once joined
+        self.token = None
+        self.sock = None
+        self.frames = queue.Queue()
+        self.lock = Lock()
+        self.joining = False
+        self.waiting = False
+        self.closed = False
+
+    def connect(self) -> "ChatClient":
+        self.sock = socket.create_connection((self.host, self.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.offers:
+            self.sock.sendall(protocol.hello(*self.offers))
+        Thread(target=self._read_loop, daemon=True).start()
+        return self
+
+    def __enter__(self) -> "ChatClient":
+        return self.connect() if self.sock is None else self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def _read_loop(self) -> None:
+        decoder = FrameDecoder(inflate=True)
+        try:
+            while True:
+                data = self.sock.recv(READ_SIZE)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    if frame.type == protocol.PING:
+                        self._write(protocol.PONG_FRAME)
+                    elif frame.type == protocol.HELLO:
+                        self._accepted(frame.payload.split())
+                    elif frame.type == protocol.SESSION:
+                        self.token = frame.payload
+                    elif self.on_message is not None and not self.joining:
+                        self.on_message(frame)
+                    else:
+                        self.frames.put(frame)
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            self.frames.put(None)
+
+    def _accepted(self, offers: list) -> None:
+        self.compress = protocol.ZLIB_OFFER in offers
+        self.events = protocol.EVENTS_OFFER in offers
+
+    def _write(self, data: bytes) -> None:
+        if self.compress:
+            data = compression.pack(data)
+        with self.lock:
+            self.sock.sendall(data)
+
+    def join(
+        self,
+        username: str,
+        group: str,
+        gtype: str = "",
+        secret: str = "",
+        timeout=10,
+        token: bytes = None,
+    ) -> None:
+        """
+        run the handshake
+        :param username: name to join with
+        :param group: group to join
+        :param gtype: type of the group to create if it doesn't exist
+        :param secret: key of a secret group
+        :param timeout: seconds to wait for each answer of the server
+        :param token: session token of an earlier client, to get back in its
+                      group after a server restart without any prompt, the
+                      handshake runs as usual if the session is gone
+        :return: None, raises JoinError if the server refuses
+        """
+        handshake = Handshake(username, group, gtype, secret, token is not None)
+        self.joining = True
+        if token is not None:
+            self._write(protocol.encode(protocol.SESSION, token))
+        try:
+            while not handshake.done:
+                try:
+                    frame = self.frames.get(timeout=timeout)
+                except queue.Empty:
+                    raise JoinError("the server stopped answering") from None
+                if frame is None:
+                    raise JoinError("the server closed the connection")
+
+                line = handshake.answer(frame)
+                if line is not None:
+                    self.send(line)
+        finally:
+            self.joining = False
+
+        self.waiting = handshake.waiting
+        # whatever came with the welcome (history) goes to the callback too
+        if self.on_message is not None:
+            while not self.frames.empty():
+                frame = self.frames.get()
+                if frame is None:
+                    self.frames.put(None)
+                    break
+                self.on_message(frame)
+
+    def send(self, line: str) -> None:
+        """
+        send a line as typed in the interactive client (@, - and ! prefixes
+        work), without waiting for any answer
+        :param line: the message
+        :return: None
+        """
+        self._write(from_line(line))
+
+    def send_many(self, lines) -> None:
+        """
+        send several lines in a single write
+        :param lines: the messages
+        :return: None
+        """
+        self._write(b"".join(map(from_line, lines)))
+
+    def recv(self, timeout: float = None):
+        """
+        :param timeout: seconds to wait, None for ever
+        :return: the next Frame, None once the connection is closed, raises
+                 queue.Empty on timeout
+        """
+        frame = self.frames.get(timeout=timeout)
+        if frame is None:
+            # keep the end marker for the next caller
+            self.frames.put(None)
+        return frame
+
+    def __iter__(self):
+        while True:
+            frame = self.recv()
+            if frame is None:
+                return
+            yield frame
+
+    def close(self) -> None:
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+
+class AsyncChatClient:
+    """
+    asyncio client, a task reads from the server while the caller sends
+    """
+
+    def __init__(
+        self,
+        host: str = HOST,
+        port: int = PORT,
+        on_message=None,
+        compress=True,
+        events=False,
+        resume=True,
+    ):
+        """
+
+        :param host: server address
+        :param port: server port
+        :param on_message: called with every Frame received once joined,
+                           instead of queueing them
+        :param compress: offer compression to the server
+        :param events: ask for typed events instead of rendered text
+        :param resume: ask for a session token, see join
+        """
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.offers = []
+        if compress:
+            self.offers.append(protocol.ZLIB_OFFER)
+        if events:
+            self.offers.append(protocol.EVENTS_OFFER)
+        if resume:
+            self.offers.append(protocol.RESUME_OFFER)
+        # what the server accepted
+        self.compress = False
+        self.events = False
+        # session token, once joined
+        self.token = None
+        self.reader = None
+        self.writer = None
+        self.frames = asyncio.Queue()
+        self.task = None
+        self.joining = False
+        self.waiting = False
+        self.closed = False
+
+    async def connect(self) -> "AsyncChatClient":
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.offers:
+            self.writer.write(protocol.hello(*self.offers))
+        self.task = asyncio.create_task(self._read_loop())
+        return self
+
+    async def __aenter__(self) -> "AsyncChatClient":
+        return await self.connect() if self.writer is None else self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    async def _read_loop(self) -> None:
+        decoder = FrameDecoder(inflate=True)
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    if frame.type == protocol.PING:
+                        self.writer.write(protocol.PONG_FRAME)
+                    elif frame.type == protocol.HELLO:
+                        self._accepted(frame.payload.split())
+                    elif frame.type == protocol.SESSION:
+                        self.token = frame.payload
+                    elif self.on_message is not None and not self.joining:
+                        self.on_message(frame)
+                    else:
+                        self.frames.put_nowait(frame)
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            self.frames.put_nowait(None)
+
+    async def join(
+        self,
+        username: str,
+        group: str,
+        gtype: str = "",
+        secret: str = "",
+        timeout=10,
+        token: bytes = None,
+    ) -> None:
+        """
+        run the handshake
+        :param username: name to join with
+        :param group: group to join
+        :param gtype: type of the group to create if it doesn't exist
+        :param secret: key of a secret group
+        :param timeout: seconds to wait for each answer of the server
+        :param token: session token of an earlier client, to get back in its
+                      group after a server restart without any prompt, the
+                      handshake runs as usual if the session is gone
+        :return: None, raises JoinError if the server refuses
+        """
+        handshake = Handshake(username, group, gtype, secret, token is not None)
+        self.joining = True
+        if token is not None:
+            self._write(protocol.encode(protocol.SESSION, token))
+        try:
+            while not handshake.done:
+                try:
+                    frame = await asyncio.wait_for(self.frames.get(), timeout)
+                except asyncio.TimeoutError:
+                    raise JoinError("the server stopped answering") from None
+                if frame is None:
+                    raise JoinError("the server closed the connection")
+
+                line = handshake.answer(frame)
+                if line is not None:
+                    self.send(line)
+        finally:
+            self.joining = False
+
+        self.waiting = handshake.waiting
+        if self.on_message is not None:
+            while not self.frames.empty():
+                frame = self.frames.get_nowait()
+                if frame is None:
+                    self.frames.put_nowait(None)
+                    break
+                self.on_message(frame)
+
+    def send(self, line: str) -> None:
+        """
+        queue a line as typed in the interactive client, returns at once, see
+        drain to wait for the socket to catch up
+        :param line: the message
+        :return: None
+        """
+        self._write(from_line(line))
+
+    def send_many(self, lines) -> None:
+        self._write(b"".join(map(from_line, lines)))
+
+    def _accepted(self, offers: list) -> None:
+        self.compress = protocol.ZLIB_OFFER in offers
+        self.events = protocol.EVENTS_OFFER in offers
+
+    def _write(self, data: bytes) -> None:
+        if self.compress:
+            data = compression.pack(data)
+        self.writer.write(data)
+
+    async def drain(self) -> None:
+        """
+        wait until the kernel took what was sent, for flow control at high rates
+        :return: None
+        """
+        await self.writer.drain()
+
+    async def recv(self):
+        """
+        :return: the next Frame, None once the connection is closed
+        """
+        frame = await self.frames.get()
+        if frame is None:
+            self.frames.put_nowait(None)
+        return frame
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        frame = await self.recv()
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        if self.task is not None:
+            await self.task
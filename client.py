@@ -2,70 +2,246 @@
 
 import socket
 import sys
-from threading import Thread
+from itertools import count
+from threading import Lock, Thread
+from time import sleep
 
+import events
+import protocol
+import transfer
 from colors import color
+from protocol import READ_SIZE, FrameDecoder
 
 fg = color.fg
 style = color.style
 
 HOST = "localhost"
 PORT = 5500
+# how many times, a second apart, to try getting back after losing the server
+RECONNECT_ATTEMPTS = 30
+
+# the current connection, replaced when reconnecting
+SOCK = None
+# session token from the server, to get back in the group after a restart
+TOKEN = None
+# the session was ended (quit, kicked...), no reconnecting
+ENDED = False
+# held while sending, file chunks go out from the listening thread too
+SEND_LOCK = Lock()
+# id -> transfer.Upload, transfer.Download
+UPLOADS = dict()
+DOWNLOADS = dict()
+_upload_ids = count(1)
+
+
+def send(sock, data):
+    with SEND_LOCK:
+        sock.sendall(data)
 
 
 def kill(sock):
+    global ENDED
+    ENDED = True
     sock.close()
     sys.exit()
 
 
 def listen(sock):
+    global TOKEN
+    decoder = FrameDecoder(inflate=True)
     while True:
         try:
-            data = sock.recv(1024).decode()
-            if data == "!!!KILL!!!":
-                kill(sock)
+            data = sock.recv(READ_SIZE)
+            if not data:
+                sock.close()
+                return
 
-            if data == "":
-                kill(sock)
-            print(data)
+            for frame in decoder.feed(data):
+                if frame.type == protocol.KILL:
+                    kill(sock)
+                if frame.type == protocol.PING:
+                    send(sock, protocol.PONG_FRAME)
+                    continue
+                if frame.type in transfer.FRAMES:
+                    transferring(sock, frame)
+                    continue
+                if frame.type == protocol.HELLO:
+                    continue
+                if frame.type == protocol.SESSION:
+                    TOKEN = frame.payload
+                    continue
+                if frame.type == protocol.EVENT:
+                    print(events.render(frame.payload))
+                    continue
+                print(frame.text)
 
         except KeyboardInterrupt:
-            sock.sendall("!quit".encode())
+            send(sock, protocol.from_line("!quit"))
             kill(sock)
 
         except:
             break
 
 
-def sending(sock):
+def transferring(sock, frame):
+    """
+    handle a frame of a file on its way to or from this client
+    :param sock: the socket
+    :param frame: the FILE, CHUNK, FILE_END or FILE_ACK frame
+    :return: None
+    """
+    payload = frame.payload
+    if frame.type == protocol.FILE:
+        file = transfer.Download(payload)
+        DOWNLOADS[file.id] = file
+        print(f" {file.sender} is sending you {file.name} ({file.size} bytes)")
+        return
+
+    (tid,) = transfer.ID.unpack_from(payload)
+    if frame.type == protocol.CHUNK:
+        file = DOWNLOADS.get(tid)
+        if file is not None:
+            send(sock, file.write(payload[transfer.ID.size :]))
+
+    elif frame.type == protocol.FILE_END:
+        file = DOWNLOADS.pop(tid, None)
+        if file is None:
+            return
+        digest = payload[transfer.ID.size :]
+        if file.finish(digest):
+            print(f"{fg.green} Saved {file.name} to {file.path}{style.reset}")
+        elif digest:
+            print(f"{fg.red} {file.name} arrived corrupted, discarded{style.reset}")
+        else:
+            print(f"{fg.yellow} {file.sender} cancelled {file.name}{style.reset}")
+
+    else:
+        file = UPLOADS.get(tid)
+        if file is None:
+            return
+        if len(payload) == transfer.ID.size:
+            UPLOADS.pop(tid).cancel()
+            print(f"{fg.yellow} Sending {file.name} was cancelled{style.reset}")
+            return
+        _, done = transfer.ACK.unpack(payload)
+        send(sock, file.next(done))
+        if file.done:
+            UPLOADS.pop(tid)
+            print(f"{fg.green} Sent {file.name}{style.reset}")
+
+
+def upload(line):
+    """
+    start sending a file, for `!send path` or `@name,name !send path`
+    :param line: what was typed
+    :return: None
+    """
+    recipients, _, path = line.partition("!send ")
+    path = path.strip()
+    try:
+        file = transfer.Upload(next(_upload_ids), path, recipients.strip()[1:])
+    except OSError as error:
+        print(f"{fg.red} Can't send {path}: {error.strerror}{style.reset}")
+        return
+
+    UPLOADS[file.id] = file
+    print(f" Sending {file.name} ({file.size} bytes)")
+    send(SOCK, file.start())
+    if file.done:
+        UPLOADS.pop(file.id, None)
+        print(f"{fg.green} Sent {file.name}{style.reset}")
+
+
+def abandon():
+    """
+    drop the transfers of a lost connection, the server dropped them too
+    :return: None
+    """
+    for file in UPLOADS.values():
+        file.cancel()
+    for file in DOWNLOADS.values():
+        file.finish(b"")
+    UPLOADS.clear()
+    DOWNLOADS.clear()
+
+
+def sending():
     while True:
         try:
-            message = input().encode()
-            sock.send(message)
+            message = input()
+            if message.startswith("!send ") or (
+                message.startswith("@") and " !send " in message
+            ):
+                upload(message)
+                continue
+            send(SOCK, protocol.from_line(message))
             if message == "!quit":
-                kill(sock)
+                kill(SOCK)
                 return
 
         except KeyboardInterrupt:
-            sock.sendall("!quit".encode())
-            kill(sock)
+            send(SOCK, protocol.from_line("!quit"))
+            kill(SOCK)
 
         except:
-            print("\n You were disconnected from the server")
-            break
+            if TOKEN is None:
+                print("\n You were disconnected from the server")
+                break
+            print("\n Not connected, the message was not sent")
+
+
+def connect():
+    """
+    connect to the server, resuming the session if there is one
+    :return: the socket
+    """
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect((HOST, PORT))
+    offers = protocol.hello(
+        protocol.ZLIB_OFFER,
+        protocol.EVENTS_OFFER,
+        protocol.RESUME_OFFER,
+        protocol.FILES_OFFER,
+    )
+    if TOKEN is not None:
+        # answers the first prompt, no username or group to type again
+        offers += protocol.encode(protocol.SESSION, TOKEN)
+    client.sendall(offers)
+    return client
+
+
+def reconnect():
+    """
+    wait for the server to come back
+    :return: the new socket, or None if it didn't
+    """
+    print(f"{fg.yellow} Disconnected, trying to get back in... {style.reset}")
+    for _ in range(RECONNECT_ATTEMPTS):
+        sleep(1)
+        try:
+            return connect()
+        except OSError:
+            continue
+    return None
 
 
 def start_connection():
+    global SOCK
     try:
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # client.settimeout(0.5)
-        client.connect((HOST, PORT))
-        listen_thread = Thread(target=listen, args=(client,), daemon=True)
-        send_thread = Thread(target=sending, args=(client,), daemon=True)
-
-        listen_thread.start()
+        SOCK = connect()
+        send_thread = Thread(target=sending, daemon=True)
         send_thread.start()
-        listen_thread.join()
+
+        while True:
+            listen_thread = Thread(target=listen, args=(SOCK,), daemon=True)
+            listen_thread.start()
+            listen_thread.join()
+            abandon()
+            if ENDED or TOKEN is None:
+                break
+            SOCK = reconnect()
+            if SOCK is None:
+                break
         exit(1)
 
     except KeyboardInterrupt:
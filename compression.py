@@ -0,0 +1,54 @@
+"""
+Compression of what the server sends to clients that asked for it.
+
+A client offers compression with protocol.ZLIB_OFFER in its HELLO; once the
+connection accepted it (see connection.negotiate) it packs every write of at
+least MIN_SIZE bytes. Deflating the same payload for every member of a group
+would cost as much as the fan-out saves, so recent results are kept: a broadcast
+is compressed for its first recipient and the others get the same bytes.
+"""
+
+from threading import Lock
+
+import metrics
+from protocol import CHUNK, HEADER_SIZE, MAX_FRAME_SIZE, deflate
+
+# overridden from the server command line
+ENABLED = True
+# writes smaller than this go as they are, deflate costs more than it saves
+MIN_SIZE = 256
+LEVEL = 6
+
+# encoded frame(s) -> what to send instead, recent payloads only
+CACHE_SIZE = 64
+_cache = dict()
+_lock = Lock()
+
+
+def pack(data: bytes) -> bytes:
+    """
+    :param data: encoded frame(s) about to be sent to a client that accepted
+                 compression
+    :return: a COMPRESSED frame, or data itself when compressing isn't worth it
+    """
+    size = len(data)
+    if size < MIN_SIZE or size > MAX_FRAME_SIZE:
+        return data
+    if data[HEADER_SIZE - 1] == CHUNK:
+        # file data, usually compressed already and never sent twice the same
+        return data
+
+    packed = _cache.get(data)
+    if packed is None:
+        packed = deflate(data, LEVEL)
+        if len(packed) >= size:
+            packed = data
+
+        with _lock:
+            _cache[data] = packed
+            while len(_cache) > CACHE_SIZE:
+                del _cache[next(iter(_cache))]
+
+    if packed is not data:
+        metrics.BYTES_SAVED.inc(size - len(packed))
+    return packed
@@ -0,0 +1,398 @@
+import os
+import socket
+from collections import deque
+from threading import Condition, Thread
+from time import monotonic
+
+import compression
+import events
+import metrics
+from protocol import (
+    EVENTS_OFFER,
+    FILES_OFFER,
+    HELLO,
+    PONG,
+    READ_SIZE,
+    RESUME_OFFER,
+    ZLIB_OFFER,
+    FrameDecoder,
+    hello,
+)
+
+# what to do when a client does not read fast enough and its queue is full
+DROP_OLDEST = "drop-oldest"
+DISCONNECT = "disconnect"
+BLOCK = "block"
+OVERFLOW_POLICIES = [DROP_OLDEST, DISCONNECT, BLOCK]
+
+# defaults for every new connection, overridden from the server command line
+QUEUE_SIZE = 1024
+OVERFLOW = DROP_OLDEST
+# with the block policy, a sender gives up on a stalled client after this long
+# and the client is disconnected
+BLOCK_TIMEOUT = 5.0
+# frames for a client are held back up to COALESCE_DELAY seconds after the
+# first one, or until COALESCE_BYTES are queued, and written together: fewer
+# syscalls and packets for a little latency, 0 writes as soon as possible
+COALESCE_DELAY = 0.0
+COALESCE_BYTES = 16 << 10
+# we batch our writes ourselves, Nagle's algorithm would only delay them more
+NODELAY = True
+# what the prefork workers get from the main process, see prefork.run_worker
+SETTINGS = (
+    "QUEUE_SIZE",
+    "OVERFLOW",
+    "BLOCK_TIMEOUT",
+    "COALESCE_DELAY",
+    "COALESCE_BYTES",
+    "NODELAY",
+)
+
+# clients whose queue went over its limit under the block policy, the threads
+# reading from clients wait for them to catch up before reading their next
+# frame (see wait_congested), senders never wait: they run on the actor pool
+CONGESTED = set()
+
+# most buffers the kernel takes in one sendmsg call
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def negotiate(conn, offers: bytes) -> None:
+    """
+    answer a client's HELLO, turning on the extensions the server supports
+    :param conn: the connection, anything with send and the compress, events,
+                 resume and files attributes
+    :param offers: payload of the HELLO frame
+    :return: None
+    """
+    offers = offers.split()
+    accepted = []
+    if EVENTS_OFFER in offers:
+        accepted.append(EVENTS_OFFER)
+    if compression.ENABLED and ZLIB_OFFER in offers:
+        accepted.append(ZLIB_OFFER)
+    if RESUME_OFFER in offers:
+        accepted.append(RESUME_OFFER)
+    if FILES_OFFER in offers:
+        accepted.append(FILES_OFFER)
+
+    # the answer itself goes out uncompressed
+    conn.send(hello(*accepted))
+    conn.events = EVENTS_OFFER in accepted
+    conn.compress = ZLIB_OFFER in accepted
+    conn.resume = RESUME_OFFER in accepted
+    conn.files = FILES_OFFER in accepted
+
+
+def wait_congested() -> None:
+    """
+    hold up the calling reader thread while a client is over its queue limit
+    under the block policy
+    :return: None
+    """
+    while CONGESTED:
+        try:
+            conn = next(iter(CONGESTED))
+        except (RuntimeError, StopIteration):
+            # changed by another thread meanwhile
+            continue
+        conn.writable()
+
+
+def set_nodelay(sock) -> None:
+    """
+    turn Nagle's algorithm off, or back on, as NODELAY says
+    :param sock: a TCP socket
+    :return: None
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(NODELAY))
+    except (AttributeError, OSError):
+        pass
+
+
+def send_buffers(sock: socket.socket, buffers: list) -> None:
+    """
+    write a batch of frames with gather writes (sendmsg), the frames are handed
+    to the kernel as they are instead of being copied into one big buffer first
+    :param sock: socket to write to
+    :param buffers: list of bytes-like objects
+    :return: None
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+
+    while buffers:
+        sent = sock.sendmsg(buffers[:IOV_MAX])
+
+        done = 0
+        while done < len(buffers) and sent >= len(buffers[done]):
+            sent -= len(buffers[done])
+            done += 1
+
+        del buffers[:done]
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+
+class OutboundQueue:
+    """
+    Bounded queue of encoded frames waiting to be written to one client
+    """
+
+    def __init__(self, maxsize: int, policy: str) -> None:
+        """
+
+        :param maxsize: number of frames the queue holds before overflowing
+        :param policy: one of OVERFLOW_POLICIES
+        """
+        self.items = deque()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        # bytes queued
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def full(self) -> bool:
+        return len(self.items) >= self.maxsize
+
+    def push(self, data: bytes) -> bool:
+        """
+        add a frame, applying the overflow policy if the queue is full
+        :param data: encoded frame
+        :return: False if the client has to be disconnected
+        """
+        if len(self.items) >= self.maxsize:
+            if self.policy == DISCONNECT:
+                return False
+            if self.policy == DROP_OLDEST:
+                self.size -= len(self.items.popleft())
+                self.dropped += 1
+
+        self.items.append(data)
+        self.size += len(data)
+        return True
+
+    def ready(self) -> bool:
+        """
+        :return: whether the queue should be written without waiting any longer
+                 for more frames
+        """
+        return (
+            not COALESCE_DELAY
+            or self.size >= COALESCE_BYTES
+            or len(self.items) >= self.maxsize
+        )
+
+    def drain(self) -> list:
+        """
+        take everything that is queued
+        :return: list of encoded frames
+        """
+        batch = list(self.items)
+        self.items.clear()
+        self.size = 0
+        return batch
+
+
+class Connection:
+    """
+    A framed client socket used by the threaded server, writes go through a
+    bounded queue drained by a writer thread so senders never wait on the network
+    """
+
+    def __init__(self, sock: socket.socket) -> None:
+        """
+
+        :param sock: the accepted client socket
+        """
+        self.sock = sock
+        set_nodelay(sock)
+        self.decoder = FrameDecoder(inflate=True)
+        self.frames = deque()
+        # extensions the client asked for, see negotiate
+        self.events = False
+        self.compress = False
+        self.resume = False
+        self.files = False
+
+        self.queue = OutboundQueue(QUEUE_SIZE, OVERFLOW)
+        self.cond = Condition()
+        self.closing = False
+        self.closed = False
+        self.queued_at = 0.0
+        # when the client was last heard from, see heartbeat
+        self.last_seen = monotonic()
+        self.heartbeat = None
+
+        self.writer = Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.queue)
+
+    def send(self, data: bytes) -> None:
+        """
+        queue one or more already encoded frames for the writer thread
+        :param data: encoded frame(s)
+        :return: None
+        """
+        if not self.events:
+            data = events.to_text(data)
+        if self.compress:
+            data = compression.pack(data)
+
+        with self.cond:
+            if self.closed or self.closing:
+                return
+
+            first = not self.queue
+            if first:
+                self.queued_at = monotonic()
+
+            if not self.queue.push(data):
+                self._abort()
+                return
+
+            if self.queue.policy == BLOCK and self.queue.full():
+                # the block policy lets the queue grow past its limit while
+                # the readers stop taking in more, see wait_congested
+                CONGESTED.add(self)
+
+            # while coalescing the writer only needs waking for the first frame
+            # and once the batch is big enough
+            if first or self.queue.ready():
+                self.cond.notify_all()
+
+    sendall = send
+
+    def writable(self) -> None:
+        """
+        wait for the queue to get back under its limit, a client that stays
+        stalled for longer than BLOCK_TIMEOUT is disconnected
+        :return: None
+        """
+        with self.cond:
+            deadline = monotonic() + BLOCK_TIMEOUT
+            while self.queue.full() and not self.closed:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self._abort()
+                    break
+                self.cond.wait(remaining)
+        CONGESTED.discard(self)
+
+    def _abort(self) -> None:
+        """
+        drop a client that can't keep up, its listen thread sees the connection
+        end and cleans up like for any other disconnect, call with cond held
+        :return: None
+        """
+        self.closed = True
+        self.queue.drain()
+        CONGESTED.discard(self)
+        self.cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_loop(self) -> None:
+        """
+        writer thread, sends whatever piled up in the queue in one go
+        :return: None
+        """
+        try:
+            while True:
+                with self.cond:
+                    while not self.queue and not self.closing and not self.closed:
+                        self.cond.wait()
+
+                    # give the frames following this one a chance to join it
+                    deadline = self.queued_at + COALESCE_DELAY
+                    while not (self.queue.ready() or self.closing or self.closed):
+                        remaining = deadline - monotonic()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+
+                    if self.closed or not self.queue:
+                        return
+
+                    batch = self.queue.drain()
+                    queued_at = self.queued_at
+                    CONGESTED.discard(self)
+                    self.cond.notify_all()
+
+                metrics.WRITE_DELAY_SECONDS.observe(monotonic() - queued_at)
+                metrics.BYTES_SENT.inc(sum(map(len, batch)))
+                metrics.WRITES.inc()
+                send_buffers(self.sock, batch)
+
+        except OSError:
+            with self.cond:
+                self._abort()
+
+        finally:
+            with self.cond:
+                if self.closing:
+                    self.sock.close()
+
+    def recv_frame(self):
+        """
+        block until a whole frame is available
+        :return: the next Frame, or None once the peer has closed the connection
+        """
+        while True:
+            while not self.frames:
+                data = self.sock.recv(READ_SIZE)
+                if not data:
+                    return None
+                self.last_seen = monotonic()
+                self.frames.extend(self.decoder.feed(data))
+
+            frame = self.frames.popleft()
+            if frame.type == HELLO:
+                negotiate(self, frame.payload)
+            elif frame.type != PONG:
+                return frame
+
+    def recv_line(self) -> str:
+        """
+        read the next frame as the text the user typed, used during the handshake
+        :return: the text of the frame
+        """
+        frame = self.recv_frame()
+        if frame is None:
+            raise ConnectionError("connection closed by peer")
+        return frame.line
+
+    def expire(self) -> None:
+        """
+        stop reading from a client that timed out, its listen thread sees the
+        connection end while what is queued still gets written
+        :return: None
+        """
+        try:
+            self.sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        """
+        stop accepting frames, the writer flushes what is queued and closes the socket
+        :return: None
+        """
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+            if self.closed:
+                self.sock.close()
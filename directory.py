@@ -0,0 +1,146 @@
+"""
+Server wide directory of users and groups.
+
+Every connected user holds their username here from the moment they pick it
+until they disconnect, so names are unique across the server, and the entry
+points at the group they are in. Groups are registered when created and
+drop out when destroyed. Lookups by name are a single dict access whatever
+the number of groups.
+"""
+
+from colors import color
+from events import DIRECT
+from protocol import Template
+
+fg = color.fg
+reset = color.style.reset
+
+NAME_TAKEN = Template(f'{fg.red}"{{}}" is already taken, pick another username: {reset}')
+NO_SUCH_USER = Template(f"{fg.lightred} There is no user named {{}} {reset}")
+WHERE = Template(f"{fg.yellow} {{}} is in the group {{}} {reset}")
+WHERE_HIDDEN = Template(f"{fg.yellow} {{}} is in a {{}} group {reset}")
+NOWHERE = Template(f"{fg.yellow} {{}} is online but not in a group {reset}")
+
+
+class Entry:
+    """
+    A connected user
+    """
+
+    __slots__ = ("name", "conn", "group")
+
+    def __init__(self, name: str, conn) -> None:
+        """
+
+        :param name: username
+        :param conn: connection of the user
+        """
+        self.name = name
+        self.conn = conn
+        # Group the user is a member of, if any
+        self.group = None
+
+
+# username -> Entry
+users = dict()
+# group name -> Group
+groups = dict()
+
+
+def claim(name: str, conn) -> bool:
+    """
+    reserve a username for a connection
+    :param name: the username
+    :param conn: connection of the user
+    :return: False if someone else has it
+    """
+    entry = Entry(name, conn)
+    # setdefault is atomic, two connections can't both get the name
+    return users.setdefault(name, entry) is entry
+
+
+def release(name: str, conn) -> None:
+    """
+    free a username once its connection is gone
+    :param name: the username
+    :param conn: connection that claimed it
+    :return: None
+    """
+    entry = users.get(name)
+    if entry is not None and entry.conn is conn:
+        del users[name]
+
+
+def joined(name: str, group) -> None:
+    """
+    record that a user became a member of a group
+    :param name: username
+    :param group: the Group
+    :return: None
+    """
+    entry = users.get(name)
+    if entry is not None:
+        entry.group = group
+
+
+def left(name: str, group) -> None:
+    """
+    record that a user is no longer a member of a group
+    :param name: username
+    :param group: the Group they left
+    :return: None
+    """
+    entry = users.get(name)
+    if entry is not None and entry.group is group:
+        entry.group = None
+
+
+def add_group(group) -> None:
+    groups[group.name] = group
+
+
+def remove_group(group) -> None:
+    """
+    forget a destroyed group, unless its name was already taken by a new one
+    :param group: the Group
+    :return: None
+    """
+    if groups.get(group.name) is group:
+        del groups[group.name]
+
+
+def whereis(name: str) -> bytes:
+    """
+    :param name: username
+    :return: encoded answer to !whereis, secret and private groups stay unnamed
+    """
+    entry = users.get(name)
+    if entry is None:
+        return NO_SUCH_USER(name)
+
+    group = entry.group
+    if group is None:
+        return NOWHERE(name)
+    if group.type == "open":
+        return WHERE(name, group.name)
+    return WHERE_HIDDEN(name, group.type)
+
+
+def direct(sender: str, group: str, names, message: str) -> list:
+    """
+    send a private message to users wherever they are
+    :param sender: username of the sender
+    :param group: name of the sender's group
+    :param names: usernames of the recipients
+    :param message: the message
+    :return: names that are not connected, or not in a group yet
+    """
+    frame = DIRECT(sender, group, message)
+    unknown = []
+    for name in names:
+        entry = users.get(name)
+        if entry is None or entry.group is None:
+            unknown.append(name)
+        else:
+            entry.conn.send(frame)
+    return unknown
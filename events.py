@@ -0,0 +1,142 @@
+"""
+Typed events, the compact alternative to rendered text.
+
+Group happenings (joins, kicks, chat...) are built as EVENT frames: a one byte
+event code followed by its fields, every field but the last prefixed with its
+length. Clients that offered protocol.EVENTS_OFFER get them as they are and
+style them locally with render(). For everyone else the connection turns them
+back into the exact text frames older clients expect, rendering each payload
+once however many members it goes to.
+"""
+
+import struct
+from threading import Lock
+
+from colors import color
+from protocol import EVENT, HEADER, HEADER_SIZE, Template
+
+fg = color.fg
+style = color.style
+
+FIELD = struct.Struct("!H")
+
+
+class Event:
+    """
+    A kind of event, builds its EVENT frames and renders them as text
+    """
+
+    __slots__ = ("code", "prefix", "fmt", "template", "fields")
+
+    def __init__(self, code: int, fmt: str) -> None:
+        """
+
+        :param code: the event code, one byte
+        :param fmt: how the event reads as text, with "{}" where each field goes
+        """
+        self.code = code
+        self.prefix = bytes((code,))
+        self.fmt = fmt
+        self.template = Template(fmt)
+        self.fields = fmt.count("{}")
+        EVENTS[code] = self
+
+    def __call__(self, *fields: str) -> bytes:
+        """
+        build the frame, no styling or fixed text goes in it
+        :param fields: one string per "{}" in the text
+        :return: the encoded EVENT frame
+        """
+        body = self.prefix
+        for field in fields[:-1]:
+            field = field.encode()
+            body += FIELD.pack(len(field)) + field
+        body += fields[-1].encode()
+        return HEADER.pack(len(body), EVENT) + body
+
+
+# event code -> Event
+EVENTS = dict()
+
+# the text matches what the server always sent, broadcast ones carry the
+# leading space that an unnamed sender gets in broadcast
+JOINED = Event(1, f" {fg.green} {{}} has just landed! {style.reset}")
+LEFT = Event(2, f" {fg.red} {{}} left the group {style.reset}")
+KICKED = Event(
+    3, f" {fg.red} user {{}} was kicked from the group by admin {{}} {style.reset}"
+)
+MUTED = Event(4, f" {fg.cyan}{{}} was muted by {{}}{style.reset}")
+UNMUTED = Event(5, f" {fg.lightblue}{{}} was umuted by {{}}{style.reset}")
+ADMIN_CHANGED = Event(
+    6,
+    f" {fg.lightcyan}Ownership of the group was transferred from {{}} to {{}} {style.reset}",
+)
+CHAT = Event(7, "{}: {}")
+PRIVATE = Event(8, "(private) {}: {}")
+DIRECT = Event(9, "(direct) {} from {}: {}")
+JOINED_MANY = Event(10, f" {fg.green} {{}} have just landed! {style.reset}")
+
+
+def decode(payload: bytes) -> tuple:
+    """
+    :param payload: payload of an EVENT frame
+    :return: the Event and the list of its fields
+    """
+    event = EVENTS[payload[0]]
+    fields = []
+    offset = 1
+    for _ in range(event.fields - 1):
+        (length,) = FIELD.unpack_from(payload, offset)
+        offset += FIELD.size
+        fields.append(payload[offset : offset + length].decode())
+        offset += length
+    fields.append(payload[offset:].decode())
+    return event, fields
+
+
+def render(payload: bytes) -> str:
+    """
+    :param payload: payload of an EVENT frame
+    :return: the event as styled text, as a client prints it
+    """
+    event, fields = decode(payload)
+    return event.fmt.format(*fields)
+
+
+CACHE_SIZE = 64
+_cache = dict()
+_lock = Lock()
+
+
+def to_text(data: bytes) -> bytes:
+    """
+    :param data: encoded frame(s) about to be sent to a client that did not ask
+                 for events
+    :return: the same frames with every EVENT frame rendered as a text frame
+    """
+    length, ftype = HEADER.unpack_from(data)
+    if ftype != EVENT and length + HEADER_SIZE == len(data):
+        return data
+
+    rendered = _cache.get(data)
+    if rendered is not None:
+        return rendered
+
+    chunks = []
+    offset = 0
+    while offset < len(data):
+        length, ftype = HEADER.unpack_from(data, offset)
+        end = offset + HEADER_SIZE + length
+        if ftype == EVENT:
+            event, fields = decode(data[offset + HEADER_SIZE : end])
+            chunks.append(event.template(*fields))
+        else:
+            chunks.append(data[offset:end])
+        offset = end
+
+    rendered = b"".join(chunks)
+    with _lock:
+        _cache[data] = rendered
+        while len(_cache) > CACHE_SIZE:
+            del _cache[next(iter(_cache))]
+    return rendered
@@ -1,28 +1,222 @@
-import socket
-from collections import defaultdict
-from time import sleep
-
+import hashlib
+import secrets
+from fnmatch import fnmatchcase
+
+import directory
+import heartbeat
+import history
+import metrics
+import msglog
+import ratelimit
+import scheduler
+import transfer
+from actor import Actor
 from colors import color
+from events import (
+    ADMIN_CHANGED,
+    CHAT,
+    JOINED,
+    JOINED_MANY,
+    KICKED,
+    LEFT,
+    MUTED,
+    PRIVATE,
+    UNMUTED,
+)
+from history import History
+from protocol import KILL_FRAME, SESSION, Template, encode, text
 
 fg = color.fg
 style = color.style
 
+# system messages are encoded once at import, the ones with fields only
+# encode the fields on each use, what the whole group sees is in events
+YOU_LEFT = text(f"{fg.red} You left the group {style.reset}")
+STRENGTH = Template(
+    f"{fg.yellow} Currently {{}} members are online in the group {style.reset}"
+)
+ONLINE = f"SERVER: {fg.yellow} Currently online are: {style.reset}"
+ADMIN_IS = Template(
+    f"SERVER: {fg.red} {{}} {style.reset} {fg.yellow} is currently the admin of group {{}} {style.reset}"
+)
+NOBODY_LAGGING = text(f"{fg.green} Nobody is lagging {style.reset}")
+LAGGING = f"SERVER: {fg.yellow} Queued frames per member: {style.reset}"
+YOU_WERE_MUTED = Template(f"{fg.yellow} You were muted by {{}} {style.reset}")
+YOU_WERE_MUTED_FOR = Template(
+    f"{fg.yellow} You were muted by {{}} for {{}} {style.reset}"
+)
+# who mutes a member flooding the group
+FLOODING = "the server for flooding"
+YOU_WERE_UNMUTED = Template(f"{fg.green} You were unmuted by {{}}")
+CANT_KICK_SELF = text(
+    f"{fg.lightred} You cannot kick yourself from the group {style.reset} "
+)
+YOU_WERE_KICKED = text(f"{fg.red}You were kicked out from the group {style.reset}")
+DESTROYED = text(f" {fg.red} Admin destroyed the group {style.reset}")
+WAITING = f"SERVER: {fg.yellow} Currently waitng users are: {style.reset}"
+ACCEPTED = text(
+    f"{fg.green}Your request to join the group has been accepted.{style.reset}"
+)
+REJECTED = text(
+    f"{fg.red}Your request to join the group has been rejected.{style.reset}"
+)
+TIRED_OF_WAITING = text(
+    f"{fg.lightcyan} Looks like the user was tired of waiting and left {style.reset}"
+)
+NOT_WAITING = text("No such user in the waiting list")
+NOT_WAITING_NAMED = Template("No such user in the waiting list: {}")
+WAITING_FULL = text(
+    f"{fg.red}Too many requests to join this group, try again later{style.reset}"
+)
+NOT_A_MEMBER = Template(f"{fg.lightred} {{}} is not in the group {style.reset}")
+REQUEST_SENT = text(
+    f"{fg.lightblue} Your request has been sent successfully to the admin of the group {style.reset}"
+)
+REQUESTED = Template(
+    f"{fg.lightcyan} user {{}} has requested to join the group.{style.reset}"
+)
+ASK_PASSWORD = text("Enter password to prove you are worthy: ")
+SECRET_WELCOME = text("Welcome to the secret chat")
+WRONG_PASSWORD = text("Wrong password")
+OPEN_WELCOME = text("Welcome to the chatroom")
+# seconds a rejected user gets to read the answer before being disconnected
+KILL_DELAY = 2
+# most users waiting to join a private group, overridden from the server
+# command line
+MAX_WAITING = 100
+RESUMED = Template(f"{fg.green} Welcome back to the group {{}} {style.reset}")
+STILL_WAITING = text(
+    f"{fg.lightblue} Your request to join the group is still waiting for the admin {style.reset}"
+)
+HISTORY = Template(f"{fg.darkgrey}--- last {{}} messages ---{style.reset}")
+NO_HISTORY = text(f"{fg.darkgrey}--- no messages yet ---{style.reset}")
+SUBSCRIBED = Template(f"{fg.green} Following {{}} {style.reset}")
+UNSUBSCRIBED = Template(f"{fg.yellow} No longer following {{}} {style.reset}")
+YOUR_TOPICS = f"SERVER: {fg.yellow} You are following: {style.reset}"
+NO_TOPICS = text(
+    f"{fg.yellow} You follow no topics, !sub name to follow one {style.reset}"
+)
+TOO_MANY_TOPICS = Template(f"{fg.red} You can follow at most {{}} topics {style.reset}")
+NO_FOLLOWERS = Template(f"{fg.yellow} Nobody else follows #{{}} {style.reset}")
+# topics a member can follow, and the longest topic name
+MAX_TOPICS = 32
+TOPIC_LENGTH = 32
+
+
+def _kill(conn) -> None:
+    """
+    tell a client to go and end its session
+    :param conn: the connection
+    :return: None
+    """
+    conn.send(KILL_FRAME)
+    conn.expire()
+
+
+def topic_of(message: str):
+    """
+    :param message: a chat message
+    :return: the topic of a "#topic message", None if it is for the whole group
+    """
+    if len(message) < 2 or message[0] != "#" or message[1].isspace():
+        return None
+    return message[1:].split(None, 1)[0].lower()[:TOPIC_LENGTH]
+
+
+def _topic_names(topics: str) -> list:
+    """
+    :param topics: comma separated topic names, with or without their #
+    :return: the names as topic_of gives them
+    """
+    names = [i.strip().lstrip("#").lower()[:TOPIC_LENGTH] for i in topics.split(",")]
+    return [i for i in dict.fromkeys(names) if i]
+
+
+def token_digest(token: bytes) -> str:
+    """
+    :param token: a session token as the client holds it
+    :return: what the server keeps of it
+    """
+    return hashlib.sha256(token).hexdigest()
+
+
+class Detached:
+    """
+    Stands in for the connection of a member restored from a snapshot until
+    they come back (see snapshot), whatever is sent to them is dropped
+    """
+
+    events = compress = resume = files = False
+    queue_depth = 0
+    heartbeat = None
+
+    def send(self, data: bytes) -> None:
+        pass
+
+    sendall = send
+
+    def expire(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+DETACHED = Detached()
+
+
+class Member:
+    """
+    Everything a group knows about one of its users, waiting or joined
+    """
+
+    __slots__ = (
+        "name",
+        "conn",
+        "waiting",
+        "muted",
+        "unmute",
+        "sent",
+        "token",
+        "topics",
+    )
+
+    def __init__(self, name: str, conn, waiting: bool = False) -> None:
+        """
+
+        :param name: username
+        :param conn: connection of the user
+        :param waiting: whether the user is still waiting to be accepted
+        """
+        self.name = name
+        self.conn = conn
+        self.waiting = waiting
+        self.muted = False
+        # scheduler Timer lifting a timed mute
+        self.unmute = None
+        # messages the member sent to the group
+        self.sent = 0
+        # digest of the session token, if the client can resume
+        self.token = None
+        # names of the topics the member follows
+        self.topics = set()
+
 
 class Group:
     """
-    Group class to manage group functions
+    Group class to manage group functions, its state is only changed from its
+    actor (see actor), so none of it is locked
     """
 
-    def __init__(
-        self, name: str, admin: str, conn: socket.socket, type: str, secret_key=None
-    ) -> None:
+    def __init__(self, name: str, admin: str, conn, type: str, secret_key=None) -> None:
         """
 
         :param name:  name of the group
         :param admin: name of admin of the group
-        :param conn: client socket
+        :param conn: client connection
         :param type: type of group (open/secret/private)
-        :param secret_key: secret key if the group is of type "secret"
+        :param secret_key: salted hash of the secret key if the group is of
+                           type "secret", see auth.hash_secret
         """
 
         self.name = name
@@ -31,16 +225,34 @@ class Group:
         self.secret_key = secret_key
         self.is_alive = True
 
-        self.members = set()
-        self.members.add(admin)
-
-        self.muted_users = defaultdict(bool)
-
-        self.waiting_users = set()
-        self.waiting_clients = dict()
-
-        self.clients = defaultdict(socket.socket)
-        self.clients[admin] = conn
+        # username -> Member, for members and users waiting to be accepted
+        self.sessions = {admin: Member(admin, conn)}
+        # joined members, replaced (never mutated) when the membership changes
+        # so other threads (metrics, snapshots) can read it at any time
+        self._roster = (self.sessions[admin],)
+        # username -> Member, the users waiting to be accepted (also in
+        # sessions), oldest first
+        self.waiting = dict()
+        # topic -> {username: Member} of its followers, so a topic message
+        # only costs as much as it has followers
+        self.topics = dict()
+        self.actor = Actor()
+        # id -> Transfer, files on their way, see transfer
+        self.transfers = dict()
+        # (sender, their id) -> the same Transfer
+        self.uploads = dict()
+        directory.joined(admin, self)
+        self._issue(self.sessions[admin])
+
+        # shared by every member, see ratelimit
+        self.limit = ratelimit.group_bucket()
+        self.history = History()
+        # the log outlives the group, a group created again with the same name
+        # picks up where it stopped
+        self.log = msglog.open_log(name)
+        if self.log is not None:
+            for frame in self.log.tail(history.MAX_MESSAGES):
+                self.history.append(frame)
 
     # ---------------------------------------
     # | COMMON BASE FUNCTIONS               |
@@ -48,22 +260,100 @@ class Group:
 
     # !! PRIVATE FUNCTIONS !!
 
-    def valid_user(self, user: str) -> bool:
-        try:
-            _ = self.clients[user]
-            return True
-        except KeyError:
+    def member(self, user: str):
+        """
+        :param user: username
+        :return: the Member if the user has joined the group, None otherwise
+        """
+        member = self.sessions.get(user)
+        if member is None or member.waiting:
+            return None
+        return member
+
+    def is_member(self, user: str) -> bool:
+        return self.member(user) is not None
+
+    def is_waiting(self, user: str) -> bool:
+        member = self.sessions.get(user)
+        return member is not None and member.waiting
+
+    def is_muted(self, user: str) -> bool:
+        member = self.sessions.get(user)
+        return member is not None and member.muted
+
+    def roster(self) -> tuple:
+        """
+        :return: every joined Member
+        """
+        return self._roster
+
+    def _join(self, member: Member) -> None:
+        """
+        make a user a member, replacing any previous session of the same name
+        :param member: the new member
+        :return: None
+        """
+        old = self.sessions.get(member.name)
+        self.sessions[member.name] = member
+        roster = self._roster
+        if old is not None and not old.waiting:
+            roster = tuple(i for i in roster if i is not old)
+            self._unfollow_all(old)
+        self._roster = roster + (member,)
+        directory.joined(member.name, self)
+        self._issue(member)
+
+    def _issue(self, member: Member) -> None:
+        """
+        give a member a session token, if their client can resume sessions
+        and they don't have one yet
+        :param member: the member
+        :return: None
+        """
+        if member.token is None and member.conn.resume:
+            token = secrets.token_urlsafe(24).encode()
+            member.token = token_digest(token)
+            member.conn.send(encode(SESSION, token))
+
+    def reattach(self, user: str, conn) -> bool:
+        """
+        hand a member restored from a snapshot their new connection
+        :param user: username
+        :param conn: connection of the user
+        :return: False if they are no longer in the group, or already back
+        """
+        member = self.sessions.get(user)
+        if member is None or member.conn is not DETACHED:
             return False
+        member.conn = conn
 
-    def _add_user(self, user: str, conn: socket.socket) -> None:
+        if member.waiting:
+            conn.send(STILL_WAITING)
+        else:
+            directory.joined(user, self)
+            conn.send(RESUMED(self.name))
+            self.catch_up(user)
+        return True
+
+    def _send(self, user: str, frame: bytes) -> None:
+        """
+        send to a user of the group, joined or waiting, if they are still there
+        :param user: username
+        :param frame: encoded frame(s)
+        :return: None
+        """
+        member = self.sessions.get(user)
+        if member is not None:
+            member.conn.send(frame)
+
+    def _add_user(self, user: str, conn) -> None:
         """
         function to add the desired user to the group
         :param user: name of the user to add
-        :param conn: socket object of the user
+        :param conn: connection of the user
         :return: None
         """
-        self.members.add(user)
-        self.clients[user] = conn
+        self._join(Member(user, conn))
 
     def _remove_user(self, user: str) -> None:
         """
@@ -71,8 +361,12 @@ class Group:
         :param user: name of the user to remove
         :return: None
         """
-        del self.clients[user]
-        self.members.remove(user)
+        member = self.sessions.pop(user)
+        self._roster = tuple(i for i in self._roster if i is not member)
+        self._unfollow_all(member)
+        directory.left(user, self)
+        if self.transfers:
+            transfer.left(self, user)
 
     # !! PUBLIC FUNCTIONS !!
     def welcome_user(self, user: str) -> None:
@@ -81,8 +375,7 @@ class Group:
         :param user: name to user to welcome
         :return:
         """
-        message = f"{fg.green} {user} has just landed! {style.reset}"
-        self.broadcast("", message)
+        self._fanout(JOINED(user))
 
     def broadcast(self, name: str, message: str) -> None:
         """
@@ -92,22 +385,201 @@ class Group:
         :return: None
         """
 
-        sender = name
         if name:
-            sender += ":"
-        for member in self.members:
-            if member != name:
-                self.clients[member].send(f"{sender} {message}".encode())
+            member = self.sessions.get(name)
+            if member is not None:
+                member.sent += 1
+            frame = CHAT(name, message)
+        else:
+            frame = text(f" {message}")
+        self.history.append(frame)
+        if self.log is not None:
+            self.log.append(frame)
+        self._fanout(frame, name)
+
+    def _fanout(self, frame: bytes, skip: str = "") -> None:
+        """
+        Function to hand the same encoded frame to every member
+        :param frame: the frame, built once and shared by every recipient
+        :param skip: member that should not get it (usually the sender)
+        :return: None
+        """
+        self._deliver(frame, self.roster(), skip)
+
+    def _deliver(self, frame: bytes, members, skip: str = "") -> None:
+        """
+        Function to hand the same encoded frame to some members
+        :param frame: the frame, built once and shared by every recipient
+        :param members: the Member records to send it to
+        :param skip: member that should not get it
+        :return: None
+        """
+        sent = 0
+        for member in members:
+            if member.name != skip:
+                member.conn.send(frame)
+                sent += 1
+
+        metrics.MESSAGES_OUT.inc(sent, self.name)
 
     def private_message(self, sender: str, receiver: str, message: str) -> None:
         """
-        Function for sending from a user to certain user(s)
+        Function for sending from a user to a certain user
+        :param sender: sender
+        :param receiver: receiver
+        :param message: message
+        :return: None
+        """
+        self.multicast(sender, message, include={receiver})
+
+    def multicast(
+        self, sender: str, message: str, include: set = None, exclude: set = None
+    ) -> set:
+        """
+        Function for sending a private message to some of the members, built
+        once whatever the number of recipients
         :param sender: sender
-        :param receiver: receiver(s)
         :param message: message
+        :param include: names of the recipients
+        :param exclude: or names of the members who should not get it
+        :return: names in include that are not members
+        """
+        missing = set()
+        if include is not None:
+            sessions = self.sessions
+            recipients = [
+                member
+                for member in map(sessions.get, include)
+                if member is not None and not member.waiting
+            ]
+            if len(recipients) < len(include):
+                missing = include.difference([m.name for m in recipients])
+        else:
+            exclude = exclude or set()
+            recipients = [m for m in self.roster() if m.name not in exclude]
+
+        if not recipients:
+            return missing
+
+        frame = PRIVATE(sender, message)
+        self._deliver(frame, recipients)
+        if self.log is not None:
+            # who it was meant for as the sender put it, the recipients of an
+            # exclusion are the whole group and would not fit
+            if include is not None:
+                self.log.append(frame, ",".join(sorted(include)))
+            else:
+                self.log.append(frame, "-" + ",".join(sorted(exclude)))
+        return missing
+
+    def _follow(self, member: Member, topic: str) -> None:
+        self.topics.setdefault(topic, {})[member.name] = member
+        member.topics.add(topic)
+
+    def _unfollow(self, member: Member, topic: str) -> None:
+        member.topics.discard(topic)
+        followers = self.topics.get(topic)
+        if followers is not None and followers.get(member.name) is member:
+            del followers[member.name]
+            if not followers:
+                del self.topics[topic]
+
+    def _unfollow_all(self, member: Member) -> None:
+        for topic in list(member.topics):
+            self._unfollow(member, topic)
+
+    def subscribe(self, user: str, topics: str) -> None:
+        """
+        Function to follow topics, with none given the member is told theirs
+        :param user: the member
+        :param topics: comma separated topic names
         :return: None
         """
-        self.clients[receiver].send(f"(private) {sender}: {message}".encode())
+        member = self.member(user)
+        if member is None:
+            return
+
+        names = _topic_names(topics)
+        if not names:
+            if member.topics:
+                following = ", ".join([f"#{i}" for i in sorted(member.topics)])
+                self._send(user, text(YOUR_TOPICS + following))
+            else:
+                self._send(user, NO_TOPICS)
+            return
+
+        if len(member.topics.union(names)) > MAX_TOPICS:
+            self._send(user, TOO_MANY_TOPICS(MAX_TOPICS))
+            return
+
+        for topic in names:
+            self._follow(member, topic)
+        self._send(user, SUBSCRIBED(", ".join([f"#{i}" for i in names])))
+
+    def unsubscribe(self, user: str, topics: str) -> None:
+        """
+        Function to stop following topics, all of them if none are given
+        :param user: the member
+        :param topics: comma separated topic names
+        :return: None
+        """
+        member = self.member(user)
+        if member is None:
+            return
+
+        names = _topic_names(topics) or sorted(member.topics)
+        if not names:
+            self._send(user, NO_TOPICS)
+            return
+
+        for topic in names:
+            self._unfollow(member, topic)
+        self._send(user, UNSUBSCRIBED(", ".join([f"#{i}" for i in names])))
+
+    def topic_message(self, name: str, topic: str, message: str) -> None:
+        """
+        Function to send a "#topic message" to the followers of the topic only,
+        the sender doesn't have to follow it
+        :param name: sender
+        :param topic: the topic, see topic_of
+        :param message: the message, with its #topic
+        :return: None
+        """
+        followers = self.topics.get(topic, {})
+        if len(followers) - (name in followers) == 0:
+            self._send(name, NO_FOLLOWERS(topic))
+            return
+
+        member = self.sessions.get(name)
+        if member is not None:
+            member.sent += 1
+        frame = CHAT(name, message)
+        self._deliver(frame, followers.values(), name)
+        if self.log is not None:
+            self.log.append(frame, f"#{topic}")
+
+    def replay(self, user: str, count: int) -> None:
+        """
+        Sends the last messages of the group to a member in a single write
+        :param user: the member
+        :param count: how many messages
+        :return: None
+        """
+        frames = self.history.last(count)
+        if not frames:
+            self._send(user, NO_HISTORY)
+            return
+
+        self._send(user, HISTORY(min(count, len(self.history))) + frames)
+
+    def catch_up(self, user: str) -> None:
+        """
+        replay the recent messages to a new member, if there are any
+        :param user: the new member
+        :return: None
+        """
+        if history.REPLAY and len(self.history):
+            self.replay(user, history.REPLAY)
 
     def quit(self, user: str) -> None:
         """
@@ -115,16 +587,15 @@ class Group:
         :param user: the user who wants to leave the group
         :return: None
         """
-        self.clients[user].send(f"{fg.red} You left the group {style.reset}".encode())
+        self._send(user, YOU_LEFT)
 
         self._remove_user(user)
-        quit_message = f"{fg.red} {user} left the group {style.reset}"
-        self.broadcast("", quit_message)
+        self._fanout(LEFT(user))
 
         if user == self.admin:
-            if len(self.members):
-                new_admin = next(iter(self.clients))
-                self.changeadmin(new_admin)
+            roster = self.roster()
+            if roster:
+                self.changeadmin(roster[0].name)
             else:
                 self.destruct()
 
@@ -134,9 +605,7 @@ class Group:
         :param user: the enquirer
         :return: None
         """
-        members = str(len(self.members))
-        message = f"{fg.yellow} Currently {members} members are online in the group {style.reset}".encode()
-        self.clients[user].sendall(message)
+        self._send(user, STRENGTH(len(self.roster())))
 
     def whosonline(self, user: str) -> None:
         """
@@ -145,11 +614,8 @@ class Group:
         :param user: the enquirer
         :return: None
         """
-        message = (
-            f"SERVER: {fg.yellow} Currently online are: {style.reset}".encode()
-            + b", ".join([i.encode() for i in self.members])
-        )
-        self.clients[user].sendall(message)
+        names = [member.name for member in self.roster()]
+        self._send(user, text(ONLINE + ", ".join(names)))
 
     def whosadmin(self, user: str) -> None:
         """
@@ -157,31 +623,96 @@ class Group:
         :param user: the enquirer
         :return: None
         """
-        self.clients[user].send(
-            f"SERVER: {fg.red} {self.admin} {style.reset} {fg.yellow} is currently the admin of group {self.name} {style.reset}".encode()
-        )
+        self._send(user, ADMIN_IS(self.admin, self.name))
 
     # !!!ADMIN FUNCTIONS!!!
 
+    def lagging(self, user: str) -> None:
+        """
+        [admin function] Sends the members whose outbound queue is not empty, longest first
+        :param user: the enquirer
+        :return: None
+        """
+        depths = sorted(
+            [(member.conn.queue_depth, member.name) for member in self.roster()],
+            reverse=True,
+        )
+        lagging = [f"{name} ({depth})" for depth, name in depths if depth]
+
+        if not lagging:
+            self._send(user, NOBODY_LAGGING)
+            return
+
+        self._send(user, text(LAGGING + ", ".join(lagging)))
+
     def mute(self, users: str) -> None:
         """
         [admin function] Function to mute (they can only see messages) users of the group
-        :param users: user(s) to mute
+        :param users: user(s) to mute, optionally followed by how long (10m, 2h...)
         :return: None
         """
-        users = users.strip()
-        user_list = users.split(",")
+        words = users.split()
+        delay = scheduler.parse_duration(words[-1]) if len(words) > 1 else None
+        if delay is not None:
+            duration = words.pop()
+        user_list = " ".join(words).split(",")
         user_list = [i.strip() for i in user_list]
-        print(users)
-        for user in users:
-            if not self.muted_users[user] and user in self.members:
-                self.clients[user].send(
-                    f"{fg.yellow} You were muted by {self.admin} {style.reset}".encode()
-                )
-                self.muted_users[user] = True
-                self.broadcast(
-                    "", f"{fg.cyan}{user} was muted by {self.admin}{style.reset}"
+        for user in user_list:
+            member = self.member(user)
+            if member is None or (member.muted and delay is None):
+                continue
+
+            if member.unmute is not None:
+                scheduler.cancel(member.unmute)
+                member.unmute = None
+            if delay is not None:
+                member.unmute = scheduler.later(
+                    delay, self.actor.post, self._lift_mute, member, self.admin
                 )
+                member.conn.send(YOU_WERE_MUTED_FOR(self.admin, duration))
+            else:
+                member.conn.send(YOU_WERE_MUTED(self.admin))
+
+            if not member.muted:
+                member.muted = True
+                self._fanout(MUTED(user, self.admin))
+
+    def _lift_mute(self, member: Member, admin: str) -> None:
+        """
+        a timed mute is over
+        :param member: the muted member
+        :param admin: who muted them
+        :return: None
+        """
+        member.unmute = None
+        if member.muted and self.member(member.name) is member:
+            member.muted = False
+            self._fanout(UNMUTED(member.name, admin))
+            member.conn.send(YOU_WERE_UNMUTED(admin))
+
+    def flood_mute(self, user: str) -> None:
+        """
+        mute a member who kept going past the rate limits
+        :param user: the member
+        :return: None
+        """
+        member = self.member(user)
+        if member is None:
+            return
+
+        if member.unmute is not None:
+            scheduler.cancel(member.unmute)
+            member.unmute = None
+        delay = ratelimit.FLOOD_MUTE_SECONDS
+        if delay:
+            member.unmute = scheduler.later(
+                delay, self.actor.post, self._lift_mute, member, FLOODING
+            )
+            member.conn.send(YOU_WERE_MUTED_FOR(FLOODING, f"{delay:g}s"))
+        else:
+            member.conn.send(YOU_WERE_MUTED(FLOODING))
+        member.muted = True
+        self._fanout(MUTED(user, FLOODING))
 
     def unmute(self, users: str):
         """
@@ -194,14 +725,14 @@ class Group:
         userlist = [i.strip() for i in userlist]
 
         for user in userlist:
-            if self.muted_users[user]:
-                self.broadcast(
-                    "", f"{fg.lightblue}{user} was umuted by {self.admin}{style.reset}"
-                )
-                self.clients[user].send(
-                    f"{fg.green} You were unmuted by {self.admin}".encode()
-                )
-                self.muted_users[user] = False
+            member = self.member(user)
+            if member is not None and member.muted:
+                if member.unmute is not None:
+                    scheduler.cancel(member.unmute)
+                    member.unmute = None
+                self._fanout(UNMUTED(user, self.admin))
+                member.conn.send(YOU_WERE_UNMUTED(self.admin))
+                member.muted = False
 
     def kick(self, user: str) -> None:
         """
@@ -210,18 +741,18 @@ class Group:
         :return: None
         """
         if user == self.admin:
-            self.clients[self.admin].send(
-                f"{fg.lightred} You cannot kick yourself from the group {style.reset} ".encode()
-            )
+            self._send(self.admin, CANT_KICK_SELF)
             return
 
-        self.clients[user].send(
-            f"{fg.red}You were kicked out from the group {style.reset}".encode()
-        )
+        member = self.member(user)
+        if member is None:
+            self._send(self.admin, NOT_A_MEMBER(user))
+            return
+
+        member.conn.send(YOU_WERE_KICKED)
         self._remove_user(user)
 
-        kick_message = f"{fg.red} user {user} was kicked from the group by admin {self.admin} {style.reset}"
-        self.broadcast("", kick_message)
+        self._fanout(KICKED(user, self.admin))
 
     def changeadmin(self, user: str) -> None:
         """
@@ -229,8 +760,11 @@ class Group:
         :param user: the new owner/admin of the group
         :return: None
         """
-        change_message = f"{fg.lightcyan}Ownership of the group was transferred from {self.admin} to {user} {style.reset}"
-        self.broadcast("", change_message)
+        if not self.is_member(user):
+            self._send(self.admin, NOT_A_MEMBER(user))
+            return
+
+        self._fanout(ADMIN_CHANGED(self.admin, user))
         self.admin = user
 
     def destruct(self) -> None:
@@ -238,10 +772,19 @@ class Group:
         [admin function] To destroy the group completely kicking out every member including the admin
         :return: None
         """
-        destruct_message = f"{fg.red} Admin destroyed the group {style.reset}"
-        self.broadcast("", destruct_message)
-        self.members = set()
+        self._fanout(DESTROYED)
+        transfer.close(self)
+        roster = self._roster
+        self.sessions = {}
+        self.waiting = {}
+        self.topics = {}
+        self._roster = ()
         self.is_alive = False
+        for member in roster:
+            directory.left(member.name, self)
+        directory.remove_group(self)
+        if self.log is not None:
+            self.log.close()
 
     # ---------------------------------------
     # | FUNCTIONS FOR PRIVATE ROOM           |
@@ -252,134 +795,150 @@ class Group:
         method to remove a user from waiting list
         :param name: name of the user to be removed
         """
-        del self.waiting_clients[name]
-        self.waiting_users.remove(name)
+        if self.waiting.pop(name, None) is not None:
+            del self.sessions[name]
+
+    def _take_waiting(self, names: str, accept: bool) -> list:
+        """
+        take users out of the waiting list, to accept or reject them
+        :param names: comma separated usernames or glob patterns, * for everyone
+        :param accept: whether they become members, or leave the group
+        :return: the Member of each user taken, oldest request first
+        """
+        patterns = [i.strip() for i in names.split(",") if i.strip()]
+        missing = []
+        taken = dict()
+        for pattern in patterns:
+            if "*" in pattern or "?" in pattern or "[" in pattern:
+                for name in self.waiting:
+                    if fnmatchcase(name, pattern):
+                        taken[name] = None
+            elif pattern in self.waiting:
+                taken[pattern] = None
+            else:
+                missing.append(pattern)
+
+        members = [m for name, m in self.waiting.items() if name in taken]
+        for member in members:
+            del self.waiting[member.name]
+            if accept:
+                member.waiting = False
+            else:
+                del self.sessions[member.name]
+
+        if not members:
+            self._send(self.admin, NOT_WAITING)
+        elif missing:
+            self._send(self.admin, NOT_WAITING_NAMED(", ".join(missing)))
+        return members
+
+    def withdraw(self, name: str) -> None:
+        """
+        method to forget a user who left the waiting list before being answered
+        :param name: username of the user
+        :return: None
+        """
+        if name not in self.waiting:
+            # answered in the meantime
+            return
+        self._remove_from_waiting_list(name)
+        self._send(self.admin, TIRED_OF_WAITING)
 
     def whoswaiting(self) -> None:
         """
         method to send a string containing names name of current waiting members of the group
         :return: None
         """
-        message = (
-            f"SERVER: {fg.yellow} Currently waitng users are: {style.reset}".encode()
-            + b", ".join(
-                [f"{fg.orange} i {style.reset}".encode() for i in self.waiting_users]
-            )
+        waiting = list(self.waiting)
+        message = text(
+            WAITING + ", ".join([f"{fg.orange} {i} {style.reset}" for i in waiting])
         )
-        self.clients[self.admin].sendall(message)
+        self._send(self.admin, message)
 
-    def accept(self, name: str) -> None:
+    def accept(self, names: str) -> None:
         """
-        method to accept a user in waitng list
-        :param name: username of the user wanting to enter the group
+        method to accept users in waitng list, the group hears about them all at once
+        :param names: comma separated usernames or glob patterns, * for everyone
         :return: None
         """
+        members = self._take_waiting(names, accept=True)
+        if not members:
+            return
 
-        try:
-
-            _ = self.waiting_clients[name]
-
-            try:
-                self.waiting_clients[name].send(
-                    f"{fg.green}Your request to join the group has been accepted.{style.reset}".encode()
-                )
-            except:
-                self.clients[self.admin].send(
-                    f"{fg.lightcyan} Looks like the user was tired of waiting and left {style.reset}".encode()
-                )
-                self._remove_from_waiting_list(name)
-                return
-
-            self.welcome_user(name)
-            self.members.add(name)
-            self.clients[name] = self.waiting_clients[name]
-            self._remove_from_waiting_list(name)
+        if len(members) == 1:
+            self.welcome_user(members[0].name)
+        else:
+            self._fanout(JOINED_MANY(", ".join([m.name for m in members])))
 
-        except:
-            self.clients[self.admin].send("No such user in the waiting list".encode())
+        for member in members:
+            member.conn.send(ACCEPTED)
+            heartbeat.enter(member.conn, heartbeat.CHATTING)
+            self._join(member)
+            self.catch_up(member.name)
 
-    def reject(self, name: str) -> None:
+    def reject(self, names: str) -> None:
         """
-        method to reject a user in waitng list
-        :param name: username of the user wanting to enter the group
+        method to reject users in waitng list
+        :param names: comma separated usernames or glob patterns, * for everyone
         :return: None
         """
+        for member in self._take_waiting(names, accept=False):
+            member.conn.send(REJECTED)
+            # let them read the answer, then end their session
+            scheduler.later(KILL_DELAY, _kill, member.conn)
 
-        try:
-
-            _ = self.waiting_clients[name]
-
-            try:
-                self.waiting_clients[name].send(
-                    f"{fg.red}Your request to join the group has been rejected.{style.reset}".encode()
-                )
-                sleep(2)
-                # self.waiting_clients[name].send("!!!KILL!!!".encode())
-
-            except:
-                self.clients[self.admin].send(
-                    f"{fg.lightcyan} Looks like the user was tired of waiting and left {style.reset}".encode()
-                )
-
-            self._remove_from_waiting_list(name)
-
-        except:
-            self.clients[self.admin].send("No such user in the waiting list".encode())
-
-    def private_accept(self, conn: socket.socket, name: str) -> None:
+    def private_accept(self, conn, name: str) -> bool:
         """
-        Function to accept or reject a user trying to enter in a private group
-        :param conn: socket
+        Function to put a user trying to enter in a private group on the waiting list
+        :param conn: connection of the user
         :param name: username of the user trying to connect
-        :return: bool
+        :return: False if the waiting list is full
         """
+        if MAX_WAITING and len(self.waiting) >= MAX_WAITING:
+            conn.send(WAITING_FULL)
+            return False
 
-        conn.send(
-            f"{fg.lightblue} Your request has been sent successfully to the admin of the group {style.reset}".encode()
-        )
-
-        self.clients[self.admin].send(
-            f"{fg.lightcyan} user {name} has requested to join the group.{style.reset}".encode()
-        )
-
-        self.waiting_users.add(name)
-        self.waiting_clients[name] = conn
+        member = Member(name, conn, waiting=True)
+        self.sessions[name] = member
+        self.waiting[name] = member
+        conn.send(REQUEST_SENT)
+        self._issue(member)
+        self._send(self.admin, REQUESTED(name))
+        return True
 
     # ---------------------------------------
     # | FUNCTIONS FOR SECRET ROOM           |
     # ---------------------------------------
 
-    def secret_accept(self, conn: socket.socket, name: str) -> bool:
+    def secret_verify(self, conn, name: str, valid: bool) -> bool:
         """
-        Function to accept or reject a user trying to enter in a secret group
-        :param conn: socket
+        Function to let a user in a secret group once the password has been checked
+        :param conn: connection of the user
         :param name: username of the user trying to connect
+        :param valid: whether the password the user entered is right
         :return: bool
         """
-        conn.send("Enter password to prove you are worthy: ".encode())
-        passwd = conn.recv(1024).decode()
-        if self.valid(passwd):
+        if valid:
             self._add_user(name, conn)
-            conn.send("Welcome to the secret chat".encode())
+            conn.send(SECRET_WELCOME)
+            self.catch_up(name)
             return True
         else:
-            conn.send("Wrong password".encode())
+            conn.send(WRONG_PASSWORD)
             return False
 
-    def valid(self, secret_key):
-        return secret_key == self.secret_key
-
     # ---------------------------------------
     # | FUNCTIONS FOR OPEN ROOM             |
     # ---------------------------------------
 
-    def open_accept(self, conn: socket.socket, name: str) -> None:
+    def open_accept(self, conn, name: str) -> None:
         """
         Function to accept a user trying to enter in a open group
-        :param conn: socket
+        :param conn: connection of the user
         :param name: username of the user trying to connect
         :return: bool
         """
         self.welcome_user(name)
         self._add_user(name, conn)
-        self.clients[name].send("Welcome to the chatroom".encode())
+        conn.send(OPEN_WELCOME)
+        self.catch_up(name)
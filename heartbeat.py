@@ -0,0 +1,153 @@
+"""
+Liveness of client connections.
+
+Every connection is watched from the moment it is accepted. During the
+handshake and while waiting to be let into a private group it only has a fixed
+amount of time. Once chatting, a member that has been quiet for PING_INTERVAL is
+pinged (clients answer with a pong), and one silent for IDLE_TIMEOUT, pongs
+included, is dropped. Dropping a connection ends its read side, so its session
+cleans up exactly as if the client had gone. Deadlines are scheduler timers,
+so they cost nothing until they are due.
+"""
+
+from time import monotonic
+
+import scheduler
+from colors import color
+from protocol import PING_FRAME, text
+
+fg = color.fg
+reset = color.style.reset
+
+# seconds, overridden from the server command line, 0 turns a check off
+PING_INTERVAL = 30
+IDLE_TIMEOUT = 90
+HANDSHAKE_TIMEOUT = 60
+WAITING_TIMEOUT = 600
+
+HANDSHAKE = 0
+WAITING = 1
+CHATTING = 2
+
+TIMED_OUT = {
+    HANDSHAKE: text(f"{fg.red}Took too long to join, disconnected{reset}"),
+    WAITING: text(f"{fg.red}Nobody answered your request to join, disconnected{reset}"),
+    CHATTING: text(f"{fg.red}Connection timed out{reset}"),
+}
+
+
+def _next_check(idle: float) -> float:
+    """
+    :param idle: seconds a chatting connection has been silent
+    :return: seconds until it has to be pinged or dropped, 0 if never (pings
+             and the idle timeout are both off)
+    """
+    delays = []
+    if PING_INTERVAL:
+        # pinged again every interval while it stays silent
+        delays.append(PING_INTERVAL - idle % PING_INTERVAL)
+    if IDLE_TIMEOUT:
+        delays.append(IDLE_TIMEOUT - idle)
+    return min(delays, default=0)
+
+
+class Heartbeat:
+    """
+    The deadline of one connection
+    """
+
+    __slots__ = ("conn", "stage", "since", "timer", "stopped")
+
+    def __init__(self, conn) -> None:
+        """
+
+        :param conn: the connection, anything with send, expire and last_seen
+        """
+        self.conn = conn
+        self.stopped = False
+        self.timer = None
+        self.enter(HANDSHAKE)
+
+    def enter(self, stage: int) -> None:
+        """
+        start a new stage of the session, with its own deadline
+        :param stage: HANDSHAKE, WAITING or CHATTING
+        :return: None
+        """
+        self.stage = stage
+        self.since = monotonic()
+        if self.timer is not None:
+            scheduler.cancel(self.timer)
+
+        delay = {
+            HANDSHAKE: HANDSHAKE_TIMEOUT,
+            WAITING: WAITING_TIMEOUT,
+            CHATTING: _next_check(0),
+        }[stage]
+        self._schedule(delay)
+
+    def _schedule(self, delay: float) -> None:
+        if not self.stopped and delay:
+            self.timer = scheduler.later(delay, self._check)
+
+    def _check(self) -> None:
+        """
+        the deadline came, drop the connection, ping it or look again later
+        :return: None
+        """
+        if self.stopped:
+            return
+
+        now = monotonic()
+        conn = self.conn
+        if self.stage == CHATTING:
+            idle = now - conn.last_seen
+            if IDLE_TIMEOUT and idle >= IDLE_TIMEOUT:
+                self._expire()
+                return
+            if PING_INTERVAL and idle >= PING_INTERVAL:
+                conn.send(PING_FRAME)
+            self._schedule(_next_check(idle))
+            return
+
+        timeout = HANDSHAKE_TIMEOUT if self.stage == HANDSHAKE else WAITING_TIMEOUT
+        left = self.since + timeout - now
+        if left > 0:
+            self._schedule(left)
+        else:
+            self._expire()
+
+    def _expire(self) -> None:
+        self.stopped = True
+        self.conn.send(TIMED_OUT[self.stage])
+        self.conn.expire()
+
+    def stop(self) -> None:
+        """
+        the session is over, forget the connection
+        :return: None
+        """
+        self.stopped = True
+        if self.timer is not None:
+            scheduler.cancel(self.timer)
+
+
+def watch(conn) -> Heartbeat:
+    """
+    start watching a connection that was just accepted
+    :param conn: the connection
+    :return: its Heartbeat, also kept as conn.heartbeat
+    """
+    conn.heartbeat = Heartbeat(conn)
+    return conn.heartbeat
+
+
+def enter(conn, stage: int) -> None:
+    """
+    move a watched connection to another stage, unwatched ones are ignored
+    :param conn: the connection
+    :param stage: HANDSHAKE, WAITING or CHATTING
+    :return: None
+    """
+    if conn.heartbeat is not None:
+        conn.heartbeat.enter(stage)
@@ -0,0 +1,58 @@
+from collections import deque
+
+# defaults for every new group, overridden from the server command line
+MAX_MESSAGES = 200
+MAX_BYTES = 256 * 1024
+# how many messages a new member gets when joining
+REPLAY = 20
+
+
+class History:
+    """
+    Fixed capacity buffer of the most recent encoded broadcasts of a group,
+    bounded both by number of messages and by bytes, so its footprint stays
+    the same however much traffic goes through the group
+    """
+
+    def __init__(self, max_messages: int = 0, max_bytes: int = 0) -> None:
+        """
+
+        :param max_messages: most messages kept
+        :param max_bytes: most bytes kept, over all messages
+        """
+        self.frames = deque(maxlen=max_messages or MAX_MESSAGES)
+        self.max_bytes = max_bytes or MAX_BYTES
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def append(self, frame: bytes) -> None:
+        """
+        remember a broadcast, evicting the oldest ones past the limits
+        :param frame: the encoded frame, shared with the recipients
+        :return: None
+        """
+        frames = self.frames
+        if len(frame) > self.max_bytes:
+            return
+
+        if len(frames) == frames.maxlen:
+            self.size -= len(frames[0])
+        frames.append(frame)
+        self.size += len(frame)
+
+        while self.size > self.max_bytes:
+            self.size -= len(frames.popleft())
+
+    def last(self, count: int) -> bytes:
+        """
+        the most recent messages as one buffer, ready for a single write
+        :param count: how many messages
+        :return: the encoded frames, oldest first
+        """
+        frames = self.frames
+        count = min(count, len(frames))
+        if count <= 0:
+            return b""
+        return b"".join([frames[i] for i in range(len(frames) - count, len(frames))])
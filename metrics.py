@@ -0,0 +1,362 @@
+"""
+Server metrics.
+
+Counters and histograms are sharded per thread: the hot path only touches the
+calling thread's own shard (no lock, no contention) and shards are summed when
+the metrics are read. The registry is rendered in the Prometheus text format by
+an optional HTTP endpoint and summarised by the `!stats` admin command.
+"""
+
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds in seconds
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+
+class _Sharded:
+    """
+    base for metrics keeping one shard per thread
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, label: str = "") -> None:
+        """
+
+        :param name: metric name
+        :param help: one line description
+        :param label: name of the label the values are split by, if any
+        """
+        self.name = name
+        self.help = help
+        self.label = label
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (thread, shard) for every thread that touched the metric, shards of
+        # threads that are gone are folded into retired
+        self.shards = []
+        self.retired = self._new_shard()
+
+    def _new_shard(self):
+        raise NotImplementedError
+
+    def _merge(self, into, shard) -> None:
+        raise NotImplementedError
+
+    def _shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = self._new_shard()
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+                if len(self.shards) > 256:
+                    self._fold()
+            return shard
+
+    def _fold(self) -> None:
+        """
+        merge the shards of finished threads, call with lock held
+        :return: None
+        """
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self.retired, shard)
+        self.shards = alive
+
+    def _snapshots(self) -> list:
+        with self.lock:
+            self._fold()
+            shards = [self.retired] + [shard for _, shard in self.shards]
+        # copying a dict is atomic under the GIL, no need to stop the writers
+        return [dict(shard) for shard in shards]
+
+
+class Counter(_Sharded):
+    """
+    A value that only goes up (or, used as a gauge, up and down)
+    """
+
+    kind = "counter"
+
+    def _new_shard(self):
+        return defaultdict(int)
+
+    def _merge(self, into, shard) -> None:
+        for label, value in dict(shard).items():
+            into[label] += value
+
+    def inc(self, amount: int = 1, label: str = "") -> None:
+        self._shard()[label] += amount
+
+    def dec(self, amount: int = 1, label: str = "") -> None:
+        self._shard()[label] -= amount
+
+    def values(self) -> dict:
+        """
+        :return: label value -> total over every thread
+        """
+        totals = defaultdict(int)
+        for shard in self._snapshots():
+            for label, value in shard.items():
+                totals[label] += value
+        return dict(totals)
+
+    def value(self, label: str = "") -> int:
+        return self.values().get(label, 0)
+
+    def render(self) -> list:
+        lines = []
+        for label, value in sorted(self.values().items()):
+            selector = f'{{{self.label}="{label}"}}' if self.label else ""
+            lines.append(f"{self.name}{selector} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+
+class Histogram(_Sharded):
+    """
+    Distribution of durations over fixed buckets
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        """
+
+        :param name: metric name
+        :param help: one line description
+        :param buckets: upper bounds of the buckets, in seconds
+        """
+        self.buckets = buckets
+        super().__init__(name, help)
+
+    def _new_shard(self):
+        # one count per bucket, then +Inf, then the sum of every observation
+        return {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+
+    def _merge(self, into, shard) -> None:
+        for i, count in enumerate(shard["counts"]):
+            into["counts"][i] += count
+        into["sum"] += shard["sum"]
+
+    def observe(self, value: float) -> None:
+        shard = self._shard()
+        shard["counts"][bisect_left(self.buckets, value)] += 1
+        shard["sum"] += value
+
+    def totals(self) -> tuple:
+        """
+        :return: (per bucket counts, sum)
+        """
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for shard in self._snapshots():
+            for i, count in enumerate(list(shard["counts"])):
+                counts[i] += count
+            total += shard["sum"]
+        return counts, total
+
+    def quantile(self, q: float):
+        """
+        estimate a quantile as the upper bound of the bucket it falls in
+        :param q: between 0 and 1
+        :return: seconds, None without observations, inf past the last bucket
+        """
+        counts, _ = self.totals()
+        seen = sum(counts)
+        if not seen:
+            return None
+
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            if running >= q * seen:
+                return bound
+
+    def render(self) -> list:
+        counts, total = self.totals()
+        lines = []
+        running = 0
+        for bound, count in zip(self.buckets, counts):
+            running += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {running}')
+        running += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {running}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {running}")
+        return lines
+
+
+class Registry:
+    """
+    Every metric of the server, plus callbacks evaluated when scraped
+    """
+
+    def __init__(self) -> None:
+        self.metrics = []
+        self.callbacks = []
+
+    def counter(self, name: str, help: str, label: str = "") -> Counter:
+        metric = Counter(name, help, label)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help: str, label: str = "") -> Gauge:
+        metric = Gauge(name, help, label)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str) -> Histogram:
+        metric = Histogram(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge_callback(self, name: str, help: str, label: str, callback) -> None:
+        """
+        register a gauge computed at scrape time
+        :param name: metric name
+        :param help: one line description
+        :param label: name of the label
+        :param callback: returns a dict of label value -> value, replaces the
+                         one registered before under the same name (server.py
+                         is imported twice when it runs as __main__)
+        """
+        self.callbacks = [i for i in self.callbacks if i[0] != name]
+        self.callbacks.append((name, help, label, callback))
+
+    def render(self) -> str:
+        """
+        :return: every metric in the Prometheus text format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+
+        for name, help, label, callback in self.callbacks:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for key, value in sorted(callback().items()):
+                lines.append(f'{name}{{{label}="{key}"}} {value}')
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CONNECTIONS = REGISTRY.counter(
+    "chat_connections_accepted_total", "Connections accepted by the server"
+)
+SESSIONS = REGISTRY.gauge("chat_sessions_active", "Connections currently open")
+MESSAGES_IN = REGISTRY.counter(
+    "chat_messages_in_total", "Frames received from members, per group", "group"
+)
+MESSAGES_OUT = REGISTRY.counter(
+    "chat_messages_out_total", "Frames handed to members, per group", "group"
+)
+BYTES_SENT = REGISTRY.counter("chat_bytes_sent_total", "Bytes written to clients")
+WRITES = REGISTRY.counter(
+    "chat_writes_total", "Batches of frames written to clients, one write each"
+)
+BYTES_SAVED = REGISTRY.counter(
+    "chat_bytes_saved_total", "Bytes compression kept off the wire"
+)
+FILE_BYTES = REGISTRY.counter(
+    "chat_file_bytes_total", "Bytes of files relayed to recipients"
+)
+TRANSFERS = REGISTRY.counter(
+    "chat_file_transfers_total", "File transfers, per outcome", "outcome"
+)
+COMMANDS = REGISTRY.counter(
+    "chat_commands_total", "Special (!) commands received", "command"
+)
+RATE_LIMITED = REGISTRY.counter(
+    "chat_rate_limited_total", "Frames stopped by the rate limits, per action", "action"
+)
+FANOUT_SECONDS = REGISTRY.histogram(
+    "chat_fanout_seconds",
+    "Time from receiving a frame to handing it to its last recipient",
+)
+WRITE_DELAY_SECONDS = REGISTRY.histogram(
+    "chat_write_delay_seconds",
+    "Time frames spend in a client's outbound queue before being written",
+)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def serve(host: str, port: int) -> ThreadingHTTPServer:
+    """
+    expose the registry over HTTP (GET /metrics) from a daemon thread
+    :param host: address to bind, keep it local
+    :param port: port to bind
+    :return: the running HTTP server
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _ms(seconds) -> str:
+    if seconds is None:
+        return "-"
+    return f"<{seconds * 1000:g}ms"
+
+
+def summary(group: str) -> str:
+    """
+    short human readable report for the !stats command
+    :param group: name of the group asking
+    :return: the report
+    """
+    return (
+        f"group {group}: {MESSAGES_IN.value(group)} messages in, "
+        f"{MESSAGES_OUT.value(group)} out | "
+        f"server: {SESSIONS.value()} sessions, "
+        f"{CONNECTIONS.value()} connections accepted, "
+        f"{BYTES_SENT.value()} bytes sent | "
+        f"fan-out p50 {_ms(FANOUT_SECONDS.quantile(0.5))} "
+        f"p99 {_ms(FANOUT_SECONDS.quantile(0.99))}"
+    )
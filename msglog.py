@@ -0,0 +1,456 @@
+"""
+Durable message log, one per group.
+
+A log is a directory of append-only segment files named after the offset of
+their first record, each with a sparse index mapping some of its offsets to
+byte positions so a read can seek close to where it starts:
+
+    <log dir>/<group>/00000000000000000000.log
+    <log dir>/<group>/00000000000000000000.index
+    <log dir>/<group>/00000000000000004211.log
+    ...
+
+Appending only puts the record in memory, a single committer thread writes
+whatever every log gathered since the last commit with one write and one fsync
+per log, so durability costs one sync per batch instead of one per message and
+the send path never waits on the disk. Reads go through mmap. Old segments are
+deleted once they are past the retention age or the log is over its size.
+"""
+
+import atexit
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_right
+from collections import deque
+from time import time
+from urllib.parse import quote
+
+# where logs live, None disables them, overridden from the server command line
+LOG_DIR = None
+# a new segment is started past this size or age
+SEGMENT_BYTES = 16 << 20
+SEGMENT_SECONDS = 24 * 3600
+# segments are deleted past this age or once the log is bigger, 0 keeps them
+RETENTION_SECONDS = 7 * 24 * 3600
+RETENTION_BYTES = 1 << 30
+# how long records may wait in memory before being written and synced
+COMMIT_INTERVAL = 0.05
+# roughly how many bytes of records between two index entries
+INDEX_INTERVAL = 4096
+# how often the committer looks for segments to delete
+RETENTION_CHECK = 60
+
+# frame length, time, recipient length, then the recipient and the frame,
+# broadcasts have no recipient
+RECORD = struct.Struct("!IdH")
+# longest recipient and frame a record holds
+MAX_RECIPIENT = 0xFFFF
+MAX_FRAME = 0xFFFFFFFF
+# offset relative to the segment, position in the segment
+INDEX_ENTRY = struct.Struct("!II")
+
+
+class Segment:
+    """
+    One log file and its sparse index
+    """
+
+    def __init__(self, directory: str, base: int) -> None:
+        """
+        open (or create) the segment and find where it ends
+        :param directory: directory of the log
+        :param base: offset of the first record of the segment
+        """
+        self.base = base
+        self.path = os.path.join(directory, f"{base:020d}.log")
+        self.index_path = os.path.join(directory, f"{base:020d}.index")
+
+        self.offsets = []
+        self.positions = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as index:
+                data = index.read()
+            for rel, pos in INDEX_ENTRY.iter_unpack(data[: len(data) // 8 * 8]):
+                self.offsets.append(rel)
+                self.positions.append(pos)
+
+        self.file = open(self.path, "ab")
+        self.index = open(self.index_path, "ab")
+        self.size = self.file.tell()
+        self.created = os.stat(self.path).st_mtime if self.size else time()
+        self._recover()
+
+    def _recover(self) -> None:
+        """
+        count the records past the last index entry, dropping a record cut
+        short by a crash and index entries pointing past the end of the file
+        :return: None
+        """
+        while self.positions and self.positions[-1] >= self.size:
+            self.offsets.pop()
+            self.positions.pop()
+        if self.positions:
+            rel, pos = self.offsets[-1], self.positions[-1]
+        else:
+            rel, pos = 0, 0
+
+        with open(self.path, "rb") as file:
+            file.seek(pos)
+            data = file.read()
+
+        end = 0
+        while end + RECORD.size <= len(data):
+            length, _, to_length = RECORD.unpack_from(data, end)
+            record_end = end + RECORD.size + to_length + length
+            if record_end > len(data):
+                break
+            end = record_end
+            rel += 1
+
+        if pos + end < self.size:
+            self.file.truncate(pos + end)
+            self.size = pos + end
+        self.next_offset = self.base + rel
+        self.indexed = self.positions[-1] if self.positions else -INDEX_INTERVAL
+
+    def write(self, records: list) -> None:
+        """
+        append records, with a single write
+        :param records: (time, recipient, frame) tuples
+        :return: None
+        """
+        chunks = []
+        entries = []
+        position = self.size
+        rel = self.next_offset - self.base
+
+        for stamp, recipient, frame in records:
+            if position - self.indexed >= INDEX_INTERVAL:
+                entries.append(INDEX_ENTRY.pack(rel, position))
+                self.offsets.append(rel)
+                self.positions.append(position)
+                self.indexed = position
+
+            chunks.append(RECORD.pack(len(frame), stamp, len(recipient)))
+            chunks.append(recipient)
+            chunks.append(frame)
+            position += RECORD.size + len(recipient) + len(frame)
+            rel += 1
+
+        self.file.write(b"".join(chunks))
+        self.file.flush()
+        # the index can always be rebuilt from the log, it is never synced
+        if entries:
+            self.index.write(b"".join(entries))
+            self.index.flush()
+
+        self.size = position
+        self.next_offset = self.base + rel
+
+    def sync(self) -> None:
+        os.fsync(self.file.fileno())
+
+    def records(self, start: int):
+        """
+        read records through mmap
+        :param start: offset of the first record wanted
+        :return: iterator of (offset, time, recipient, frame)
+        """
+        size = self.size
+        if not size or start >= self.next_offset:
+            return
+
+        rel = max(start - self.base, 0)
+        at = bisect_right(self.offsets, rel) - 1
+        offset, position = (
+            (self.offsets[at], self.positions[at]) if at >= 0 else (0, 0)
+        )
+        offset += self.base
+
+        with open(self.path, "rb") as file:
+            with mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as view:
+                while position + RECORD.size <= size:
+                    length, stamp, to_length = RECORD.unpack_from(view, position)
+                    body = position + RECORD.size
+                    position = body + to_length + length
+                    if offset >= start:
+                        yield (
+                            offset,
+                            stamp,
+                            view[body : body + to_length],
+                            view[body + to_length : position],
+                        )
+                    offset += 1
+
+    def close(self) -> None:
+        self.file.close()
+        self.index.close()
+
+    def delete(self) -> None:
+        self.close()
+        os.unlink(self.path)
+        if os.path.exists(self.index_path):
+            os.unlink(self.index_path)
+
+
+class MessageLog:
+    """
+    The log of one group
+    """
+
+    def __init__(self, name: str) -> None:
+        """
+        open the log of a group, creating it if needed
+        :param name: name of the group
+        """
+        self.name = name
+        self.directory = os.path.join(
+            LOG_DIR, quote(name, safe="").replace(".", "%2E") or "%00"
+        )
+        os.makedirs(self.directory, exist_ok=True)
+
+        bases = sorted(
+            int(entry[:-4])
+            for entry in os.listdir(self.directory)
+            if entry.endswith(".log")
+        )
+        self.segments = [Segment(self.directory, base) for base in bases or [0]]
+        # only the last segment is still written to
+        for segment in self.segments[:-1]:
+            segment.close()
+        # appended by whoever sends, drained by the committer
+        self.pending = deque()
+        self.closing = False
+        # held while writing, reading or deleting segments, never by senders
+        self.lock = threading.Lock()
+
+    @property
+    def next_offset(self) -> int:
+        return self.segments[-1].next_offset
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments)
+
+    def append(self, frame: bytes, recipient: str = "") -> None:
+        """
+        add a message to the log, it reaches the disk with the next commit
+        :param frame: the encoded frame
+        :param recipient: who it was for if it was private, names separated by
+                          commas, "-" first when it was for everyone but them
+        :return: None
+        """
+        if len(frame) > MAX_FRAME:
+            # checked here, the committer must never meet a record it can't write
+            raise ValueError(f"frame of {len(frame)} bytes is too large to log")
+        recipient = recipient.encode()
+        if len(recipient) > MAX_RECIPIENT:
+            # a list of names too long to keep, the start of it will do
+            recipient = recipient[:MAX_RECIPIENT]
+        self.pending.append((time(), recipient, frame))
+        _committer.start()
+
+    def commit(self) -> None:
+        """
+        write and sync everything appended so far
+        :return: None
+        """
+        pending = self.pending
+        if not pending:
+            return
+
+        # split the batch where the segment fills up, each part is one write
+        batches = [[]]
+        room = SEGMENT_BYTES - self.segments[-1].size
+        while pending:
+            record = pending.popleft()
+            if room <= 0:
+                batches.append([])
+                room = SEGMENT_BYTES
+            batches[-1].append(record)
+            room -= RECORD.size + len(record[1]) + len(record[2])
+
+        with self.lock:
+            for records in batches:
+                segment = self.segments[-1]
+                if records:
+                    segment.write(records)
+                    segment.sync()
+
+                if segment.size >= SEGMENT_BYTES or (
+                    time() - segment.created >= SEGMENT_SECONDS
+                ):
+                    self.segments.append(Segment(self.directory, segment.next_offset))
+                    segment.close()
+
+    def compact(self) -> None:
+        """
+        delete the oldest segments while they are past the retention age or
+        the log is over its size, the segment being written is always kept
+        :return: None
+        """
+        with self.lock:
+            total = self.size
+            now = time()
+            while len(self.segments) > 1:
+                oldest = self.segments[0]
+                # a sealed segment was last written when the next one started
+                too_old = RETENTION_SECONDS and (
+                    now - self.segments[1].created > RETENTION_SECONDS
+                )
+                too_big = RETENTION_BYTES and total > RETENTION_BYTES
+                if not (too_old or too_big):
+                    break
+
+                total -= oldest.size
+                oldest.delete()
+                self.segments.pop(0)
+
+    def read(self, start: int = 0):
+        """
+        every record from an offset on, only what has been committed
+        :param start: first offset wanted
+        :return: list of (offset, time, recipient, frame)
+        """
+        with self.lock:
+            segments = list(self.segments)
+            bases = [segment.base for segment in segments]
+            at = max(bisect_right(bases, start) - 1, 0)
+            return [
+                record
+                for segment in segments[at:]
+                for record in segment.records(start)
+            ]
+
+    def tail(self, count: int) -> list:
+        """
+        the last broadcasts of the group, to fill its history after a restart
+        :param count: how many
+        :return: list of encoded frames, oldest first
+        """
+        with self.lock:
+            first = self.segments[0].base
+        end = self.next_offset
+        start = end
+
+        frames = []
+        while len(frames) < count and start > first:
+            # private messages are skipped, look further back until enough
+            start = max(first, start - 2 * (count - len(frames)))
+            frames = [
+                frame
+                for _, _, recipient, frame in self.read(start)
+                if not recipient
+            ]
+
+        return frames[-count:] if count else []
+
+    def close(self) -> None:
+        """
+        stop using the log, the committer writes what is left and closes it
+        :return: None
+        """
+        self.closing = True
+        _committer.start()
+
+    def _release(self) -> None:
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+
+
+class Committer:
+    """
+    The thread writing every log to disk, a batch every COMMIT_INTERVAL
+    """
+
+    def __init__(self) -> None:
+        self.logs = dict()
+        # taken to open and release logs, not to append to them
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self) -> None:
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._loop, daemon=True)
+                    self.thread.start()
+
+    def open(self, name: str) -> MessageLog:
+        """
+        the log of a group, shared by every Group object of that name
+        :param name: name of the group
+        :return: the log
+        """
+        with self.lock:
+            log = self.logs.get(name)
+            if log is None:
+                log = self.logs[name] = MessageLog(name)
+            log.closing = False
+        return log
+
+    def commit_all(self) -> None:
+        with self.lock:
+            logs = list(self.logs.values())
+
+        for log in logs:
+            try:
+                log.commit()
+            except Exception as error:
+                # that batch is lost, the other logs and the next ones still
+                # get written
+                _report(log, "write", error)
+            if log.closing:
+                with self.lock:
+                    # check again, the group may have come back meanwhile
+                    if log.closing and not log.pending:
+                        del self.logs[log.name]
+                        log._release()
+
+    def _loop(self) -> None:
+        checked = time()
+        while not self.stopped.wait(COMMIT_INTERVAL):
+            self.commit_all()
+
+            if time() - checked >= RETENTION_CHECK:
+                checked = time()
+                with self.lock:
+                    logs = list(self.logs.values())
+                for log in logs:
+                    try:
+                        log.compact()
+                    except Exception as error:
+                        _report(log, "compact", error)
+
+    def stop(self) -> None:
+        """
+        write whatever is left, at exit
+        :return: None
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.commit_all()
+
+
+def _report(log: MessageLog, action: str, error: Exception) -> None:
+    print(f"[-] COULD NOT {action.upper()} THE LOG OF {log.name}: {error!r}")
+
+
+_committer = Committer()
+atexit.register(_committer.stop)
+
+
+def open_log(name: str):
+    """
+    the log of a group, if logs are enabled
+    :param name: name of the group
+    :return: a MessageLog, or None
+    """
+    if LOG_DIR is None:
+        return None
+    return _committer.open(name)
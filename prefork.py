@@ -0,0 +1,418 @@
+"""
+Prefork mode: N worker processes share the listening port through SO_REUSEPORT
+and a broker process owns every Group.
+
+Workers do the per-connection work (accepting, reading, decoding frames,
+queueing and writing to each socket) and forward decoded frames to the broker
+over a Unix domain socket. The broker runs the same sessions as the asyncio
+server against RemoteConnection objects, so a group spread over several
+workers behaves exactly like it does in a single process. Everything a group
+sends is batched per worker: one DELIVER message carries a payload once along
+with the ids of every local connection that should get it.
+"""
+
+import asyncio
+import os
+import socket
+import struct
+import tempfile
+from multiprocessing import get_context
+from time import monotonic
+
+import async_server
+import compression
+import connection
+import events
+import metrics
+import scheduler
+import snapshot
+from async_server import CONGESTED, StreamClient
+from protocol import HELLO, PONG, READ_SIZE, Frame, FrameDecoder, encode
+from server import HOST, PORT
+
+# link messages between workers and the broker, carried in protocol frames
+OPEN = 1  # worker -> broker: new client, payload is its address
+FRAME = 2  # worker -> broker: a frame from a client, payload is type + body
+CLOSED = 3  # worker -> broker: the client went away
+DELIVER = 4  # broker -> worker: count, ids, then frames to write to each id
+DROP = 5  # broker -> worker: the session ended, close the client
+
+CONN_ID = struct.Struct("!I")
+LINK_MAX_FRAME = 64 << 20
+
+
+class RemoteConnection:
+    """
+    Broker side stand-in for a client connected to one of the workers
+    """
+
+    def __init__(self, link: "WorkerLink", conn_id: int) -> None:
+        """
+
+        :param link: the worker holding the client's socket
+        :param conn_id: id of the client inside that worker
+        """
+        self.link = link
+        self.conn_id = conn_id
+        self.frames = asyncio.Queue()
+        self.closed = False
+        # extensions the client asked for, see connection.negotiate
+        self.events = False
+        self.compress = False
+        self.resume = False
+        self.files = False
+        # when the client was last heard from, see heartbeat
+        self.last_seen = monotonic()
+        self.heartbeat = None
+
+    @property
+    def queue_depth(self) -> int:
+        # the outbound queue lives in the worker
+        return 0
+
+    def send(self, data: bytes) -> None:
+        """
+        queue encoded frame(s) for the client, batched with the rest of the
+        group's traffic for the same worker
+        :param data: encoded frame(s)
+        :return: None
+        """
+        if not self.closed:
+            if not self.events:
+                data = events.to_text(data)
+            if self.compress:
+                data = compression.pack(data)
+            metrics.BYTES_SENT.inc(len(data))
+            self.link.deliver(data, self.conn_id)
+
+    sendall = send
+
+    async def writable(self) -> None:
+        return
+
+    async def recv_frame(self):
+        """
+        wait for the next frame forwarded by the worker
+        :return: the next Frame, or None once the client has gone
+        """
+        while True:
+            frame = await self.frames.get()
+            if frame is not None and frame.type == HELLO:
+                connection.negotiate(self, frame.payload)
+            elif frame is None or frame.type != PONG:
+                return frame
+
+    async def recv_line(self) -> str:
+        frame = await self.recv_frame()
+        if frame is None:
+            raise ConnectionError("connection closed by peer")
+        return frame.line
+
+    def expire(self) -> None:
+        """
+        end the session of a client that timed out, as if it had gone
+        :return: None
+        """
+        self.frames.put_nowait(None)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.link.deliver(None, self.conn_id)
+
+
+class WorkerLink:
+    """
+    Broker side of the link to one worker process
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        """
+
+        :param writer: stream to the worker
+        """
+        self.writer = writer
+        self.conns = dict()
+        # list of [data, ids], data None means drop, kept in send order so
+        # every client still gets its frames in order
+        self.pending = []
+
+    def deliver(self, data, conn_id: int) -> None:
+        """
+        add a frame for one client to the batch, consecutive sends of the same
+        payload (a broadcast) share one entry
+        :param data: encoded frame(s), or None to drop the client
+        :param conn_id: id of the client in the worker
+        :return: None
+        """
+        pending = self.pending
+        if not pending:
+            asyncio.get_running_loop().call_soon(self.flush)
+
+        if pending and pending[-1][0] is data:
+            pending[-1][1].append(conn_id)
+        else:
+            pending.append([data, [conn_id]])
+
+    def flush(self) -> None:
+        """
+        write everything batched during this loop iteration to the worker
+        :return: None
+        """
+        out = []
+        for data, ids in self.pending:
+            if data is None:
+                out.extend(encode(DROP, CONN_ID.pack(i)) for i in ids)
+            else:
+                head = struct.pack(f"!I{len(ids)}I", len(ids), *ids)
+                out.append(encode(DELIVER, head + data))
+
+        self.pending = []
+        if not self.writer.is_closing():
+            self.writer.writelines(out)
+
+
+async def broker_link(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    serve one worker: start a session for each of its clients and feed them
+    the frames the worker forwards
+    :param reader: stream from the worker
+    :param writer: stream to the worker
+    :return: None
+    """
+    link = WorkerLink(writer)
+    decoder = FrameDecoder(LINK_MAX_FRAME)
+
+    try:
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                break
+
+            for message in decoder.feed(data):
+                (conn_id,) = CONN_ID.unpack_from(message.payload)
+                body = message.payload[CONN_ID.size :]
+
+                if message.type == FRAME:
+                    conn = link.conns.get(conn_id)
+                    if conn is not None:
+                        conn.last_seen = monotonic()
+                        conn.frames.put_nowait(Frame(body[0], body[1:]))
+
+                elif message.type == OPEN:
+                    conn = RemoteConnection(link, conn_id)
+                    link.conns[conn_id] = conn
+                    asyncio.create_task(run_session(link, conn, body.decode()))
+
+                elif message.type == CLOSED:
+                    conn = link.conns.get(conn_id)
+                    if conn is not None:
+                        conn.frames.put_nowait(None)
+
+    finally:
+        # the worker died, every client it held is gone
+        for conn in link.conns.values():
+            conn.closed = True
+            conn.frames.put_nowait(None)
+
+
+async def run_session(link: WorkerLink, conn: RemoteConnection, addr: str) -> None:
+    """
+    run a client's session on the broker and forget the client once it ends
+    :param link: the worker holding the client
+    :param conn: the client
+    :param addr: address of the client, for logging
+    :return: None
+    """
+    try:
+        await async_server.session(conn, addr)
+    finally:
+        link.conns.pop(conn.conn_id, None)
+
+
+async def broker(path: str, ready) -> None:
+    """
+    broker process main coroutine
+    :param path: path of the Unix socket workers connect to
+    :param ready: event set once workers can connect
+    :return: None
+    """
+    server = await asyncio.start_unix_server(broker_link, path)
+    # the broker owns the groups, it saves and restores them
+    restored = snapshot.restore()
+    if restored:
+        print(f"[+] RESTORED {restored} GROUPS")
+    snapshot.start()
+    # the broker runs the sessions, so it keeps their deadlines
+    reaper = asyncio.create_task(scheduler.run_async())
+    ready.set()
+
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            reaper.cancel()
+
+
+# ---------------------------------------
+# | WORKER PROCESS                      |
+# ---------------------------------------
+
+
+async def worker(path: str) -> None:
+    """
+    worker process main coroutine
+    :param path: path of the broker's Unix socket
+    :return: None
+    """
+    link_reader, link_writer = await asyncio.open_unix_connection(path)
+    conns = dict()
+    next_id = iter(range(1, 1 << 32))
+
+    async def client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        conn_id = next(next_id)
+        conn = StreamClient(reader, writer)
+        # the broker already rendered or compressed what this client gets
+        conn.events = True
+        conns[conn_id] = conn
+        prefix = CONN_ID.pack(conn_id)
+
+        addr = str(writer.get_extra_info("peername"))
+        link_writer.write(encode(OPEN, prefix + addr.encode()))
+
+        decoder = FrameDecoder(inflate=True)
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+
+                link_writer.writelines(
+                    [
+                        encode(FRAME, prefix + bytes((frame.type,)) + frame.payload)
+                        for frame in decoder.feed(data)
+                    ]
+                )
+
+                # the block overflow policy, stop reading from our clients
+                # until the stalled ones catch up
+                while CONGESTED:
+                    await next(iter(CONGESTED)).writable()
+
+        except Exception:
+            pass
+
+        finally:
+            link_writer.write(encode(CLOSED, prefix))
+
+    server = await asyncio.start_server(client, sock=reuseport_socket())
+
+    decoder = FrameDecoder(LINK_MAX_FRAME)
+    async with server:
+        while True:
+            data = await link_reader.read(READ_SIZE)
+            if not data:
+                break
+
+            for message in decoder.feed(data):
+                if message.type == DELIVER:
+                    payload = message.payload
+                    (count,) = CONN_ID.unpack_from(payload)
+                    ids = struct.unpack_from(f"!{count}I", payload, CONN_ID.size)
+                    frame = payload[CONN_ID.size * (count + 1) :]
+
+                    for conn_id in ids:
+                        conn = conns.get(conn_id)
+                        if conn is not None:
+                            conn.send(frame)
+
+                elif message.type == DROP:
+                    (conn_id,) = CONN_ID.unpack_from(message.payload)
+                    conn = conns.pop(conn_id, None)
+                    if conn is not None:
+                        conn.close()
+
+
+def reuseport_socket() -> socket.socket:
+    """
+    listening socket shared by every worker, the kernel spreads new
+    connections between them
+    :return: the bound socket
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((HOST, PORT))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+def run_worker(path: str, settings: dict) -> None:
+    """
+    worker process entry point
+    :param path: path of the broker's Unix socket
+    :param settings: the connection settings of the main process, spawned
+                     workers start from the defaults
+    :return: None
+    """
+    for name, value in settings.items():
+        setattr(connection, name, value)
+    try:
+        asyncio.run(worker(path))
+    except KeyboardInterrupt:
+        pass
+
+
+def start_server(workers: int = 0) -> None:
+    """
+    start the broker and the worker processes
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :return: None
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("prefork mode needs SO_REUSEPORT, which this platform doesn't have")
+        return
+
+    workers = workers or os.cpu_count() or 1
+    path = os.path.join(tempfile.mkdtemp(prefix="chat_house-"), "broker.sock")
+
+    async def main() -> None:
+        ready = asyncio.Event()
+        task = asyncio.create_task(broker(path, ready))
+        await ready.wait()
+
+        # spawn rather than fork, workers should not inherit the broker's loop
+        context = get_context("spawn")
+        settings = {name: getattr(connection, name) for name in connection.SETTINGS}
+        processes = []
+        for _ in range(workers):
+            process = context.Process(
+                target=run_worker, args=(path, settings), daemon=True
+            )
+            process.start()
+            processes.append(process)
+
+        print(f"[+] SERVER IS UP AND RUNNING ({workers} workers)...")
+        print("[+] WAITING FOR CONNECTIONS...")
+
+        try:
+            await task
+        finally:
+            for process in processes:
+                process.terminate()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        print("SERVER CRASHED")
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+
+
+if __name__ == "__main__":
+    start_server()
@@ -0,0 +1,278 @@
+"""
+Wire protocol shared by the server and the client.
+
+Every message travels as a frame: a 5 byte header holding the payload length
+(unsigned 32 bit, network order) and the frame type, followed by the payload.
+
+    +----------------+------+-----------------+
+    | length (4)     | type | payload ...     |
+    +----------------+------+-----------------+
+
+Chat prefixes typed by the user (`@`, `-`, `!`) are carried by the frame type
+instead of the payload, so `@jon,linus hi` travels as a PRIVATE frame holding
+`jon,linus hi`.
+
+A client may offer extensions with a HELLO frame before answering the first
+prompt, the server answers with a HELLO listing those it accepted. With
+EVENTS_OFFER group happenings come as EVENT frames (see events) instead of
+rendered text. With ZLIB_OFFER large payloads can come as COMPRESSED frames. Their payload is one or more whole frames
+deflated together with a preset dictionary of the server's usual text. Each
+one stands alone, without a context carried across frames, so a broadcast is
+compressed once and the same bytes go to every member.
+With RESUME_OFFER the server hands out a SESSION token once the user is in a
+group; a client coming back after a server restart answers the first prompt
+with a SESSION frame holding that token instead of a username (see snapshot).
+With FILES_OFFER the client can send and receive files, streamed as FILE,
+CHUNK and FILE_END frames and paced by FILE_ACK frames (see transfer).
+"""
+
+import struct
+import zlib
+from collections import namedtuple
+
+HEADER = struct.Struct("!IB")
+HEADER_SIZE = HEADER.size
+
+# how much to ask the kernel for per read, many frames can come out of one read
+READ_SIZE = 65536
+# anything bigger than this is treated as a broken or hostile peer
+MAX_FRAME_SIZE = 1 << 20
+
+MESSAGE = 1
+PRIVATE = 2
+EXCEPT = 3
+COMMAND = 4
+KILL = 5
+# server asks "are you there", clients answer with a PONG
+PING = 6
+PONG = 7
+# extensions offered by the client and accepted by the server
+HELLO = 8
+# frames deflated together
+COMPRESSED = 9
+# a typed event, code and fields, see events
+EVENT = 10
+# token of a resumable session, from the server when issued, from the client
+# to get back in
+SESSION = 11
+# file transfers, see transfer
+FILE = 12
+CHUNK = 13
+FILE_END = 14
+FILE_ACK = 15
+
+PREFIXES = {
+    PRIVATE: "@",
+    EXCEPT: "-",
+    COMMAND: "!",
+}
+
+
+class ProtocolError(ValueError):
+    """
+    raised when the peer sends something that is not a valid frame
+    """
+
+
+class Frame(namedtuple("Frame", ["type", "payload"])):
+    """
+    A decoded frame, payload is kept as bytes until someone asks for text
+    """
+
+    __slots__ = ()
+
+    @property
+    def text(self) -> str:
+        return self.payload.decode()
+
+    @property
+    def line(self) -> str:
+        """
+        the frame as the user typed it, with its prefix put back
+        """
+        return PREFIXES.get(self.type, "") + self.text
+
+
+def encode(ftype: int, payload: bytes = b"") -> bytes:
+    """
+    build a single frame
+    :param ftype: type of the frame
+    :param payload: body of the frame
+    :return: the frame ready to be written on a socket
+    """
+    return HEADER.pack(len(payload), ftype) + payload
+
+
+def text(message: str) -> bytes:
+    """
+    build a MESSAGE frame out of a string
+    :param message: the text to send
+    :return: the encoded frame
+    """
+    return encode(MESSAGE, message.encode())
+
+
+def from_line(line: str) -> bytes:
+    """
+    turn a line typed by the user into a frame, picking the type from its prefix
+    :param line: what the user typed
+    :return: the encoded frame
+    """
+    for ftype, prefix in PREFIXES.items():
+        if line.startswith(prefix):
+            return encode(ftype, line[len(prefix) :].encode())
+
+    return text(line)
+
+
+KILL_FRAME = encode(KILL)
+PING_FRAME = encode(PING)
+PONG_FRAME = encode(PONG)
+
+# deflate starts out knowing these, the most common strings go last where they
+# are cheapest to refer to
+ZDICT = "".join(
+    [
+        "There is no group named . Would you like to create one? [y/n] ",
+        "Enter the type of group [open/secret/private] ",
+        "Your request has been sent successfully to the admin of the group ",
+        "Your request to join the group has been accepted. ",
+        "user  has requested to join the group. ",
+        "You're the admin of this new open group ",
+        "Welcome to the chatroom Welcome to the secret chat ",
+        "Nobody is lagging Online users: ",
+        "You were muted by  was muted by  was umuted by ",
+        "There is no user named  is in the group  is online but not in a group ",
+        "--- no messages yet ------ last  messages --- ",
+        "(direct)  from (private) : ",
+        "\033[32m\033[31m\033[94m\033[93m\033[96m\033[91m\033[90m",
+        " has just landed!  left the group \033[0m",
+    ]
+).encode()
+# what a HELLO can offer
+ZLIB_OFFER = b"zlib:%08x" % zlib.adler32(ZDICT)
+EVENTS_OFFER = b"events:1"
+RESUME_OFFER = b"resume:1"
+FILES_OFFER = b"files:1"
+
+
+def hello(*offers) -> bytes:
+    """
+    :param offers: extensions offered, or accepted
+    :return: the encoded HELLO frame
+    """
+    return encode(HELLO, b" ".join(offers))
+
+
+def deflate(data: bytes, level: int = 6) -> bytes:
+    """
+    compress one or more encoded frames into a single COMPRESSED frame
+    :param data: encoded frame(s)
+    :param level: zlib compression level
+    :return: the COMPRESSED frame
+    """
+    compressor = zlib.compressobj(level, zdict=ZDICT)
+    return encode(COMPRESSED, compressor.compress(data) + compressor.flush())
+
+
+def inflate(payload: bytes, max_size: int = MAX_FRAME_SIZE) -> list:
+    """
+    :param payload: payload of a COMPRESSED frame
+    :param max_size: most bytes it may inflate to
+    :return: list of the Frame it holds
+    """
+    decompressor = zlib.decompressobj(zdict=ZDICT)
+    try:
+        data = decompressor.decompress(payload, max_size)
+    except zlib.error as error:
+        raise ProtocolError(f"bad compressed frame: {error}") from None
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ProtocolError("compressed frame is too large or truncated")
+
+    decoder = FrameDecoder(max_size)
+    frames = decoder.feed(data)
+    if decoder.buffer:
+        raise ProtocolError("compressed frame ends in the middle of a frame")
+    return frames
+
+
+class Template:
+    """
+    A MESSAGE frame with fixed text around a few "{}" fields, the fixed parts are
+    encoded once and only the fields are encoded each time the template is used
+    """
+
+    __slots__ = ("parts",)
+
+    def __init__(self, fmt: str) -> None:
+        """
+
+        :param fmt: the message, with "{}" where each field goes
+        """
+        self.parts = [part.encode() for part in fmt.split("{}")]
+
+    def __call__(self, *fields) -> bytes:
+        """
+        build the frame
+        :param fields: one value per "{}" in the template
+        :return: the encoded frame
+        """
+        parts = self.parts
+        chunks = [b"", parts[0]]
+        for field, part in zip(fields, parts[1:]):
+            chunks.append(str(field).encode())
+            chunks.append(part)
+
+        chunks[0] = HEADER.pack(sum(map(len, chunks)), MESSAGE)
+        return b"".join(chunks)
+
+
+class FrameDecoder:
+    """
+    Incremental decoder, feed it whatever the socket returned and get back every
+    complete frame, partial frames are kept until the rest arrives
+    """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE, inflate=False) -> None:
+        """
+
+        :param max_frame_size: largest payload accepted from the peer
+        :param inflate: whether to unpack COMPRESSED frames into the frames
+                        they hold
+        """
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+        self.inflate = inflate
+
+    def feed(self, data: bytes) -> list:
+        """
+        add received bytes and pull out all the frames they complete
+        :param data: bytes just read from the peer
+        :return: list of Frame
+        """
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        offset = 0
+        end = len(buffer)
+
+        while end - offset >= HEADER_SIZE:
+            length, ftype = HEADER.unpack_from(buffer, offset)
+            if length > self.max_frame_size:
+                raise ProtocolError(f"frame of {length} bytes is too large")
+
+            start = offset + HEADER_SIZE
+            if end - start < length:
+                break
+
+            payload = bytes(buffer[start : start + length])
+            if ftype == COMPRESSED and self.inflate:
+                frames.extend(inflate(payload, self.max_frame_size))
+            else:
+                frames.append(Frame(ftype, payload))
+            offset = start + length
+
+        if offset:
+            del buffer[:offset]
+
+        return frames
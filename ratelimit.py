@@ -0,0 +1,145 @@
+"""
+Flood protection.
+
+Every session gets a Limiter with token buckets for its messages, the bytes it
+sends and its special commands, and every group a bucket of its own shared by
+its members. A frame over a limit is dropped, and a streak of dropped frames
+(until one is allowed again) counts as a strike; strikes escalate from a
+warning to an automatic mute to a disconnect, and are forgiven slowly over
+time. Checking a frame is a few float operations on buckets owned by the
+session, the only shared bucket (the group's) is updated without a lock: a
+lost update under contention only makes the group limit a bit looser.
+"""
+
+from time import monotonic
+
+# sustained rates per second, 0 disables the limit, overridden from the server
+# command line
+MESSAGES_PER_SECOND = 5
+BYTES_PER_SECOND = 16 * 1024
+COMMANDS_PER_SECOND = 1
+GROUP_MESSAGES_PER_SECOND = 100
+# how many seconds worth of traffic can be sent at once
+BURST_SECONDS = 3
+# strikes before being muted, then disconnected, one is forgiven every
+# STRIKE_DECAY seconds, a streak still going after that long strikes again
+STRIKES_TO_MUTE = 5
+STRIKES_TO_DISCONNECT = 15
+STRIKE_DECAY = 10
+# seconds the server mutes a member for, 0 mutes them until the admin unmutes
+FLOOD_MUTE_SECONDS = 60
+
+# what to do with a frame
+ALLOW = 0
+DROP = 1
+THROTTLE = 2
+GROUP_BUSY = 3
+MUTE = 4
+DISCONNECT = 5
+
+
+class TokenBucket:
+    """
+    Refills at a steady rate up to its burst size, taking from it fails once it
+    is empty
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float = 0) -> None:
+        """
+
+        :param rate: tokens added per second
+        :param burst: most tokens held, BURST_SECONDS worth by default
+        """
+        self.rate = rate
+        self.burst = burst or rate * BURST_SECONDS
+        self.tokens = self.burst
+        self.stamp = monotonic()
+
+    def take(self, amount: float, now: float) -> bool:
+        """
+        :param amount: tokens needed
+        :param now: current monotonic time
+        :return: whether there were enough
+        """
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+
+        # something bigger than the whole burst goes through once the bucket
+        # is full, leaving it in debt
+        if tokens < amount and tokens < self.burst:
+            self.tokens = tokens
+            return False
+
+        self.tokens = tokens - amount
+        return True
+
+
+def _bucket(rate: float, burst: float = 0):
+    return TokenBucket(rate, burst) if rate else None
+
+
+def group_bucket():
+    """
+    :return: the bucket shared by the members of a new group, or None
+    """
+    return _bucket(GROUP_MESSAGES_PER_SECOND)
+
+
+class Limiter:
+    """
+    Limits of a single session, only ever touched by that session
+    """
+
+    __slots__ = ("messages", "bytes", "commands", "strikes", "struck", "throttled")
+
+    def __init__(self) -> None:
+        self.messages = _bucket(MESSAGES_PER_SECOND)
+        self.bytes = _bucket(BYTES_PER_SECOND)
+        self.commands = _bucket(COMMANDS_PER_SECOND)
+        self.strikes = 0.0
+        self.struck = 0.0
+        self.throttled = False
+
+    def check(self, command: bool, size: int, group=None) -> int:
+        """
+        decide what to do with a frame
+        :param command: whether the frame is a special command
+        :param size: payload size of the frame
+        :param group: bucket of the group the frame goes to, if it has one
+        :return: ALLOW, DROP, THROTTLE, GROUP_BUSY, MUTE or DISCONNECT
+        """
+        now = monotonic()
+        if command:
+            allowed = self.commands is None or self.commands.take(1, now)
+        else:
+            allowed = (self.messages is None or self.messages.take(1, now)) and (
+                self.bytes is None or self.bytes.take(size, now)
+            )
+
+        if allowed:
+            self.throttled = False
+            if command or group is None or group.take(1, now):
+                return ALLOW
+            # the whole group is too busy, not this member's fault
+            return GROUP_BUSY
+
+        # one strike per streak, or per STRIKE_DECAY seconds of a long one
+        streak = self.throttled
+        if streak and now - self.struck < STRIKE_DECAY:
+            return DROP
+        self.throttled = True
+
+        strikes = self.strikes - (now - self.struck) / STRIKE_DECAY
+        self.strikes = strikes = max(strikes, 0.0) + 1
+        self.struck = now
+
+        if strikes >= STRIKES_TO_DISCONNECT:
+            return DISCONNECT
+        if strikes >= STRIKES_TO_MUTE:
+            return MUTE
+        # warn once per streak, then drop silently
+        return DROP if streak else THROTTLE
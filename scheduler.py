@@ -0,0 +1,80 @@
+"""
+Deferred actions.
+
+Anything that has to happen later, like a connection's deadline, ending a
+session a moment after its last message, or lifting a timed mute, goes on one
+timer wheel. No thread or coroutine handling a client ever sleeps waiting for
+it. The wheel is driven by a thread in threaded mode and by a task on the event
+loop otherwise, so in the asyncio and prefork servers actions run on the loop
+like everything else.
+"""
+
+import asyncio
+import re
+from threading import Thread
+from time import sleep
+
+from timerwheel import Timer, TimerWheel
+
+# seconds, the precision of every deferred action
+TICK = 1.0
+
+WHEEL = TimerWheel(TICK)
+
+DURATION = re.compile(r"(\d+(?:\.\d+)?)([smhd]?)")
+UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def later(delay: float, callback, *args) -> Timer:
+    """
+    call a function once a delay has passed
+    :param delay: seconds
+    :param callback: the function
+    :param args: its arguments
+    :return: the Timer, to cancel it
+    """
+    return WHEEL.schedule(delay, callback, *args)
+
+
+def cancel(timer: Timer) -> None:
+    """
+    :param timer: a Timer that may or may not have fired yet
+    :return: None
+    """
+    WHEEL.cancel(timer)
+
+
+def parse_duration(word: str):
+    """
+    :param word: a duration as typed in a command, like 30s, 10m, 2h or 1d,
+                 plain numbers are seconds
+    :return: seconds, or None if the word is not a duration
+    """
+    match = DURATION.fullmatch(word)
+    if match is None:
+        return None
+    return float(match.group(1)) * UNITS[match.group(2)]
+
+
+def run() -> None:
+    """
+    drive the wheel from a thread, for the threaded server
+    :return: None
+    """
+
+    def loop() -> None:
+        while True:
+            sleep(TICK)
+            WHEEL.advance()
+
+    Thread(target=loop, daemon=True).start()
+
+
+async def run_async() -> None:
+    """
+    drive the wheel from the event loop, for the asyncio and prefork servers
+    :return: None
+    """
+    while True:
+        await asyncio.sleep(TICK)
+        WHEEL.advance()
@@ -1,17 +1,58 @@
-import time
+import argparse
 import socket
-from threading import Thread
+from time import perf_counter
+from threading import Lock, Thread
 from colors import color
-from group import Group
+import actor
+import auth
+import compression
+import connection
+import directory
+import heartbeat
+import history
+import metrics
+import msglog
+import ratelimit
+import scheduler
+import snapshot
+import transfer
+from connection import Connection
+import group
+from group import ASK_PASSWORD, Group, topic_of
+import protocol
+from protocol import Template, text
 
 fg = color.fg
 reset = color.style.reset
 
 HOST = "localhost"
 PORT = 5500
-BUFF_SIZE = 1024
-groups = dict()
+# every live group, by name, see directory
+groups = directory.groups
 SERVER = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# held while checking a group name is free and creating the group
+CREATING = Lock()
+
+# handshake and error messages are encoded once at import
+WELCOME = text(f" {fg.lightblue} Welcome to chat_house!\nEnter you username: {reset}")
+ASK_GROUP = text(f" {fg.purple} Enter the name of the group you want to join: {reset}")
+NO_SUCH_GROUP = Template(
+    f'{fg.red}There is no group named "{{}}". Would you like to create one? [y/n]{reset}'
+)
+ASK_TYPE = text(f" {fg.orange} Enter the type of group [open/secret/private] {reset}")
+BAD_TYPE = text("Not a valid type of group")
+ASK_SECRET = text("Please enter a secret key for the group")
+CREATED = text(f"{fg.green} Creation Successful{reset}\n")
+CREATED_MEANWHILE = Template(
+    f'{fg.red}The group "{{}}" was created by someone else meanwhile{reset}'
+)
+NEW_ADMIN = Template("You're the admin of this new {} group")
+NO_SUCH_COMMAND = text("No such special command! ")
+NOT_ADMIN = text("You can't preform this action until you are an admin :(")
+ONLY_PRIVATE = text("This action is only viable in a private group")
+SLOW_DOWN = text(f"{fg.yellow}You are sending too fast, slow down{reset}")
+GROUP_BUSY = text(f"{fg.yellow}The group is too busy, try again in a moment{reset}")
+FLOODED = text(f"{fg.red}Disconnected for flooding the group{reset}")
 
 SPECIAL_MESSAGES = [
     "whosonline",
@@ -26,8 +67,22 @@ SPECIAL_MESSAGES = [
     "reject",
     "mute",
     "unmute",
+    "lagging",
+    "stats",
+    "history",
+    "whereis",
+    "sub",
+    "unsub",
 ]
 
+LIMIT_ACTIONS = {
+    ratelimit.DROP: "drop",
+    ratelimit.THROTTLE: "throttle",
+    ratelimit.GROUP_BUSY: "group_busy",
+    ratelimit.MUTE: "mute",
+    ratelimit.DISCONNECT: "disconnect",
+}
+
 ADMIN_ONLY = [
     "kick",
     "destruct",
@@ -37,74 +92,105 @@ ADMIN_ONLY = [
     "reject",
     "mute",
     "unmute",
+    "lagging",
+    "stats",
 ]
 
 
+def queue_depths() -> dict:
+    """
+    deepest outbound queue of each group, evaluated when metrics are scraped
+    :return: group name -> queue depth
+    """
+    depths = dict()
+    for name, group in list(groups.items()):
+        depths[name] = max(
+            [member.conn.queue_depth for member in group.roster()], default=0
+        )
+    return depths
+
+
+metrics.REGISTRY.gauge_callback(
+    "chat_queue_depth_max",
+    "Frames waiting in the most behind member's outbound queue",
+    "group",
+    queue_depths,
+)
+metrics.REGISTRY.gauge_callback(
+    "chat_mailbox_depth",
+    "Messages waiting in each group's mailbox (threaded mode)",
+    "group",
+    lambda: {name: len(group.actor) for name, group in list(groups.items())},
+)
+
+
 def private_except_message(
-    username: str, _: socket.socket, group: Group, message: str
+    username: str, _: Connection, group: Group, message: str
 ) -> None:
     """
-    Function to handle private messages
+    Function to handle messages to everyone but some members
     :param username: sender
-    :param client: socket object of the sender
+    :param client: connection of the sender
     :param group: group object of the group sender is currently in
-    :param message: the message (along with the receiver's info)
+    :param message: the message (along with the excluded members)
     :return:
     """
-    receivers, *msg = message[1:].split()
-    message = " ".join(msg)
-
-    receivers = [i.strip() for i in receivers.split(",")]
-
-    for member in group.members:
-        if member not in receivers:
-            group.private_message(username, member, message)
+    receivers, message = split_receivers(message)
+    group.multicast(username, message, exclude=receivers)
 
 
 def private_message(
-    username: str, _: socket.socket, group: Group, message: str
+    username: str, client: Connection, group: Group, message: str
 ) -> None:
     """
     Function to handle private messages
     :param username: sender
-    :param client: socket object of the sender
+    :param client: connection of the sender
     :param group: group object of the group sender is currently in
     :param message: the message (along with the receiver's info)
     :return:
     """
+    receivers, message = split_receivers(message)
+    missing = group.multicast(username, message, include=receivers)
+    if missing:
+        # not in this group, maybe in another one
+        for name in directory.direct(username, group.name, missing, message):
+            client.send(directory.NO_SUCH_USER(name))
 
-    receivers, *msg = message[1:].split()
-    message = " ".join(msg)
 
-    receivers = receivers.split(",")
-    for receiver in receivers:
-        receiver = receiver.strip()
-        if receiver in group.members:
-            group.private_message(username, receiver, message)
+def split_receivers(message: str) -> tuple:
+    """
+    Function to separate the comma separated names in front of a message
+    :param message: the message as received, without its prefix
+    :return: (set of names, the message itself)
+    """
+    receivers, _, message = message.strip().partition(" ")
+    return {name.strip() for name in receivers.split(",")}, message.strip()
 
 
 def special_message(
-    username: str, client: socket.socket, group: Group, message: str
+    username: str, client: Connection, group: Group, message: str
 ) -> None:
     """
-    Function to handle special messages (starting with '!')
+    Function to handle special messages (COMMAND frames, typed with a '!')
     :param username: username of the sender
-    :param client: socket object of the sender
+    :param client: connection of the sender
     :param group: Group object of the sender's current group
     :param message: the message along with the special instruction
     :return: None
     """
-    special, *msg = message[1:].split()
+    special, *msg = message.split()
     message = " ".join(msg)
 
     if special not in SPECIAL_MESSAGES:
-        client.sendall("No such special command! ".encode())
+        metrics.COMMANDS.inc(label="unknown")
+        client.sendall(NO_SUCH_COMMAND)
         return
 
+    metrics.COMMANDS.inc(label=special)
+
     if username != group.admin and special in ADMIN_ONLY:
-        client.sendall(
-            "You can't preform this action until you are an admin :(".encode()
-        )
+        client.sendall(NOT_ADMIN)
         return
 
     if special == "quit":
@@ -139,95 +225,264 @@ def special_message(
     elif special == "unmute":
         group.unmute(message)
 
+    elif special == "lagging":
+        group.lagging(username)
+
+    elif special == "stats":
+        client.send(text(metrics.summary(group.name)))
+
+    elif special == "whereis":
+        client.send(directory.whereis(message.strip()))
+
+    elif special == "history":
+        count = int(message) if message.isdigit() else history.REPLAY
+        group.replay(username, count)
+
+    elif special == "sub":
+        group.subscribe(username, message)
+
+    elif special == "unsub":
+        group.unsubscribe(username, message)
+
     elif special == "accept":
         if group.type != "private":
-            client.send("This action is only viable in a private group".encode())
+            client.send(ONLY_PRIVATE)
             return
 
         group.accept(message)
 
     elif special == "reject":
         if group.type != "private":
-            client.send("This action is only viable in a private group".encode())
+            client.send(ONLY_PRIVATE)
             return
 
         group.reject(message)
 
 
-def listen(client: socket.socket, username: str, group: Group):
+def handle_frame(
+    username: str,
+    client: Connection,
+    group: Group,
+    frame: protocol.Frame,
+    received: float = None,
+) -> None:
+    """
+    Function to route a chat frame to the right handler based on its type
+    :param username: username of the sender
+    :param client: connection of the sender
+    :param group: Group object of the sender's current group
+    :param frame: the frame as received from the client
+    :param received: perf_counter() when the frame was read, now by default
+    :return: None
     """
-    listening thread for the server
-    :param client: socket object of the user
+    if received is None:
+        received = perf_counter()
+    metrics.MESSAGES_IN.inc(label=group.name)
+    message = frame.text
+
+    if frame.type == protocol.PRIVATE:
+        private_message(username, client, group, message)
+    elif frame.type == protocol.EXCEPT:
+        private_except_message(username, client, group, message)
+    elif frame.type == protocol.COMMAND:
+        special_message(username, client, group, message)
+    elif frame.type == protocol.MESSAGE:
+        topic = topic_of(message)
+        if topic is None:
+            group.broadcast(username, message)
+        else:
+            group.topic_message(username, topic, message)
+
+    metrics.FANOUT_SECONDS.observe(perf_counter() - received)
+
+
+def admit(
+    username: str,
+    client: Connection,
+    group: Group,
+    limiter: ratelimit.Limiter,
+    frame: protocol.Frame,
+) -> bool:
+    """
+    Function to apply the rate limits to a frame, escalating against a user who
+    keeps flooding: warning, then mute, then disconnect
+    :param username: username of the sender
+    :param client: connection of the sender
+    :param group: Group object of the sender's current group
+    :param limiter: limits of the sender's session
+    :param frame: the frame as received from the client
+    :return: whether the frame can be handled
+    """
+    verdict = limiter.check(
+        frame.type == protocol.COMMAND, len(frame.payload), group.limit
+    )
+    if verdict == ratelimit.ALLOW:
+        return True
+
+    metrics.RATE_LIMITED.inc(label=LIMIT_ACTIONS[verdict])
+    if verdict == ratelimit.THROTTLE:
+        client.send(SLOW_DOWN)
+
+    elif verdict == ratelimit.GROUP_BUSY:
+        client.send(GROUP_BUSY)
+
+    elif verdict == ratelimit.MUTE:
+        if not group.is_muted(username):
+            group.flood_mute(username)
+
+    elif verdict == ratelimit.DISCONNECT:
+        client.send(FLOODED)
+        group.quit(username)
+
+    return False
+
+
+def receive(
+    username: str,
+    client: Connection,
+    group: Group,
+    limiter: ratelimit.Limiter,
+    frame: protocol.Frame,
+    received: float,
+) -> None:
+    """
+    Function to handle a frame from a member, run by the group's actor
+    :param username: username of the sender
+    :param client: connection of the sender
+    :param group: Group object of the sender's current group
+    :param limiter: limits of the sender's session
+    :param frame: the frame as received from the client
+    :param received: perf_counter() when the frame was read, fan-out is timed
+                     from there so it counts the wait in the mailbox
+    :return: None
+    """
+    member = group.member(username)
+    if member is None:
+        # left or kicked while the frame was in the mailbox
+        return
+
+    try:
+        if frame.type in transfer.FRAMES:
+            # paced by the recipients rather than the rate limits, and muted
+            # members still acknowledge what they receive
+            transfer.handle(group, username, client, frame)
+        elif not admit(username, client, group, limiter, frame):
+            if not group.is_member(username):
+                # disconnected for flooding, the listening thread sees the end
+                client.expire()
+        elif not member.muted:
+            handle_frame(username, client, group, frame, received)
+
+    except Exception:
+        client.expire()
+
+
+def listen(client: Connection, username: str, group: Group):
+    """
+    listening thread for the server, it only reads: what the frames do is up to
+    the group's actor
+    :param client: connection of the user
     :param username: username of the user
     :param group: group object of the user's group
     :return: None
     """
+    limiter = ratelimit.Limiter()
+    waiting = group.is_waiting(username)
+    heartbeat.enter(client, heartbeat.WAITING if waiting else heartbeat.CHATTING)
     while True:
         try:
             if group.is_alive:
-                message = client.recv(BUFF_SIZE).decode()
-                if username not in group.members:
+                frame = client.recv_frame()
+                member = group.sessions.get(username)
+                if frame is not None and member is not None and member.waiting:
+                    continue
+                if member is None or member.waiting:
+                    if member is not None and member.conn is client:
+                        # gave up, or timed out, before being answered
+                        group.actor.post(group.withdraw, username)
                     break
 
-                if not group.muted_users[username]:
-                    if not message:
-                        message = "!quit"
-                        special_message(username, client, group, message)
-                        return
-
-                    if message.startswith("@"):
-                        private_message(username, client, group, message)
-                    elif message.startswith("-"):
-                        private_except_message(username, client, group, message)
-                    elif message.startswith("!"):
-                        special_message(username, client, group, message)
-                    else:
-                        group.broadcast(username, message)
+                if frame is None:
+                    # the connection is closed once the group is done with it
+                    left = group.actor.call(
+                        special_message, username, client, group, "quit"
+                    )
+                    left.result()
+                    return
+
+                group.actor.post(
+                    receive, username, client, group, limiter, frame, perf_counter()
+                )
+                connection.wait_congested()
 
             else:
                 return
 
-        except:
-            # print(f"CONNECTION LOST TO {username}")
+        except Exception:
+            # reset or broken, the user is gone all the same
+            group.actor.call(drop, username, client, group).result()
             break
 
 
-def create_new_group(conn: socket.socket, username: str, name: str) -> bool:
+def drop(username: str, client, group: Group) -> None:
+    """
+    Function to take a user whose connection broke out of the group, as if they
+    had quit (or given up waiting), run by the group's actor
+    :param username: username of the user
+    :param client: connection of the user, they may have come back on another
+    :param group: Group object of the user's group
+    :return: None
+    """
+    member = group.sessions.get(username)
+    if not group.is_alive or member is None or member.conn is not client:
+        return
+    if member.waiting:
+        group.withdraw(username)
+    else:
+        special_message(username, client, group, "quit")
+
+
+def create_new_group(conn: Connection, username: str, name: str) -> bool:
     """
     create a new group object
-    :param conn: socket object of the user
+    :param conn: connection of the user
     :param username: the username of the connected client
     :param name: name of the group
     :return: None
     """
     secret = None
 
-    conn.send(
-        f" {fg.orange} Enter the type of group [open/secret/private] {reset}".encode()
-    )
-    gtype = conn.recv(BUFF_SIZE).decode()
+    conn.send(ASK_TYPE)
+    gtype = conn.recv_line()
 
     if gtype not in ["open", "secret", "private"]:
-        conn.send("Not a valid type of group".encode())
-        time.sleep(1)
-        conn.send("!!!KILL!!!".encode())
+        # the caller sends the kill, frames arrive in order so the client
+        # shows this first
+        conn.send(BAD_TYPE)
         return False
 
     if gtype == "secret":
-        conn.send("Please enter a secret key for the group".encode())
-        secret = conn.recv(BUFF_SIZE).decode()
+        conn.send(ASK_SECRET)
+        secret = auth.hash_secret(conn.recv_line())
+
+    with CREATING:
+        if name in groups:
+            conn.send(CREATED_MEANWHILE(name))
+            return False
+        group = groups[name] = Group(name, username, conn, gtype, secret)
 
-    groups[name] = Group(name, username, conn, gtype, secret)
-    conn.send(f"{fg.green} Creation Successful{reset}\n".encode())
-    conn.send(f"You're the admin of this new {gtype} group".encode())
+    conn.send(CREATED)
+    conn.send(NEW_ADMIN(gtype))
+    # a group created again picks up its logged history
+    group.actor.post(group.catch_up, username)
 
     return True
 
 
-def service_user(conn: socket.socket, username: str, group_name: str) -> None:
+def service_user(conn: Connection, username: str, group_name: str) -> None:
     """
     Function to allocate a new user to some group
-    :param conn: socket object of client
+    :param conn: connection of client
     :param username: username of the client
     :param group_name: group name the user wants to join/create
     :return: None
@@ -235,53 +490,74 @@ def service_user(conn: socket.socket, username: str, group_name: str) -> None:
     if group_name in groups.keys() and groups[group_name].is_alive:
         group = groups[group_name]
 
+        # joining changes the group, its actor does it, the user is a member
+        # (or waiting) by the time listen starts
         if group.type == "open":
-            group.open_accept(conn, username)
+            group.actor.call(group.open_accept, conn, username).result()
 
         elif group.type == "secret":
-            ok = group.secret_accept(conn, username)
-            if not ok:
+            conn.send(ASK_PASSWORD)
+            passwd = conn.recv_line()
+            valid = auth.verify(group.secret_key, passwd)
+            joined = group.actor.call(group.secret_verify, conn, username, valid)
+            if not joined.result():
                 return
 
         elif group.type == "private":
-            group.private_accept(conn, username)
+            if not group.actor.call(group.private_accept, conn, username).result():
+                conn.send(protocol.KILL_FRAME)
+                return
 
     else:
 
-        conn.send(
-            f'{fg.red}There is no group named "{group_name}". Would you like to create one? [y/n]{reset}'.encode()
-        )
-        answer = conn.recv(BUFF_SIZE).decode()
+        conn.send(NO_SUCH_GROUP(group_name))
+        answer = conn.recv_line()
 
         if answer.lower() != "y":
-            conn.send("!!!KILL!!!".encode())
+            conn.send(protocol.KILL_FRAME)
             return
 
         ok = create_new_group(conn, username, group_name)
 
         if not ok:
-            conn.send("!!!KILL!!!".encode())
+            conn.send(protocol.KILL_FRAME)
+            return
 
     listen(conn, username, groups[group_name])
 
 
-def welcome_user(conn: socket.socket, addr: tuple) -> None:
+def welcome_user(sock: socket.socket, addr: tuple) -> None:
     """
     Start the chat process
-    :param conn: socket object of the client
+    :param sock: socket object of the client
     :param addr: ip adrress and port of the client
     :return:
     """
+    conn = Connection(sock)
+    beat = heartbeat.watch(conn)
+    username = None
+    metrics.CONNECTIONS.inc()
+    metrics.SESSIONS.inc()
     try:
-        conn.send(
-            f" {fg.lightblue} Welcome to chat_house!\nEnter you username: {reset}".encode()
-        )
-        username = conn.recv(BUFF_SIZE).decode()
+        conn.send(WELCOME)
+        frame = conn.recv_frame()
+        if frame is not None and frame.type == protocol.SESSION:
+            # back after a restart, straight into the group
+            username, group = snapshot.resume(conn, frame.payload)
+            if group is not None:
+                listen(conn, username, group)
+                return
+            frame = conn.recv_frame()
 
-        conn.send(
-            f" {fg.purple} Enter the name of the group you want to join: {reset}".encode()
-        )
-        group_name = conn.recv(BUFF_SIZE).decode()
+        if frame is None:
+            raise ConnectionError("connection closed by peer")
+        username = frame.line
+        while not directory.claim(username, conn):
+            conn.send(directory.NAME_TAKEN(username))
+            username = conn.recv_line()
+
+        conn.send(ASK_GROUP)
+        group_name = conn.recv_line()
         service_user(conn, username, group_name)
 
     except:
@@ -290,6 +566,13 @@ def welcome_user(conn: socket.socket, addr: tuple) -> None:
         )
         # print(f"[-] CONNECTION LOST TO {addr}")
 
+    finally:
+        beat.stop()
+        if username is not None:
+            directory.release(username, conn)
+        metrics.SESSIONS.dec()
+        conn.close()
+
 
 def start_server() -> None:
     """
@@ -301,6 +584,12 @@ def start_server() -> None:
 
     SERVER.bind((HOST, PORT))
     SERVER.listen()
+    restored = snapshot.restore()
+    if restored:
+        print(f"[+] RESTORED {restored} GROUPS")
+    snapshot.start()
+    actor.start()
+    scheduler.run()
     print("[+] SERVER IS UP AND RUNNING...")
     print("[+] WAITING FOR CONNECTIONS...")
 
@@ -317,5 +606,279 @@ def start_server() -> None:
         SERVER.close()
 
 
+def main() -> None:
+    """
+    parse the command line and start the server in the requested mode
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description="chat_house server")
+    parser.add_argument(
+        "--mode",
+        choices=["threaded", "async", "prefork"],
+        default="threaded",
+        help="threaded: one thread per connection, async: single asyncio event loop, "
+        "prefork: worker processes sharing the port with a broker owning the groups",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="number of worker processes in prefork mode (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=connection.QUEUE_SIZE,
+        help="number of frames buffered for a client before its overflow policy applies",
+    )
+    parser.add_argument(
+        "--overflow",
+        choices=connection.OVERFLOW_POLICIES,
+        default=connection.OVERFLOW,
+        help="what to do with a client whose outbound queue is full",
+    )
+    parser.add_argument(
+        "--coalesce-ms",
+        type=float,
+        default=connection.COALESCE_DELAY * 1000,
+        help="hold messages for a client up to this many milliseconds so they "
+        "go out in one write (0 to write them right away)",
+    )
+    parser.add_argument(
+        "--coalesce-bytes",
+        type=int,
+        default=connection.COALESCE_BYTES,
+        help="write held messages as soon as this many bytes are waiting",
+    )
+    parser.add_argument(
+        "--nagle",
+        action="store_true",
+        help="leave Nagle's algorithm on for client sockets (TCP_NODELAY off)",
+    )
+    parser.add_argument(
+        "--history-messages",
+        type=int,
+        default=history.MAX_MESSAGES,
+        help="most messages each group keeps for new members and !history",
+    )
+    parser.add_argument(
+        "--history-bytes",
+        type=int,
+        default=history.MAX_BYTES,
+        help="most bytes of messages each group keeps",
+    )
+    parser.add_argument(
+        "--history-replay",
+        type=int,
+        default=history.REPLAY,
+        help="how many past messages a member gets when joining (0 for none)",
+    )
+    parser.add_argument(
+        "--log-dir",
+        help="keep a durable log of every group's messages in this directory",
+    )
+    parser.add_argument(
+        "--log-segment-size",
+        type=int,
+        default=msglog.SEGMENT_BYTES,
+        help="bytes after which a log starts a new segment file",
+    )
+    parser.add_argument(
+        "--log-retention",
+        type=float,
+        default=msglog.RETENTION_SECONDS / 3600,
+        help="hours after which old log segments are deleted (0 to keep them)",
+    )
+    parser.add_argument(
+        "--log-retention-size",
+        type=int,
+        default=msglog.RETENTION_BYTES,
+        help="bytes past which a group's oldest log segments are deleted (0 for no limit)",
+    )
+    parser.add_argument(
+        "--rate-messages",
+        type=float,
+        default=ratelimit.MESSAGES_PER_SECOND,
+        help="messages per second a user can send (0 for no limit)",
+    )
+    parser.add_argument(
+        "--rate-bytes",
+        type=int,
+        default=ratelimit.BYTES_PER_SECOND,
+        help="bytes per second a user can send (0 for no limit)",
+    )
+    parser.add_argument(
+        "--rate-commands",
+        type=float,
+        default=ratelimit.COMMANDS_PER_SECOND,
+        help="special commands per second a user can send (0 for no limit)",
+    )
+    parser.add_argument(
+        "--rate-group",
+        type=float,
+        default=ratelimit.GROUP_MESSAGES_PER_SECOND,
+        help="messages per second a whole group can take (0 for no limit)",
+    )
+    parser.add_argument(
+        "--flood-mute",
+        type=float,
+        default=ratelimit.FLOOD_MUTE_SECONDS,
+        help="seconds a user flooding the group is muted for (0 until unmuted)",
+    )
+    parser.add_argument(
+        "--no-rate-limits",
+        action="store_true",
+        help="turn every rate limit off, for benchmarks",
+    )
+    parser.add_argument(
+        "--waiting-limit",
+        type=int,
+        default=group.MAX_WAITING,
+        help="most users waiting to join a private group, later ones are turned "
+        "away (0 for no limit)",
+    )
+    parser.add_argument(
+        "--ping-interval",
+        type=float,
+        default=heartbeat.PING_INTERVAL,
+        help="seconds of silence before a member is pinged (0 to never ping)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=heartbeat.IDLE_TIMEOUT,
+        help="seconds without hearing from a member before dropping it, pinged "
+        "or not (0 to never drop)",
+    )
+    parser.add_argument(
+        "--handshake-timeout",
+        type=float,
+        default=heartbeat.HANDSHAKE_TIMEOUT,
+        help="seconds a new connection has to join or create a group",
+    )
+    parser.add_argument(
+        "--waiting-timeout",
+        type=float,
+        default=heartbeat.WAITING_TIMEOUT,
+        help="seconds a request to join a private group waits for the admin",
+    )
+    parser.add_argument(
+        "--compress-min-size",
+        type=int,
+        default=compression.MIN_SIZE,
+        help="smallest write compressed for clients that asked for compression",
+    )
+    parser.add_argument(
+        "--no-compression",
+        action="store_true",
+        help="turn down every client's offer to compress",
+    )
+    parser.add_argument(
+        "--auth-workers",
+        type=int,
+        default=auth.WORKERS,
+        help="processes hashing and checking secret group keys",
+    )
+    parser.add_argument(
+        "--auth-cache",
+        type=float,
+        default=auth.CACHE_SECONDS,
+        help="seconds a correct secret key is let in again without checking it "
+        "(0 to always check)",
+    )
+    parser.add_argument(
+        "--group-workers",
+        type=int,
+        default=actor.WORKERS,
+        help="threads running the groups in threaded mode (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--snapshot",
+        help="save every group to this file and restore them when starting",
+    )
+    parser.add_argument(
+        "--snapshot-interval",
+        type=float,
+        default=snapshot.INTERVAL,
+        help="seconds between two snapshots (0 to only save when stopping)",
+    )
+    parser.add_argument(
+        "--resume-window",
+        type=float,
+        default=snapshot.RESUME_WINDOW,
+        help="seconds members of restored groups get to come back",
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=int,
+        default=transfer.MAX_SIZE,
+        help="largest file members can send each other, in bytes",
+    )
+    parser.add_argument(
+        "--transfer-timeout",
+        type=float,
+        default=transfer.STALL_TIMEOUT,
+        help="seconds a file transfer may make no progress before it is cancelled",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="serve Prometheus metrics on http://localhost:PORT/metrics "
+        "(off by default)",
+    )
+    args = parser.parse_args()
+
+    connection.QUEUE_SIZE = args.queue_size
+    connection.OVERFLOW = args.overflow
+    connection.COALESCE_DELAY = args.coalesce_ms / 1000
+    connection.COALESCE_BYTES = args.coalesce_bytes
+    connection.NODELAY = not args.nagle
+    history.MAX_MESSAGES = args.history_messages
+    history.MAX_BYTES = args.history_bytes
+    history.REPLAY = args.history_replay
+    msglog.LOG_DIR = args.log_dir
+    heartbeat.PING_INTERVAL = args.ping_interval
+    heartbeat.IDLE_TIMEOUT = args.idle_timeout
+    heartbeat.HANDSHAKE_TIMEOUT = args.handshake_timeout
+    heartbeat.WAITING_TIMEOUT = args.waiting_timeout
+    group.MAX_WAITING = args.waiting_limit
+    if args.no_rate_limits:
+        args.rate_messages = args.rate_bytes = args.rate_commands = 0
+        args.rate_group = 0
+    ratelimit.MESSAGES_PER_SECOND = args.rate_messages
+    ratelimit.BYTES_PER_SECOND = args.rate_bytes
+    ratelimit.COMMANDS_PER_SECOND = args.rate_commands
+    ratelimit.GROUP_MESSAGES_PER_SECOND = args.rate_group
+    ratelimit.FLOOD_MUTE_SECONDS = args.flood_mute
+    msglog.SEGMENT_BYTES = args.log_segment_size
+    msglog.RETENTION_SECONDS = args.log_retention * 3600
+    msglog.RETENTION_BYTES = args.log_retention_size
+    compression.ENABLED = not args.no_compression
+    compression.MIN_SIZE = args.compress_min_size
+    auth.WORKERS = args.auth_workers
+    auth.CACHE_SECONDS = args.auth_cache
+    actor.WORKERS = args.group_workers
+    snapshot.PATH = args.snapshot
+    snapshot.INTERVAL = args.snapshot_interval
+    snapshot.RESUME_WINDOW = args.resume_window
+    transfer.MAX_SIZE = args.max_file_size
+    transfer.STALL_TIMEOUT = args.transfer_timeout
+
+    if args.metrics_port:
+        metrics.serve(HOST, args.metrics_port)
+
+    if args.mode == "async":
+        import async_server
+
+        async_server.start_server()
+    elif args.mode == "prefork":
+        import prefork
+
+        prefork.start_server(args.workers)
+    else:
+        start_server()
+
+
 if __name__ == "__main__":
-    start_server()
+    main()
@@ -0,0 +1,298 @@
+"""
+Snapshots of every group, for a warm restart.
+
+Every INTERVAL seconds the state of the groups (type, admin, secret key hash,
+members with their mutes, topics and session tokens, waiting list) is written
+to PATH as zlib compressed JSON. Each group copies its own state on its actor,
+between two messages, and a thread encodes and writes the copies, so the chat
+only pauses for the copy. No fork: the server runs many threads and a child
+could inherit a lock one of them held.
+
+On startup the groups are restored with their members detached. A client that
+comes back with its session token within RESUME_WINDOW seconds is put back in
+its group without any prompt, the others are dropped from it once the window
+is over.
+"""
+
+import atexit
+import json
+import os
+import zlib
+from concurrent.futures import TimeoutError
+from threading import Thread
+from time import monotonic, time
+
+import directory
+import scheduler
+from colors import color
+from group import DETACHED, Group, Member, token_digest
+from protocol import text
+
+fg = color.fg
+reset = color.style.reset
+
+# where the snapshot goes, None disables them, overridden from the server
+# command line
+PATH = None
+INTERVAL = 30.0
+# seconds restored members get to come back
+RESUME_WINDOW = 120.0
+
+MAGIC = b"chat_house snapshot 1\n"
+
+NOT_RESUMED = text(
+    f"{fg.yellow} Your session could not be resumed{reset}\n"
+    f" {fg.lightblue}Enter you username: {reset}"
+)
+
+# every live group, by name, see directory
+groups = directory.groups
+# token digest -> (Group, username) of the restored members not back yet
+RESTORED = dict()
+
+# seconds a group gets to copy its state for the last snapshot at exit, it is
+# read as it stands after that
+FINAL_WAIT = 5.0
+
+# the Thread writing a snapshot
+_writer = None
+
+
+def _capture_group(group: Group):
+    """
+    copy the state of a group, on its actor
+    :param group: the Group
+    :return: the copy, None if the group is gone
+    """
+    if not group.is_alive:
+        return None
+
+    now = monotonic()
+    members = []
+    for member in group.roster():
+        # seconds left of a timed mute, 0 when muted until unmuted
+        muted = None
+        if member.muted:
+            muted = 0 if member.unmute is None else max(member.unmute.due - now, 1)
+        members.append([member.name, member.token, muted, sorted(member.topics)])
+
+    return {
+        "name": group.name,
+        "type": group.type,
+        "admin": group.admin,
+        "secret": group.secret_key,
+        "members": members,
+        "waiting": [[m.name, m.token] for m in group.waiting.values()],
+    }
+
+
+def _request() -> list:
+    """
+    ask every live group for a copy of its state
+    :return: (Group, Future of the copy) of each
+    """
+    return [
+        (group, group.actor.call(_capture_group, group))
+        for group in list(groups.values())
+        if group.is_alive
+    ]
+
+
+def _collect(copies: list, stamp: float, wait: float = None) -> dict:
+    """
+    :param copies: what _request returned
+    :param stamp: time() when they were asked for
+    :param wait: seconds to wait for each group, None for as long as it takes
+    :return: the state of every group, ready to be encoded
+    """
+    saved = []
+    for group, future in copies:
+        try:
+            state = future.result(wait)
+        except TimeoutError:
+            # only at exit, a group too busy to answer is read as it stands
+            state = _capture_group(group)
+        if state is not None:
+            saved.append(state)
+    return {"time": stamp, "groups": saved}
+
+
+def write(state: dict, path: str) -> None:
+    """
+    replace the snapshot file, a crash halfway leaves the previous one
+    :param state: what capture returned
+    :param path: the snapshot file
+    :return: None
+    """
+    data = MAGIC + zlib.compress(json.dumps(state, separators=(",", ":")).encode())
+    temp = path + ".tmp"
+    with open(temp, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, path)
+
+
+def read(path: str):
+    """
+    :param path: the snapshot file
+    :return: the state it holds, None if there is none or it can't be read
+    """
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+        if not data.startswith(MAGIC):
+            return None
+        return json.loads(zlib.decompress(data[len(MAGIC) :]))
+    except (OSError, ValueError, zlib.error):
+        return None
+
+
+def save() -> None:
+    """
+    start taking a snapshot in the background, unless one is on its way
+    :return: None
+    """
+    global _writer
+    if not PATH or (_writer is not None and _writer.is_alive()):
+        return
+
+    # asked for here, on the scheduler, so no group is ever read off its
+    # actor (in asyncio mode they answer right away), waited for by the writer
+    copies = _request()
+    stamp = time()
+    _writer = Thread(target=lambda: write(_collect(copies, stamp), PATH), daemon=True)
+    _writer.start()
+
+
+def _periodic() -> None:
+    save()
+    scheduler.later(INTERVAL, _periodic)
+
+
+def _final() -> None:
+    """
+    a last snapshot when the server stops, after the one in progress
+    :return: None
+    """
+    global _writer
+    if _writer is not None:
+        _writer.join()
+    _writer = None
+    write(_collect(_request(), time(), FINAL_WAIT), PATH)
+
+
+def start() -> None:
+    """
+    take snapshots every INTERVAL seconds and when the server exits
+    :return: None
+    """
+    if PATH and INTERVAL:
+        scheduler.later(INTERVAL, _periodic)
+    if PATH:
+        atexit.register(_final)
+
+
+def restore() -> int:
+    """
+    bring back the groups of the last snapshot, their members detached until
+    they resume their session
+    :return: number of groups restored
+    """
+    if not PATH:
+        return 0
+    state = read(PATH)
+    if state is None:
+        return 0
+
+    age = time() - state["time"]
+    restored = 0
+    for saved in state["groups"]:
+        if saved["name"] in groups:
+            continue
+
+        group = Group(
+            saved["name"], saved["admin"], DETACHED, saved["type"], saved["secret"]
+        )
+        # (username, token digest) of every restored member
+        names = []
+        for name, token, muted, *topics in saved["members"]:
+            member = group.sessions.get(name)
+            if member is None:
+                member = Member(name, DETACHED)
+                group._join(member)
+            member.token = token
+            for topic in topics[0] if topics else ():
+                group._follow(member, topic)
+            if muted is not None and (muted == 0 or muted > age):
+                member.muted = True
+                if muted:
+                    member.unmute = scheduler.later(
+                        muted - age,
+                        group.actor.post,
+                        group._lift_mute,
+                        member,
+                        group.admin,
+                    )
+            names.append((name, token))
+
+        for name, token in saved["waiting"]:
+            member = Member(name, DETACHED, waiting=True)
+            member.token = token
+            group.sessions[name] = member
+            group.waiting[name] = member
+            names.append((name, token))
+
+        for name, token in names:
+            # nobody else gets their name while they may come back
+            directory.claim(name, DETACHED)
+            if group.is_member(name):
+                directory.joined(name, group)
+            if token is not None:
+                RESTORED[token] = (group, name)
+
+        directory.add_group(group)
+        scheduler.later(RESUME_WINDOW, group.actor.post, _expire, group, names)
+        restored += 1
+
+    return restored
+
+
+def _expire(group: Group, names: list) -> None:
+    """
+    drop the restored members of a group who did not come back in time
+    :param group: the Group
+    :param names: (username, token digest) of each restored member
+    :return: None
+    """
+    for name, token in names:
+        RESTORED.pop(token, None)
+        directory.release(name, DETACHED)
+        member = group.sessions.get(name)
+        if not group.is_alive or member is None or member.conn is not DETACHED:
+            continue
+        if member.waiting:
+            group.withdraw(name)
+        else:
+            group.quit(name)
+
+
+def resume(conn, token: bytes) -> tuple:
+    """
+    put a returning client back in its group
+    :param conn: connection of the client
+    :param token: payload of the SESSION frame it answered the first prompt with
+    :return: (username, Group), or (None, None) if the session is gone, the
+             client was then asked for a username
+    """
+    entry = RESTORED.pop(token_digest(token), None)
+    if entry is not None:
+        group, name = entry
+        directory.release(name, DETACHED)
+        if directory.claim(name, conn):
+            if group.actor.call(group.reattach, name, conn).result():
+                return name, group
+            directory.release(name, conn)
+
+    conn.send(NOT_RESUMED)
+    return None, None
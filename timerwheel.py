@@ -0,0 +1,111 @@
+"""
+Hashed timer wheel.
+
+Timers are hashed into a ring of slots by the tick they expire at. Scheduling
+and cancelling are O(1) and each tick only looks at one slot, so tens of
+thousands of pending deadlines cost next to nothing until they are due. Timers
+further away than one turn of the wheel carry the number of turns left.
+"""
+
+from math import ceil
+from threading import Lock
+from time import monotonic
+
+
+class Timer:
+    """
+    A pending call, returned by TimerWheel.schedule to cancel it
+    """
+
+    __slots__ = ("slot", "rounds", "callback", "args", "due")
+
+    def __init__(
+        self, slot: int, rounds: int, callback, args: tuple, due: float
+    ) -> None:
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+        # monotonic time it fires at, give or take a tick
+        self.due = due
+
+
+class TimerWheel:
+    """
+    Calls functions after a delay, with a precision of one tick
+    """
+
+    def __init__(self, tick: float = 1.0, size: int = 512) -> None:
+        """
+
+        :param tick: seconds per slot, the precision of the timers
+        :param size: number of slots, one turn of the wheel is tick * size
+        """
+        self.tick = tick
+        self.size = size
+        self.slots = [set() for _ in range(size)]
+        self.cursor = 0
+        self.time = monotonic()
+        # schedule and cancel may come from any thread, callbacks run
+        # without it held
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return sum(map(len, self.slots))
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        """
+        call a function once a delay has passed
+        :param delay: seconds, rounded up to the next tick
+        :param callback: the function
+        :param args: its arguments
+        :return: the Timer, to cancel it
+        """
+        ticks = max(1, ceil(delay / self.tick))
+        with self.lock:
+            slot = (self.cursor + ticks) % self.size
+            due = self.time + ticks * self.tick
+            timer = Timer(slot, (ticks - 1) // self.size, callback, args, due)
+            self.slots[slot].add(timer)
+        return timer
+
+    def cancel(self, timer: Timer) -> None:
+        """
+        :param timer: a Timer that may or may not have fired yet
+        :return: None
+        """
+        with self.lock:
+            self.slots[timer.slot].discard(timer)
+
+    def advance(self, now: float = None) -> int:
+        """
+        move the wheel up to the current time, calling every timer due
+        :param now: current monotonic time
+        :return: how many timers fired
+        """
+        now = monotonic() if now is None else now
+        fired = 0
+
+        while self.time + self.tick <= now:
+            due = []
+            with self.lock:
+                self.time += self.tick
+                self.cursor = (self.cursor + 1) % self.size
+                slot = self.slots[self.cursor]
+                for timer in list(slot):
+                    if timer.rounds:
+                        timer.rounds -= 1
+                    else:
+                        slot.remove(timer)
+                        due.append(timer)
+
+            for timer in due:
+                try:
+                    timer.callback(*timer.args)
+                except Exception as error:
+                    # one failing action must not stop the wheel for the others
+                    name = getattr(timer.callback, "__qualname__", timer.callback)
+                    print(f"[-] DEFERRED ACTION {name} FAILED: {error!r}")
+            fired += len(due)
+
+        return fired
@@ -0,0 +1,490 @@
+"""
+File transfers between members of a group.
+
+The sender announces a file with a FILE frame, streams it as CHUNK frames of at
+most CHUNK_SIZE bytes and closes it with a FILE_END frame carrying its sha256.
+The server relays each frame to the recipients as it comes and keeps nothing
+but who gets what: recipients acknowledge what they wrote with FILE_ACK frames
+and the sender never has more than WINDOW bytes the slowest recipient hasn't
+acknowledged. A transfer so never takes more than WINDOW bytes of anyone's
+outbound queue, and chat keeps flowing between its chunks.
+
+    FILE      id, size, name length, name, then the recipients (to the server)
+              or the sender (from the server), comma separated
+    CHUNK     id, data
+    FILE_END  id, sha256 of the whole file, or nothing when it was cancelled
+    FILE_ACK  id, bytes written so far, or nothing when it was cancelled
+
+Clients only get FILE, CHUNK and FILE_END for what they receive and FILE_ACK
+for what they send, ids are the server's for the former and the sender's own
+for the latter.
+"""
+
+import hashlib
+import os
+import struct
+from itertools import count
+
+import metrics
+import scheduler
+from protocol import CHUNK, FILE, FILE_ACK, FILE_END, Template, encode, text
+
+# frames of a transfer, handled here rather than as chat
+FRAMES = (FILE, CHUNK, FILE_END, FILE_ACK)
+
+CHUNK_SIZE = 32 << 10
+# bytes a sender may have in flight, unacknowledged by the slowest recipient
+WINDOW = 256 << 10
+
+# id, size, name length
+HEAD = struct.Struct("!IQH")
+ID = struct.Struct("!I")
+# id, bytes written
+ACK = struct.Struct("!IQ")
+
+
+def file_frame(tid: int, size: int, name: str, who: str) -> bytes:
+    """
+    :param tid: id of the transfer
+    :param size: bytes in the file
+    :param name: name of the file
+    :param who: recipients (to the server, empty for the whole group) or sender
+    :return: the encoded FILE frame
+    """
+    name = name.encode()
+    return encode(FILE, HEAD.pack(tid, size, len(name)) + name + who.encode())
+
+
+def parse_file(payload: bytes) -> tuple:
+    """
+    :param payload: payload of a FILE frame
+    :return: id, size, name and recipients or sender
+    """
+    tid, size, length = HEAD.unpack_from(payload)
+    name = payload[HEAD.size : HEAD.size + length].decode()
+    return tid, size, name, payload[HEAD.size + length :].decode()
+
+
+def chunk_frame(tid: int, data: bytes) -> bytes:
+    return encode(CHUNK, ID.pack(tid) + data)
+
+
+def end_frame(tid: int, digest: bytes = b"") -> bytes:
+    """
+    :param tid: id of the transfer
+    :param digest: sha256 of the file, none to cancel it
+    :return: the encoded FILE_END frame
+    """
+    return encode(FILE_END, ID.pack(tid) + digest)
+
+
+def ack_frame(tid: int, done: int = None) -> bytes:
+    """
+    :param tid: id of the transfer
+    :param done: bytes written so far, None to cancel it
+    :return: the encoded FILE_ACK frame
+    """
+    if done is None:
+        return encode(FILE_ACK, ID.pack(tid))
+    return encode(FILE_ACK, ACK.pack(tid, done))
+
+
+# ---------------------------------------
+# | SERVER                              |
+# ---------------------------------------
+
+# overridden from the server command line
+MAX_SIZE = 1 << 30
+# transfers a member can have going at once
+MAX_ACTIVE = 4
+# seconds a recipient (or the sender) may make no progress before being dropped
+STALL_TIMEOUT = 60.0
+
+MUTED = text("You can't send files while muted")
+TOO_BIG = Template("Files are limited to {} bytes")
+TOO_MANY = text("Too many files on their way, wait for one to finish")
+CANT_RECEIVE = Template("{} can't receive files")
+NOBODY = text("Nobody can receive the file")
+
+_ids = count(1)
+
+
+class Transfer:
+    """
+    A file on its way through a group, only its routing and progress are kept
+    """
+
+    __slots__ = (
+        "id",
+        "local",
+        "sender",
+        "conn",
+        "size",
+        "sent",
+        "acked",
+        "checked",
+        "recipients",
+        "timer",
+    )
+
+    def __init__(
+        self, tid: int, local: int, sender: str, conn, size: int, recipients
+    ) -> None:
+        """
+
+        :param tid: id of the transfer for the recipients
+        :param local: id of the transfer for the sender
+        :param sender: username of the sender
+        :param conn: connection of the sender
+        :param size: bytes in the file
+        :param recipients: Member of each recipient
+        """
+        self.id = tid
+        self.local = local
+        self.sender = sender
+        self.conn = conn
+        self.size = size
+        self.sent = 0
+        # what the slowest recipient acknowledged
+        self.acked = 0
+        # sent as of the last stall check
+        self.checked = 0
+        # username -> [Member, bytes acknowledged, as of the last stall check]
+        self.recipients = {member.name: [member, 0, 0] for member in recipients}
+        self.timer = None
+
+    def send(self, frame: bytes) -> None:
+        for member, _, _ in self.recipients.values():
+            member.conn.send(frame)
+
+
+def handle(group, username: str, conn, frame) -> None:
+    """
+    Function to handle a frame of a transfer, on the group's actor
+    :param group: Group of the member
+    :param username: the member
+    :param conn: connection of the member
+    :param frame: the FILE, CHUNK, FILE_END or FILE_ACK frame
+    :return: None
+    """
+    payload = frame.payload
+    if frame.type == FILE:
+        _start(group, username, conn, payload)
+        return
+
+    (tid,) = ID.unpack_from(payload)
+    if frame.type == FILE_ACK:
+        transfer = group.transfers.get(tid)
+        if transfer is not None and username in transfer.recipients:
+            _, done = ACK.unpack(payload)
+            _acknowledge(transfer, username, done)
+        return
+
+    transfer = group.uploads.get((username, tid))
+    if transfer is None:
+        # cancelled while this was on its way
+        return
+
+    if frame.type == CHUNK:
+        data = payload[ID.size :]
+        if (
+            len(data) > CHUNK_SIZE
+            or transfer.sent + len(data) > transfer.size
+            or transfer.sent - transfer.acked >= WINDOW
+        ):
+            # a sender that doesn't play by the window is cut off
+            _cancel(group, transfer, "broken")
+            return
+
+        transfer.sent += len(data)
+        transfer.send(chunk_frame(transfer.id, data))
+        metrics.FILE_BYTES.inc(len(data) * len(transfer.recipients))
+
+    elif frame.type == FILE_END:
+        digest = payload[ID.size :]
+        if not digest or transfer.sent != transfer.size:
+            _cancel(group, transfer, "cancelled" if not digest else "broken")
+            return
+
+        transfer.send(end_frame(transfer.id, digest))
+        _forget(group, transfer)
+        metrics.TRANSFERS.inc(label="done")
+
+
+def _start(group, username: str, conn, payload: bytes) -> None:
+    """
+    announce a file to its recipients
+    :param group: Group of the sender
+    :param username: the sender
+    :param conn: connection of the sender
+    :param payload: payload of the FILE frame
+    :return: None
+    """
+    local, size, name, names = parse_file(payload)
+    refusal = None
+    if group.is_muted(username):
+        refusal = MUTED
+    elif size > MAX_SIZE:
+        refusal = TOO_BIG(MAX_SIZE)
+    elif (username, local) in group.uploads or MAX_ACTIVE <= sum(
+        1 for sender, _ in group.uploads if sender == username
+    ):
+        refusal = TOO_MANY
+
+    recipients = []
+    if refusal is None:
+        if names:
+            wanted = {i.strip() for i in names.split(",") if i.strip()}
+            wanted.discard(username)
+            recipients = [
+                member
+                for member in map(group.member, wanted)
+                if member is not None and member.conn.files
+            ]
+            unable = wanted.difference([member.name for member in recipients])
+            if unable:
+                conn.send(CANT_RECEIVE(", ".join(sorted(unable))))
+        else:
+            recipients = [
+                member
+                for member in group.roster()
+                if member.name != username and member.conn.files
+            ]
+        if not recipients:
+            refusal = NOBODY
+
+    if refusal is not None:
+        conn.send(refusal)
+        conn.send(ack_frame(local))
+        metrics.TRANSFERS.inc(label="refused")
+        return
+
+    tid = next(_ids) & 0xFFFFFFFF
+    transfer = Transfer(tid, local, username, conn, size, recipients)
+    group.transfers[transfer.id] = transfer
+    group.uploads[(username, local)] = transfer
+    transfer.send(file_frame(transfer.id, size, name, username))
+    transfer.timer = scheduler.later(
+        STALL_TIMEOUT, group.actor.post, _check, group, transfer
+    )
+
+
+def _acknowledge(transfer: Transfer, username: str, done: int) -> None:
+    """
+    a recipient wrote more of the file, the sender hears about it once the
+    slowest recipient did
+    :param transfer: the Transfer
+    :param username: the recipient
+    :param done: bytes the recipient wrote
+    :return: None
+    """
+    entry = transfer.recipients[username]
+    behind = entry[1] == transfer.acked
+    entry[1] = max(entry[1], min(done, transfer.sent))
+    if behind:
+        _advance(transfer)
+
+
+def _advance(transfer: Transfer) -> None:
+    acked = min([entry[1] for entry in transfer.recipients.values()])
+    if acked > transfer.acked:
+        transfer.acked = acked
+        transfer.conn.send(ack_frame(transfer.local, acked))
+
+
+def _drop(group, transfer: Transfer, username: str) -> None:
+    """
+    take a recipient out of a transfer, which ends if nobody is left
+    :param group: Group of the transfer
+    :param transfer: the Transfer
+    :param username: the recipient
+    :return: None
+    """
+    member = transfer.recipients.pop(username)[0]
+    member.conn.send(end_frame(transfer.id))
+    if transfer.recipients:
+        _advance(transfer)
+    else:
+        _cancel(group, transfer, "cancelled")
+
+
+def _cancel(group, transfer: Transfer, outcome: str) -> None:
+    transfer.send(end_frame(transfer.id))
+    transfer.conn.send(ack_frame(transfer.local))
+    _forget(group, transfer)
+    metrics.TRANSFERS.inc(label=outcome)
+
+
+def _forget(group, transfer: Transfer) -> None:
+    del group.transfers[transfer.id]
+    del group.uploads[(transfer.sender, transfer.local)]
+    if transfer.timer is not None:
+        scheduler.cancel(transfer.timer)
+
+
+def _check(group, transfer: Transfer) -> None:
+    """
+    drop the recipients that made no progress since the last check, or the
+    whole transfer if the sender didn't
+    :param group: Group of the transfer
+    :param transfer: the Transfer
+    :return: None
+    """
+    if group.transfers.get(transfer.id) is not transfer:
+        return
+
+    if transfer.sent == transfer.checked and transfer.acked == transfer.sent:
+        _cancel(group, transfer, "stalled")
+        return
+    transfer.checked = transfer.sent
+
+    for name, entry in list(transfer.recipients.items()):
+        if entry[1] == entry[2] and entry[1] < transfer.sent:
+            _drop(group, transfer, name)
+            if group.transfers.get(transfer.id) is not transfer:
+                return
+        else:
+            entry[2] = entry[1]
+
+    transfer.timer = scheduler.later(
+        STALL_TIMEOUT, group.actor.post, _check, group, transfer
+    )
+
+
+def left(group, username: str) -> None:
+    """
+    end or shrink the transfers of a member who is no longer in the group
+    :param group: Group the member left
+    :param username: the member
+    :return: None
+    """
+    for transfer in list(group.transfers.values()):
+        if group.transfers.get(transfer.id) is not transfer:
+            continue
+        if transfer.sender == username:
+            _cancel(group, transfer, "cancelled")
+        elif username in transfer.recipients:
+            _drop(group, transfer, username)
+
+
+def close(group) -> None:
+    """
+    cancel every transfer of a group that is going away
+    :param group: the Group
+    :return: None
+    """
+    for transfer in list(group.transfers.values()):
+        _cancel(group, transfer, "cancelled")
+
+
+# ---------------------------------------
+# | CLIENT                              |
+# ---------------------------------------
+
+DOWNLOAD_DIR = "downloads"
+
+
+class Upload:
+    """
+    A file being sent, read from disk a chunk at a time as the window opens
+    """
+
+    def __init__(self, tid: int, path: str, recipients: str = "") -> None:
+        """
+
+        :param tid: id of the transfer, unique among the client's uploads
+        :param path: the file
+        :param recipients: comma separated usernames, empty for the whole group
+        """
+        self.id = tid
+        self.file = open(path, "rb")
+        self.name = os.path.basename(path)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.recipients = recipients
+        self.sent = 0
+        self.acked = 0
+        self.hash = hashlib.sha256()
+        self.done = False
+
+    def start(self) -> bytes:
+        """
+        :return: the FILE frame and the first window of chunks
+        """
+        return file_frame(self.id, self.size, self.name, self.recipients) + self.next(0)
+
+    def next(self, acked: int) -> bytes:
+        """
+        :param acked: bytes the recipients acknowledged
+        :return: the chunks the window now lets through, and the FILE_END frame
+                 after the last one
+        """
+        self.acked = max(self.acked, acked)
+        frames = []
+        while not self.done and self.sent - self.acked < WINDOW:
+            data = self.file.read(min(CHUNK_SIZE, self.size - self.sent))
+            if not data:
+                # the end of the file, or of what is left of it
+                self.done = True
+                self.file.close()
+                frames.append(end_frame(self.id, self.hash.digest()))
+                break
+
+            self.hash.update(data)
+            self.sent += len(data)
+            frames.append(chunk_frame(self.id, data))
+        return b"".join(frames)
+
+    def cancel(self) -> None:
+        self.done = True
+        self.file.close()
+
+
+class Download:
+    """
+    A file being received, written to disk as it comes
+    """
+
+    def __init__(self, payload: bytes, directory: str = DOWNLOAD_DIR) -> None:
+        """
+
+        :param payload: payload of the FILE frame announcing it
+        :param directory: where to save it
+        """
+        self.id, self.size, name, self.sender = parse_file(payload)
+        # only ever a name, never a path somewhere else
+        self.name = os.path.basename(name.replace("\\", "/")) or "file"
+        os.makedirs(directory, exist_ok=True)
+        base, ext = os.path.splitext(self.name)
+        self.path = os.path.join(directory, self.name)
+        copy = 0
+        while os.path.exists(self.path):
+            copy += 1
+            self.path = os.path.join(directory, f"{base} ({copy}){ext}")
+
+        self.part = self.path + ".part"
+        self.file = open(self.part, "wb")
+        self.received = 0
+        self.hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> bytes:
+        """
+        :param data: the next chunk
+        :return: the FILE_ACK frame to send back
+        """
+        self.file.write(data)
+        self.hash.update(data)
+        self.received += len(data)
+        return ack_frame(self.id, self.received)
+
+    def finish(self, digest: bytes) -> bool:
+        """
+        :param digest: checksum from the FILE_END frame, empty if cancelled
+        :return: whether the file arrived whole, it is then at self.path,
+                 otherwise nothing is left of it
+        """
+        self.file.close()
+        if digest and digest == self.hash.digest() and self.received == self.size:
+            os.replace(self.part, self.path)
+            return True
+        os.remove(self.part)
+        return False